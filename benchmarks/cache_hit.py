@@ -0,0 +1,72 @@
+"""Cache hit latency of MongoCache.find_one, deepcopy-on-read vs read only views.
+
+run from the repo root with:
+python -m benchmarks.cache_hit
+"""
+import tempfile
+import timeit
+from copy import deepcopy
+
+from bson import ObjectId
+
+from utils.models.settings.guild import DEFAULT_COINS
+from utils.MongoCache import MongoCache
+
+LOOPS = 20000
+
+
+def character_document():
+    base = DEFAULT_COINS["basecoin"]
+    return {
+        "_id": ObjectId(),
+        "user": "980955381725556777",
+        "guild": "951225215801757716",
+        "name": "Bob",
+        "sheet": "https://ddb.ac/characters/123",
+        "multiclasses": {"Bard": 3, "Wizard": 2},
+        "xp": 12.0,
+        "lastlog": {"id": ObjectId(), "time": 1660000000},
+        "coinpurse": {
+            "coinlist": [
+                {"count": "15", "base": base, "type": x, "isbase": x is base}
+                for x in (base, *DEFAULT_COINS["cointypes"])
+            ]
+        },
+    }
+
+
+def main():
+    # hits never touch the database, so the cache doesn't need a bot
+    cache = MongoCache(None, tempfile.mkdtemp(), maxsize=50, ttl=3600)
+    document = character_document()
+    cache[str(document["_id"])] = {**document, "collectionkey": "charactercollection"}
+    filt = {"user": document["user"], "guild": document["guild"], "name": "Bob"}
+
+    def find_one():
+        # a hit never awaits anything, so the coroutine finishes on its first step
+        try:
+            cache.find_one("charactercollection", filt).send(None)
+        except StopIteration as e:
+            return e.value
+
+    def before():
+        # the old find_one hit path, plus the copy Character.get_data made of _id
+        match = deepcopy(cache._find_matches_in_self("charactercollection", filt))
+        match[0].pop("collectionkey")
+        deepcopy(match[0]["_id"])
+
+    def after():
+        char = find_one()
+        # what Character.get_data copies now
+        char = dict(char)
+        char["coinpurse"] = dict(char["coinpurse"])
+
+    old = timeit.timeit(before, number=LOOPS) / LOOPS
+    new = timeit.timeit(after, number=LOOPS) / LOOPS
+    print(f"deepcopy on read: {old * 1e6:8.2f} us/hit")
+    print(f"read only views:  {new * 1e6:8.2f} us/hit")
+    print(f"speedup:          {old / new:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
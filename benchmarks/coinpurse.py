@@ -0,0 +1,49 @@
+"""Memory and hydration time of character coinpurses, a list of Coin objects vs the array backed purse.
+
+run from the repo root with:
+python -m benchmarks.coinpurse
+"""
+import timeit
+import tracemalloc
+
+from utils.models.coinpurse import Coin, CoinPurse
+from utils.models.settings.coin import CoinConfig
+from utils.models.settings.guild import DEFAULT_COINS
+
+PURSES = 2000
+LOOPS = 5
+
+
+def purse_document(config: CoinConfig):
+    return {"coinlist": [{**x, "count": 15} for x in config.gen_coinpurse_dict()]}
+
+
+def measure(build):
+    tracemalloc.start()
+    kept = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return size / PURSES
+
+
+def main():
+    config = CoinConfig.from_dict(DEFAULT_COINS)
+    documents = [purse_document(config) for _ in range(PURSES)]
+
+    def before():
+        # what every character carried before, a Coin (with its own base and type) per coin
+        return [[Coin.from_dict(x) for x in y["coinlist"]] for y in documents]
+
+    def after():
+        return [CoinPurse.from_dict({**x, "config": config}) for x in documents]
+
+    old_size, new_size = measure(before), measure(after)
+    old = timeit.timeit(before, number=LOOPS) / LOOPS / PURSES
+    new = timeit.timeit(after, number=LOOPS) / LOOPS / PURSES
+    print(f"coin objects: {old_size:8.0f} bytes/purse {old * 1e6:8.2f} us/purse")
+    print(f"arrays:       {new_size:8.0f} bytes/purse {new * 1e6:8.2f} us/purse")
+
+
+if __name__ == "__main__":
+    main()
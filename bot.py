@@ -2,7 +2,7 @@ import asyncio
 import logging
 import os
 import traceback
-from typing import Optional
+from typing import Any, AsyncIterator, Dict, Iterable, List, Mapping, Optional, Union
 
 import disnake
 import motor.motor_asyncio
@@ -13,11 +13,15 @@ from disnake.ext import commands
 from disnake.ext.commands.errors import CommandInvokeError
 
 from utils import MongoCache, config
+from utils.database import Database, PoolMonitor, connect, parse_read_preferences
+from utils.indexes import INDEXES, POLL_INDEXES, ensure_indexes, explain_queries
 from utils.models.character import Character
 from utils.models.errors import LabyrinthianException, MissingCharacterDataError
 from utils.models.settings.guild import ServerSettings
 from utils.models.settings.user import UserPreferences
-from utils.models.xplog import XPLogBook
+from utils.models.xplog import XPLogBook, XPStats
+from utils.partitions import DEFAULT_PARTITIONS, WATCHED_TTL, with_ttl
+from utils.sharedcache import RedisBackend, SharedCacheBackend
 
 if config.TESTING:
     import sys
@@ -40,6 +44,9 @@ intents = disnake.Intents.all()
 
 cwd = os.getcwd()
 
+# characters hydrated at a time by get_characters_bulk
+BULK_BATCH = 200
+
 extensions = (
     "cogs.characterlog.charactercog",
     "cogs.administrative.configcog",
@@ -66,16 +73,62 @@ class Labyrinthian(commands.Bot):
             **options,
         )
         self.persistent_views_added = False
+        self._dbsetup: Optional["asyncio.Task[None]"] = None
 
         # databases
-        self.mclient = motor.motor_asyncio.AsyncIOMotorClient(config.MONGO_URL)
-        self.sdb: motor.motor_asyncio.AsyncIOMotorDatabase = self.mclient[
-            config.MONGODB_TESTINGDB_NAME
-            if config.TESTING
-            else config.MONGODB_SERVERDB_NAME
-        ]
-        self.dbcache = MongoCache.MongoCache(self, cwd, maxsize=50, ttl=30)
-        self.charcache = MongoCache.CharlistCache(self, maxsize=50, ttl=30)
+        self.dbpool = PoolMonitor()
+        self.mclient = connect(config.MONGO_URL, self.dbpool)
+        self.sdb: motor.motor_asyncio.AsyncIOMotorDatabase = Database(
+            self.mclient[
+                config.MONGODB_TESTINGDB_NAME
+                if config.TESTING
+                else config.MONGODB_SERVERDB_NAME
+            ],
+            parse_read_preferences(config.MONGO_READ_PREFERENCES),
+        )
+        self.sharedcache: Optional[SharedCacheBackend] = (
+            RedisBackend(config.REDIS_URL) if config.REDIS_URL else None
+        )
+        self.dbcache = MongoCache.MongoCache(
+            self,
+            cwd,
+            maxsize=50,
+            ttl=WATCHED_TTL if config.CACHE_WATCH else 30,
+            partitions=(
+                with_ttl(DEFAULT_PARTITIONS, WATCHED_TTL)
+                if config.CACHE_WATCH
+                else None
+            ),
+            write_behind=config.CACHE_WRITE_BEHIND,
+            backend=self.sharedcache,
+            watch=config.CACHE_WATCH,
+            serve_stale=config.CACHE_SERVE_STALE,
+            read_max_time_ms=config.MONGO_READ_MAX_TIME_MS,
+        )
+        self.charcache = MongoCache.CharlistCache(
+            self,
+            maxsize=50,
+            ttl=30,
+            backend=self.sharedcache,
+            serve_stale=config.CACHE_SERVE_STALE,
+            workdir=cwd,
+        )
+
+    async def start(self, *args, **kwargs) -> None:
+        # index builds can take a while on big collections, nothing waits on them
+        self._dbsetup = asyncio.create_task(self.setup_database())
+        await self.dbcache.start()
+        await self.charcache.start()
+        await super().start(*args, **kwargs)
+
+    async def close(self) -> None:
+        await super().close()
+        if self._dbsetup is not None:
+            self._dbsetup.cancel()
+        await self.dbcache.close()
+        await self.charcache.close()
+        if self.sharedcache is not None:
+            await self.sharedcache.close()
 
     async def get_server_settings(
         self, guild_id: str, validate: bool = True
@@ -117,6 +170,20 @@ class Labyrinthian(commands.Bot):
         else:
             return Character.no_validate(data)
 
+    async def get_character_fields(
+        self, guild_id: str, user_id: str, character_name: str, *fields: str
+    ) -> Mapping[str, Any]:
+        """Slim read of a few character fields, for callers (i.e. autocompletes)
+        that don't need a whole Character."""
+        data = await Character.get_data(
+            self,
+            {"user": user_id, "guild": guild_id, "name": character_name},
+            projection=fields,
+        )
+        if data is None:
+            raise MissingCharacterDataError()
+        return data
+
     async def get_char_by_oid(
         self, oid: ObjectId, validate: bool = True
     ) -> Optional[Character]:
@@ -128,9 +195,88 @@ class Labyrinthian(commands.Bot):
         else:
             return Character.no_validate(data)
 
+    async def setup_database(self):
+        """Makes sure the indexes the bot's queries rely on exist, see utils.indexes.
+        Then counts the xp logged before each guild had stats, see XPStats.rebuild."""
+        await ensure_indexes(
+            self.sdb, INDEXES + (POLL_INDEXES if config.CACHE_WATCH else ())
+        )
+        if config.MONGO_EXPLAIN:
+            await explain_queries(self.sdb)
+        rebuilt = await self.sdb["xpstats"].distinct(
+            "guild", {"charref": None, "rebuilt": True}
+        )
+        for guild in set(await self.sdb["xplog"].distinct("guild")) - set(rebuilt):
+            settings = await self.get_server_settings(guild, validate=False)
+            await XPStats.rebuild(self.sdb, guild, settings.xptemplate)
+
+    def db_stats(self) -> Mapping[str, Any]:
+        """Connection pool wait times and cache hit ratios, for keeping an eye on the database layer."""
+        return {"pool": self.dbpool.stats(), "cache": self.dbcache.stats()}
+
+    async def get_characters_bulk(
+        self,
+        query: Union[Iterable[ObjectId], Mapping[str, Any]],
+        validate: bool = False,
+    ) -> AsyncIterator[Character]:
+        """Streams the characters with the given ids, or matching a filter, out of a single query.
+        Every character of a guild shares one ServerSettings (and CoinConfig), user prefs are
+        fetched with one query per batch of characters."""
+        if not isinstance(query, Mapping):
+            query = {"_id": {"$in": list(query)}}
+        settings: Dict[str, ServerSettings] = {}
+        uprefs: Dict[str, UserPreferences] = {}
+        batch = []
+        async for document in self.dbcache.find_many(
+            "charactercollection", query, batch_size=BULK_BATCH
+        ):
+            batch.append(document)
+            if len(batch) >= BULK_BATCH:
+                for char in await self._hydrate_characters(
+                    batch, settings, uprefs, validate
+                ):
+                    yield char
+                batch = []
+        for char in await self._hydrate_characters(batch, settings, uprefs, validate):
+            yield char
+
+    async def _hydrate_characters(
+        self,
+        batch: List[Mapping[str, Any]],
+        settings: Dict[str, ServerSettings],
+        uprefs: Dict[str, UserPreferences],
+        validate: bool,
+    ) -> List[Character]:
+        users = list({x["user"] for x in batch} - uprefs.keys())
+        if users:
+            async for data in self.dbcache.find_many(
+                "userprefs", {"user": {"$in": users}}
+            ):
+                uprefs[data["user"]] = UserPreferences.no_validate(
+                    {**data, "_base": data}
+                )
+        chars = []
+        for document in batch:
+            if document["guild"] not in settings:
+                settings[document["guild"]] = await self.get_server_settings(
+                    document["guild"], validate=False
+                )
+            if document["user"] not in uprefs:
+                uprefs[document["user"]] = await self.get_user_prefs(document["user"])
+            data = Character.hydrate(
+                document, settings[document["guild"]], uprefs[document["user"]]
+            )
+            chars.append(
+                Character.parse_obj(data) if validate else Character.no_validate(data)
+            )
+        return chars
+
     async def get_character_xplog(self, character_ref_id: ObjectId):
         return await XPLogBook.new(self.sdb, character_ref_id)
 
+    async def get_character_xpstats(self, guild: str, character_ref_id: ObjectId):
+        return await XPStats.find(self.sdb, guild, character_ref_id)
+
 
 bot = Labyrinthian(
     prefix="'",
@@ -1,15 +1,17 @@
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, Iterable, List
 
 import disnake
 import rapidfuzz
 from disnake.ext import commands
 from pydantic import ValidationError
+from utils.models.character import Character
+from utils.models.coinparser import CoinParser
+from utils.models.coinpurse import CoinPurse
 from utils.ui.logui import LogMenu
 from utils.ui.settingsui import SettingsNav
 
 if TYPE_CHECKING:
     from bot import Labyrinthian
-    from utils.models.character import Character
     from utils.models.settings.user import UserPreferences
 
 
@@ -107,6 +109,59 @@ class Configs(commands.Cog):
                 ephemeral=True,
             )
 
+    @staff.sub_command()
+    @commands.cooldown(3, 30.0, type=commands.BucketType.user)
+    async def payout(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        role: disnake.Role,
+        input: str,
+    ):
+        """Pay (or charge, with negative amounts) the active character of everyone with a role.
+        Parameters
+        ----------
+        role: Whose characters get paid, @everyone for a server-wide stipend.
+        input: The amount, i.e. 5gp 3sp."""
+        guild_id = str(inter.guild.id)
+        settings = await self.bot.get_server_settings(guild_id, validate=False)
+        counts = CoinParser.for_config(settings.coinconf).parse(input)
+        amount = CoinPurse.from_counts(counts, settings.coinconf)
+        if not any(amount.counts):
+            await inter.send("No matching currency types found", ephemeral=True)
+            return
+        await inter.response.defer()
+        users = [str(x.id) for x in role.members if not x.bot]
+        charids = []
+        async for data in self.bot.dbcache.find_many(
+            "userprefs", {"user": {"$in": users}}, projection=("activechar",)
+        ):
+            active = data.get("activechar", {}).get(guild_id)
+            if active and active.get("id"):
+                charids.append(active["id"])
+        if not charids:
+            await inter.send(f"Nobody with {role.mention} has an active character.")
+            return
+        chars: List["Character"] = [
+            x async for x in self.bot.get_characters_bulk(charids)
+        ]
+        paid = await Character.mutate_many(self.bot.dbcache, chars, amount)
+        embed = disnake.Embed(
+            title="Payout",
+            description=" ".join(x.full_display_str for x in amount if x),
+            color=disnake.Colour.random(),
+        ).add_field(
+            name="Paid",
+            value=_roster(x for x, y in zip(chars, paid) if y) or "Nobody",
+            inline=False,
+        )
+        if not all(paid):
+            embed.add_field(
+                name="Not paid",
+                value=_roster(x for x, y in zip(chars, paid) if not y),
+                inline=False,
+            )
+        await inter.send(embed=embed)
+
     @staff.sub_command()
     async def removelisting(
         self, inter: disnake.ApplicationCommandInteraction, listing: str
@@ -132,5 +187,17 @@ class Configs(commands.Cog):
             return [x[0] for x in rapidfuzz.process.extract(user_input, charlist)]
 
 
+def _roster(chars: Iterable["Character"], limit: int = 1024) -> str:
+    """Characters one per line, cut short to fit an embed field."""
+    lines = [f"{x.name} (<@{x.user}>)" for x in chars]
+    shown = []
+    for line in lines:
+        if sum(len(x) + 1 for x in shown) + len(line) > limit - 20:
+            shown.append(f"...and {len(lines) - len(shown)} more")
+            break
+        shown.append(line)
+    return "\n".join(shown)
+
+
 def setup(bot):
     bot.add_cog(Configs(bot))
@@ -100,8 +100,9 @@ class CharacterLog(
                 name=name, id=result.inserted_id
             )
             await uprefs.commit(self.bot.dbcache)
-            if f"{inter.guild.id}{inter.author.id}" in self.bot.charcache:
-                self.bot.charcache.pop(f"{inter.guild.id}{inter.author.id}")
+            await self.bot.charcache.invalidate(
+                str(inter.guild.id), str(inter.author.id)
+            )
             if settings.loggingchar:
                 self.bot.dispatch("character_created", settings, inter.author, char)
             await inter.send(f"Registered {name} with the Adventurers Coalition.")
@@ -151,8 +152,9 @@ class CharacterLog(
         else:
             char.name = new_name
             await char.commit(self.bot.dbcache)
-            if f"{inter.guild.id}{inter.author.id}" in self.bot.charcache:
-                self.bot.charcache.pop(f"{inter.guild.id}{inter.author.id}")
+            await self.bot.charcache.invalidate(
+                str(inter.guild.id), str(inter.author.id)
+            )
             uprefs = await self.bot.get_user_prefs(str(inter.author.id))
             if uprefs.activechar[str(inter.guild.id)].name == name:
                 uprefs.activechar[str(inter.guild.id)].name = new_name
@@ -210,11 +212,12 @@ class CharacterLog(
             dm=dm.id,
             timestamp=timestamp,
         )
-        result: "InsertOneResult" = await newlog.commit(self.bot.dbcache)
-        char.xp += xp
+        result: "InsertOneResult" = await newlog.commit(
+            self.bot.sdb, settings.xptemplate
+        )
         char.lastlog.id = result.inserted_id
         char.lastlog.time = timestamp
-        await char.commit(self.bot.dbcache)
+        await char.mutate(self.bot.dbcache, xp=xp)
         p = inflect.engine()
         outputstr = (
             f"{name} lost {p.plural(settings.xplabel)} {char.xp-xp}({xp}) <@{dm.id}>"
@@ -465,12 +468,12 @@ class CharacterLog(
         self, inter: disnake.ApplicationCommandInteraction, user_input: str
     ):
         name = inter.filled_options["name"]
-        char: "Character" = await self.bot.get_character(
-            str(inter.guild.id), str(inter.author.id), name, validate=False
+        char = await self.bot.get_character_fields(
+            str(inter.guild.id), str(inter.author.id), name, "multiclasses"
         )
         if char:
             classlist = await self._get_classlist(str(inter.guild.id))
-            classlist = [x for x in classlist if x not in char.multiclasses]
+            classlist = [x for x in classlist if x not in char["multiclasses"]]
             return [x[0] for x in rapidfuzz.process.extract(user_input, classlist)]
 
     @remove.autocomplete("multiclass_name")
@@ -479,14 +482,14 @@ class CharacterLog(
         self, inter: disnake.ApplicationCommandInteraction, user_input: str
     ):
         name = inter.filled_options["name"]
-        char: "Character" = await self.bot.get_character(
-            str(inter.guild.id), str(inter.author.id), name, validate=False
+        char = await self.bot.get_character_fields(
+            str(inter.guild.id), str(inter.author.id), name, "multiclasses"
         )
         if char:
             return [
                 x[0]
                 for x in rapidfuzz.process.extract(
-                    user_input, list(char.multiclasses.keys()), limit=8
+                    user_input, list(char["multiclasses"].keys()), limit=8
                 )
             ]
 
@@ -1,13 +1,11 @@
-import itertools
-import re
 from typing import TYPE_CHECKING, NewType, Tuple
 
 import disnake
 import inflect
-import rapidfuzz
 from bson import ObjectId
 from disnake.ext import commands
 
+from utils.models.coinparser import CoinParser
 from utils.models.coinpurse import CoinPurse
 from utils.ui.uiprompts import CharacterSelectPrompt
 
@@ -35,10 +33,9 @@ class CoinsCog(commands.Cog):
         amount, uprefs, char = await self.run_prechecks(inter, input)
         if not amount or not uprefs or not char:
             return
-        if amount.baseval < 0 and abs(amount.baseval) > char.coinpurse.baseval:
+        if not await char.mutate(self.bot.dbcache, coins=amount):
             await inter.send("You don't have enough money for that!", ephemeral=True)
             return
-        char.coinpurse.combine_batch(amount)
         p = inflect.engine()
         result = (
             disnake.Embed(
@@ -52,7 +49,6 @@ class CoinsCog(commands.Cog):
             )
         )
         await inter.send(embed=result)
-        await char.commit(self.bot.dbcache)
 
     @coins.sub_command(name="pay")
     async def slashpay(
@@ -155,7 +151,7 @@ class CoinsCog(commands.Cog):
         self, inter: disnake.ApplicationCommandInteraction, input
     ) -> Tuple["CoinPurse", "UserPreferences", "Character"]:
         amount = await self.process_to_coinpurse(str(inter.guild.id), input)
-        if len(amount) == 0:
+        if not any(amount.counts):
             await inter.send("No matching currency types found", ephemeral=True)
             return None, None, None
         uprefs = await self.bot.get_user_prefs(str(inter.author.id), validate=False)
@@ -178,40 +174,11 @@ class CoinsCog(commands.Cog):
         settings: "ServerSettings" = await self.bot.get_server_settings(
             guild_id, validate=False
         )
-        tables = []
-        result = {}
-        input = re.sub(r"((?<=-) +)|([ \.]+(?=[a-zA-Z\.]+))|((?<= ) +)", "", input)
-        items = re.split(r"[^a-zA-Z0-9'\-\.]", input)
-        for enum, item in enumerate(items):
-            if re.search(r"-$", item):
-                if enum < (len(items) - 1) and not re.match(r"[-]+", items[enum + 1]):
-                    items[enum + 1] = "-" + items[enum + 1]
-            count = re.sub(r"[^\-\d\.\s]|[^\d]*$", "", item)
-            if coerce_positive:
-                count = abs(float(count))
-            if force_int:
-                count = int(count)
-            prefix = re.sub(r"[0-9\-\.]", "", item)
-            cointypematch = rapidfuzz.process.extractOne(
-                settings.coinconf.base.prefix if prefix == "" else prefix,
-                itertools.chain.from_iterable(
-                    (x.name, x.prefix) for x in settings.coinconf
-                ),
-            )[0]
-            tables.append(
-                CoinPurse.valuedict_from_count(
-                    count,
-                    disnake.utils.find(
-                        lambda ctype: ctype.name == cointypematch
-                        or ctype.prefix == cointypematch,
-                        settings.coinconf,
-                    ),
-                    settings.coinconf,
-                )
-            )
-        for tab in next(iter(tables)):
-            result[tab] = sum(x[tab] for x in tables if x[tab] != 0)
-        return CoinPurse.from_simple_dict(result, settings.coinconf)
+        parser = CoinParser.for_config(settings.coinconf)
+        counts = parser.parse(
+            input, coerce_positive=coerce_positive, force_int=force_int
+        )
+        return CoinPurse.from_counts(counts, settings.coinconf)
 
     async def process_payment(
         self,
@@ -221,8 +188,9 @@ class CoinsCog(commands.Cog):
         recipient: "ObjectId",
     ):
         recipient: "Character" = await self.bot.get_char_by_oid(recipient)
-        payee.coinpurse.combine_batch(amount.negative())
-        recipient.coinpurse.combine_batch(amount.positive())
+        if not await payee.transfer(self.bot.dbcache, recipient, amount):
+            await inter.send("You don't have enough money for that!", ephemeral=True)
+            return
         result = (
             disnake.Embed(
                 title=f"{payee.name}'s Coinpurse",
@@ -248,8 +216,6 @@ class CoinsCog(commands.Cog):
             ),
         )
         await inter.send(f"<@{payee.user}> <@{recipient.user}>", embeds=result)
-        await payee.commit(self.bot.dbcache)
-        await recipient.commit(self.bot.dbcache)
 
 
 def setup(bot: "Labyrinthian"):
@@ -0,0 +1,158 @@
+"""MongoCache against mongomock, run from the repo root with:
+python -m pytest tests
+"""
+import asyncio
+
+import pytest
+from pymongo import UpdateOne
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+from utils.models.character import Character
+from utils.models.errors import VersionConflictError
+from utils.models.settings.guild import ServerSettings
+from utils.models.settings.user import UserPreferences
+from utils.MongoCache import MongoCache
+
+
+class FakeBot:
+    def __init__(self):
+        self.mclient = mongomock_motor.AsyncMongoMockClient()
+        self.sdb = self.mclient["test"]
+
+
+class BulkWriteResult:
+    def __init__(self, matched_count: int):
+        self.matched_count = matched_count
+
+
+@pytest.fixture(autouse=True)
+def bulk_write(monkeypatch):
+    """mongomock's bulk_write chokes on the operations current pymongo builds, the flush
+    only ever sends UpdateOnes so those get replayed one at a time."""
+    from mongomock.collection import Collection
+
+    def bulk_write(self, operations, ordered=True, **kwargs):
+        matched = 0
+        for operation in operations:
+            assert isinstance(operation, UpdateOne)
+            result = self.update_one(operation._filter, operation._doc)
+            matched += result.matched_count
+        return BulkWriteResult(matched)
+
+    monkeypatch.setattr(Collection, "bulk_write", bulk_write)
+
+
+def make_cache(tmp_path, **kwargs) -> MongoCache:
+    # one slot for everything, so every other document that gets cached evicts the last one
+    return MongoCache(
+        FakeBot(), str(tmp_path), maxsize=1, ttl=300, partitions={}, **kwargs
+    )
+
+
+async def load_character(cache: MongoCache, oid) -> Character:
+    document = await cache.find_one("charactercollection", {"_id": oid})
+    data = Character.hydrate(
+        document, ServerSettings(guild="g"), UserPreferences(user="u")
+    )
+    return Character.no_validate(data)
+
+
+@pytest.mark.parametrize("write_behind", [False, True])
+def test_mutate_during_eviction(tmp_path, write_behind):
+    """Writes racing the character's eviction all land, whichever order they go in."""
+
+    async def main():
+        cache = make_cache(tmp_path, write_behind=write_behind, flush_interval=0.01)
+        cache.evictions.start()
+        sdb = cache.bot.sdb
+        inserted = await cache.insert_one(
+            "charactercollection",
+            {"guild": "g", "user": "u", "name": "Bob", "sheet": "", "xp": 10.0},
+        )
+        oid = inserted.inserted_id
+        first, second = [await load_character(cache, oid) for _ in range(2)]
+
+        async def evict():
+            await cache.insert_one("srvconf", {"guild": "g"})
+
+        await asyncio.gather(
+            first.mutate(cache, xp=5),
+            evict(),
+            sdb["charactercollection"].update_one(
+                {"_id": oid}, {"$inc": {"xp": 100, "version": 1}}
+            ),
+            second.mutate(cache, xp=3),
+        )
+        # cached again, then evicted again with the write possibly still queued
+        third = await load_character(cache, oid)
+        await asyncio.gather(third.mutate(cache, xp=1), evict())
+
+        await cache.flush()
+        await cache.evictions.close()
+        document = await sdb["charactercollection"].find_one({"_id": oid})
+        assert document["xp"] == 119
+        assert document["version"] == 4
+        assert not cache.journal.pending
+
+    asyncio.run(main())
+
+
+def test_eviction_keeps_outside_increments(tmp_path):
+    async def main():
+        cache = make_cache(tmp_path)
+        cache.evictions.start()
+        first = await cache.insert_one("xpstats", {"gained": 0})
+        await cache.insert_one("xpstats", {"gained": 0})
+        await cache.update_one(
+            "xpstats", {"_id": first.inserted_id}, {"$inc": {"gained": 10}}
+        )
+        await cache.evictions.close()
+        document = await cache.bot.sdb["xpstats"].find_one({"_id": first.inserted_id})
+        assert (document["gained"], document["version"]) == (10, 1)
+
+    asyncio.run(main())
+
+
+def test_replay_skips_newer_documents(tmp_path):
+    async def main():
+        cache = make_cache(tmp_path)
+        sdb = cache.bot.sdb
+        current = await sdb["things"].insert_one({"n": 0, "version": 2})
+        moved_on = await sdb["things"].insert_one({"n": 0, "version": 5})
+        for oid, version in ((current.inserted_id, 2), (moved_on.inserted_id, 4)):
+            cache.journal.append(
+                str(oid),
+                {
+                    "collectionkey": "things",
+                    "_id": oid,
+                    "version": version,
+                    "update": {"$inc": {"n": 1, "version": 1}},
+                },
+            )
+        await cache.replay_journal()
+        counts = {x["_id"]: (x["n"], x["version"]) async for x in sdb["things"].find()}
+        assert counts[current.inserted_id] == (1, 3)
+        assert counts[moved_on.inserted_id] == (0, 5)
+        assert not cache.journal.pending
+        cache.journal.close()
+
+    asyncio.run(main())
+
+
+def test_replace_one_checks_the_version(tmp_path):
+    async def main():
+        cache = make_cache(tmp_path)
+        inserted = await cache.insert_one("things", {"n": 0})
+        stale = dict(await cache.find_one("things", {"_id": inserted.inserted_id}))
+        await cache.update_one(
+            "things", {"_id": inserted.inserted_id}, {"$inc": {"n": 1}}
+        )
+        with pytest.raises(VersionConflictError):
+            await cache.replace_one("things", {"_id": stale["_id"]}, {**stale, "n": 5})
+        current = dict(await cache.find_one("things", {"_id": inserted.inserted_id}))
+        await cache.replace_one("things", {"_id": current["_id"]}, {**current, "n": 5})
+        document = await cache.bot.sdb["things"].find_one({"_id": current["_id"]})
+        assert (document["n"], document["version"]) == (5, 2)
+
+    asyncio.run(main())
@@ -1,181 +1,628 @@
-import ast
 import asyncio
-import os
+import logging
+import uuid
+from collections import OrderedDict
+from collections.abc import MutableMapping as MutableMappingABC
 from copy import deepcopy
-from dataclasses import dataclass
-from datetime import datetime
+from dataclasses import dataclass, field, replace
 from pathlib import Path
 from typing import (
     TYPE_CHECKING,
     Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
     Dict,
+    Iterable,
     List,
     Mapping,
     MutableMapping,
+    Optional,
     Sequence,
+    Set,
+    Tuple,
     Union,
 )
 
+import bson
 import cachetools
 from bson.objectid import ObjectId
 from bson.raw_bson import RawBSONDocument
+from pymongo import ReadPreference, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 from pymongo.results import InsertOneResult, UpdateResult
 
+from utils.changestreams import CacheWatcher, utcnow_ms
+from utils.docview import FrozenDocument
+from utils.evictions import EvictionPipeline
+from utils.journal import LITJournal
+from utils.models.errors import VersionConflictError
+from utils.partitions import DEFAULT_PARTITIONS, PartitionSpec, make_partition
+from utils.sharedcache import (
+    CHARLIST_CHANNEL,
+    DBCACHE_CHANNEL,
+    SharedCacheBackend,
+    listen_for_invalidations,
+)
+from utils.snapshot import CacheSnapshot
+
 if TYPE_CHECKING:
+    from motor.motor_asyncio import AsyncIOMotorClientSession
+
     from bot import Labyrinthian
 
+logger = logging.getLogger("MongoCache")
+
+# filter shapes (sorted field names) that get resolved with a hash lookup
+# instead of a scan over the whole cache, every collection is also indexed by _id
+CACHE_INDEXES: Dict[str, Tuple[Tuple[str, ...], ...]] = {
+    "srvconf": (("guild",),),
+    "userprefs": (("user",),),
+    "charactercollection": (("guild", "name", "user"),),
+}
+
 
 @dataclass
 class UpdateResultFacade:
     inserted_id: ObjectId
+    # only set for writes deferred by write-behind, resolves once the write is in the database
+    flushed: Optional["asyncio.Future[None]"] = None
+    # the document as written (read only)
+    document: Optional[Mapping[str, Any]] = None
+
+    async def wait_flushed(self):
+        if self.flushed is not None:
+            await self.flushed
+
+
+def _stamp_update(
+    update: Union[Mapping[str, Any], Sequence[Mapping[str, Any]]]
+) -> Union[Dict[str, Any], List[Mapping[str, Any]]]:
+    """Adds the updatedAt stamp CacheWatcher polls on to an update document or pipeline,
+    and bumps the version compare-and-swap updates check against."""
+    if isinstance(update, Mapping):
+        return {
+            **update,
+            "$set": {
+                **{x: y for x, y in update.get("$set", {}).items() if x != "version"},
+                "updatedAt": utcnow_ms(),
+            },
+            "$inc": {**update.get("$inc", {}), "version": 1},
+        }
+    return [
+        *update,
+        {
+            "$set": {
+                "updatedAt": "$$NOW",
+                "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+            }
+        },
+    ]
+
+
+@dataclass
+class PendingWrite:
+    """A cached document's write-behind changes that aren't in the database yet."""
+
+    collectionkey: str
+    # the cached copy with the changes applied
+    document: MutableMapping[str, Any]
+    # the changes folded into one update, see _compose_update
+    update: Dict[str, Dict[str, Any]]
+    # the version the changes were made on top of, what replaying them from the journal checks
+    base: int
+    futures: List["asyncio.Future[None]"] = field(default_factory=list)
+    # journal seq, once the document got evicted before its flush
+    seq: Optional[int] = None
+
+
+def _settle(
+    futures: Iterable["asyncio.Future[None]"], error: Optional[Exception] = None
+):
+    for future in futures:
+        if future.done():
+            continue
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
 
 
-class MongoCache(cachetools.TTLCache):
+def _stamp(document: Mapping[str, Any]) -> Tuple[Any, Any]:
+    return document.get("updatedAt"), document.get("version")
+
+
+# update operators write-behind can apply to a cached document by itself
+LOCAL_OPERATORS = {"$set", "$unset", "$inc", "$setOnInsert"}
+
+
+def _apply_update(document: Mapping[str, Any], update: Any) -> Optional[Dict[str, Any]]:
+    """Applies a $set/$unset/$inc update to a copy of document, only copying the subdocuments on
+    the updated paths. $setOnInsert does nothing, the document already exists. Returns None for
+    anything else (pipelines, array operators, etc) since those can only be resolved by the database."""
+    if not isinstance(update, Mapping) or not set(update) <= LOCAL_OPERATORS:
+        return None
+    result = dict(document)
+    for operator, fields in update.items():
+        if operator == "$setOnInsert":
+            continue
+        for path, value in fields.items():
+            *parents, leaf = path.split(".")
+            target = result
+            for part in parents:
+                child = target.get(part, {})
+                if not isinstance(child, Mapping):
+                    return None
+                target[part] = child = dict(child)
+                target = child
+            if operator == "$set":
+                target[leaf] = value
+            elif operator == "$unset":
+                target.pop(leaf, None)
+            elif operator == "$inc":
+                target[leaf] = target.get(leaf, 0) + value
+    return result
+
+
+_MISSING = object()
+
+
+def _get_path(document: Any, path: str) -> Any:
+    for part in path.split("."):
+        if not isinstance(document, Mapping) or part not in document:
+            return _MISSING
+        document = document[part]
+    return document
+
+
+def _compose_update(
+    first: Mapping[str, Mapping[str, Any]],
+    then: Mapping[str, Mapping[str, Any]],
+    document: Mapping[str, Any],
+) -> Dict[str, Dict[str, Any]]:
+    """Folds two $set/$unset/$inc updates into one that does the same to any document, so a
+    document's queued write-behind changes flush as one update that keeps other writers' changes.
+    document is the cached copy with both applied, paths touched at two different depths
+    (i.e. $set on coinpurse then $inc on coinpurse.count) get $set to what it holds."""
+
+    def resolved(path: str) -> Tuple[str, Any]:
+        value = _get_path(document, path)
+        return ("$unset", "") if value is _MISSING else ("$set", value)
+
+    # path -> (operator, value)
+    ops: Dict[str, Tuple[str, Any]] = {
+        path: (operator, value)
+        for operator, fields in first.items()
+        if operator != "$setOnInsert"
+        for path, value in fields.items()
+    }
+    for operator, fields in then.items():
+        if operator == "$setOnInsert":
+            continue
+        for path, value in fields.items():
+            previous = ops.get(path)
+            if operator == "$inc" and previous is not None:
+                ops[path] = (
+                    ("$inc", previous[1] + value)
+                    if previous[0] == "$inc"
+                    else resolved(path)
+                )
+                continue
+            # this overwrites whatever the first one did under path
+            for other in [x for x in ops if x.startswith(f"{path}.")]:
+                del ops[other]
+            ancestor = next((x for x in ops if path.startswith(f"{x}.")), None)
+            if ancestor is not None:
+                ops[ancestor] = resolved(ancestor)
+            else:
+                ops[path] = (operator, value)
+    composed: Dict[str, Dict[str, Any]] = {}
+    for path, (operator, value) in ops.items():
+        composed.setdefault(operator, {})[path] = value
+    return composed
+
+
+class MongoCache(MutableMappingABC):
     def __init__(
         self,
         bot: "Labyrinthian",
         workdir: str,
-        maxsize: float,
+        maxsize: int,
         ttl: float,
-        *args,
-        **kwargs,
+        *,
+        partitions: Optional[Mapping[str, PartitionSpec]] = None,
+        autotune_interval: float = 60.0,
+        write_behind: bool = False,
+        flush_interval: float = 1.0,
+        flush_threshold: int = 50,
+        backend: Optional[SharedCacheBackend] = None,
+        shared_ttl: float = 300,
+        watch: bool = False,
+        serve_stale: bool = False,
+        stale_maxsize: int = 100,
+        partial_maxsize: int = 500,
+        partial_ttl: float = 60,
+        snapshot_size: int = 500,
+        read_max_time_ms: Optional[int] = None,
     ) -> None:
-        super().__init__(maxsize, ttl, *args, **kwargs)
         self.bot = bot
+        # server side limit for the reads behind cache misses, somebody is waiting on those
+        self._readopts = (
+            {} if read_max_time_ms is None else {"max_time_ms": read_max_time_ms}
+        )
+        # every collection gets its own slice of the cache with its own size and eviction policy,
+        # maxsize/ttl size the partition shared by collections without a spec of their own
+        specs = {
+            "default": PartitionSpec(policy="ttl", maxsize=maxsize, ttl=ttl),
+            **(DEFAULT_PARTITIONS if partitions is None else partitions),
+        }
+        self.partitions = {x: make_partition(self, x, y) for x, y in specs.items()}
+        # cache key -> the partition holding it
+        self._where: Dict[str, Any] = {}
+        self.autotune_interval = autotune_interval
+        self._autotuner: Optional["asyncio.Task[None]"] = None
+        # concurrent misses on the same filter share one load, (collection, filter) -> load
+        self._inflight: Dict[
+            Tuple, "asyncio.Task[Optional[MutableMapping[str, Any]]]"
+        ] = {}
+        # stale-while-revalidate: recently expired documents get served while a load refreshes them
+        self.serve_stale = serve_stale
+        self.stale_maxsize = stale_maxsize
+        self._stale: "OrderedDict[str, MutableMapping[str, Any]]" = OrderedDict()
+        # partial documents from projected lookups, cache key -> {projection: partial}
+        # and (collection, filter) -> cache key. Any write to a document drops its partials
+        self._partials: cachetools.TTLCache = cachetools.TTLCache(
+            partial_maxsize, partial_ttl
+        )
+        self._partial_keys: cachetools.TTLCache = cachetools.TTLCache(
+            partial_maxsize, partial_ttl
+        )
+        # cache key -> _writeseq when it was last written or dropped, loads that started before
+        # that may have read something out of date and don't cache it. Only kept while loads run
+        self._writeseq = 0
+        self._written: Dict[str, int] = {}
+        self._loading = 0
+        # optional second tier shared with every other process running the bot
+        # writes from any process broadcast invalidations so the rest drop their copies
+        self.backend = backend
+        self.shared_ttl = shared_ttl
+        self.origin = uuid.uuid4().hex
+        self._listener: Optional["asyncio.Task[None]"] = None
+        # write-behind: updates to cached documents are applied locally and folded into one
+        # update per document, then flushed with one bulk_write per collection on a timer or once
+        # flush_threshold documents are dirty
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        # cache key -> its changes that haven't been flushed
+        self._dirty: Dict[str, PendingWrite] = {}
+        # the batch a flush is writing right now. Flushes take turns on the lock,
+        # so writes to one document always land in order
+        self._flushing: Dict[str, PendingWrite] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_tasks: Set["asyncio.Task[None]"] = set()
+        # (collectionkey, shape) -> {field values: cache key}
+        self._indexes: Dict[Tuple[str, Tuple[str, ...]], Dict[Tuple, str]] = {}
+        # cache key -> the index entries pointing at it, so removal never has to scan
+        self._indexed: Dict[str, List[Tuple[Tuple[str, Tuple[str, ...]], Tuple]]] = {}
+        # id(session) -> (collectionkey, cache key) of everything written in that transaction so far
+        self._txwrites: Dict[int, List[Tuple[str, str]]] = {}
+        # whether the server does transactions at all, found out on first use
+        self._txsupport: Optional[bool] = None
 
-        LITdatDONE = False
-        index = 0
-        path = os.path.join(workdir, "logs", "LITdat")
-        p = Path(path)
-        if not p.exists():
-            p.mkdir(parents=True, exist_ok=True)
-        while not LITdatDONE:
-            try:
-                path = os.path.join(
-                    workdir,
-                    "logs",
-                    "LITdat",
-                    f"LITlog{'' if index == 0 else str(index)}.txt",
-                )
-                with open(path, "x"):
-                    pass
-                self.path = path
-                LITdatDONE = True
-            except FileExistsError as e:
-                with open(path, "r") as LITdat:
-                    if len(LITdat.read(-1)) < 1:
-                        self.path = path
-                        LITdatDONE = True
-                index += 1
-
-    def popitem(self):
-        key, value = super().popitem()
-        self.updateLITdat(key, value)
-        asyncio.create_task(self.updatedb(key, value))
-        # print('Key "%s" evicted with value "%s"' % (key, value))
-        return key, value
+        path = Path(workdir, "logs", "LITdat")
+        path.mkdir(parents=True, exist_ok=True)
+        self.journal = LITJournal(str(path / "LITjournal.bson"))
+        self.evictions = EvictionPipeline(self.updatedb)
+        # evicts documents changed in the database by anyone else, see CacheWatcher
+        self.watcher = CacheWatcher(self) if watch else None
 
-    async def updatedb(
-        self, key: str, value: Union[MutableMapping[str, Any], RawBSONDocument]
-    ):
-        collectionkey = deepcopy(value["collectionkey"])
-        value.pop("collectionkey")  # type: ignore
-        result: UpdateResult = await self.bot.sdb[collectionkey].replace_one(
-            {"_id": value["_id"]}, value, True
+        # warm start, the snapshot_size most hit documents get written out on shutdown
+        # and loaded back in the background on startup
+        path = Path(workdir, "logs", "snapshots")
+        path.mkdir(parents=True, exist_ok=True)
+        self.snapshot = CacheSnapshot(str(path / "dbcache.bson"))
+        self.snapshot_size = snapshot_size
+        self._warmer: Optional["asyncio.Task[None]"] = None
+        # cache key -> cache hits while cached, what decides the hot set
+        self._hits: Dict[str, int] = {}
+
+    # ==== partitions ====
+    def partition(self, collectionkey: Optional[str]):
+        partition = self.partitions.get(collectionkey)
+        # not `or`, an empty partition is falsy
+        return partition if partition is not None else self.partitions["default"]
+
+    def __getitem__(self, key: str) -> MutableMapping[str, Any]:
+        partition = self._where.get(key)
+        if partition is None:
+            raise KeyError(key)
+        return partition[key]
+
+    def __setitem__(self, key: str, value: MutableMapping[str, Any]):
+        self._stale.pop(key, None)
+        partition = self.partition(value.get("collectionkey"))
+        current = self._where.get(key)
+        if current is not None and current is not partition:
+            del current[key]
+        self._unindex(key)
+        partition[key] = value
+        self._where[key] = partition
+        self._index(key, value)
+
+    def __delitem__(self, key: str):
+        partition = self._where.get(key)
+        if partition is None:
+            raise KeyError(key)
+        # the partition calls back into _forget
+        del partition[key]
+
+    def __contains__(self, key: object) -> bool:
+        partition = self._where.get(key)
+        return partition is not None and key in partition
+
+    def __iter__(self):
+        for partition in self.partitions.values():
+            yield from partition
+
+    def __len__(self) -> int:
+        return sum(len(x) for x in self.partitions.values())
+
+    def _forget(self, key: str):
+        """Called by the partitions whenever a key leaves them."""
+        self._where.pop(key, None)
+        self._unindex(key)
+        self._hits.pop(key, None)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {x: y.stats() for x, y in self.partitions.items()}
+
+    async def _autotune(self):
+        while True:
+            await asyncio.sleep(self.autotune_interval)
+            for partition in self.partitions.values():
+                try:
+                    partition.tune()
+                except Exception:
+                    logger.exception(
+                        f"Failed to tune the {partition.name} cache partition"
+                    )
+
+    # ==== warm start ====
+    def save_snapshot(self):
+        entries = []
+        for key in list(self):
+            document = self.get(key)
+            if document is not None:
+                entries.append((self._hits.get(key, 0), key, document))
+        entries.sort(key=lambda x: x[0], reverse=True)
+        self.snapshot.save(
+            {"key": key, "hits": hits, "doc": document}
+            for hits, key, document in entries[: self.snapshot_size]
         )
 
-        # this is to check if our write operation to the database succeeded
-        # if matched_count is less than 1 or it throws an error, the operation failed
-        # if it succeeded, we want to remove the entry from our Lost In Transit log
+    async def warm(self):
+        """Loads the snapshot back into the cache. Only documents whose updatedAt and version still
+        match the database are kept, anything changed while we were down gets loaded on demand."""
+        entries = self.snapshot.load()
+        batches: Dict[str, List[Dict[str, Any]]] = {}
+        for entry in entries:
+            batches.setdefault(entry["doc"]["collectionkey"], []).append(entry)
+        warmed = 0
+        # so writes racing the validation below keep their documents out
+        self._loading += 1
         try:
-            if result.matched_count > 0:
-                self.removefromLITdat(key)
-        except:
-            pass
-        # print(yaml.dump(self._Cache__data, sort_keys=False, default_flow_style=False))
+            for collectionkey, batch in batches.items():
+                started = self._writeseq
+                try:
+                    current = {
+                        str(x["_id"]): _stamp(x)
+                        async for x in self.bot.sdb[collectionkey].find(
+                            {"_id": {"$in": [x["doc"]["_id"] for x in batch]}},
+                            {"updatedAt": 1, "version": 1},
+                        )
+                    }
+                except PyMongoError:
+                    logger.exception(f"Failed to validate the {collectionkey} snapshot")
+                    continue
+                # coldest first, so the hottest documents end up most recently used
+                for entry in sorted(batch, key=lambda x: x["hits"]):
+                    key = entry["key"]
+                    stamp = _stamp(entry["doc"])
+                    # without a stamp there's no telling whether the snapshot is out of date
+                    if stamp == (None, None) or current.get(key) != stamp:
+                        continue
+                    await self.evictions.wait_for_capacity()
+                    if (
+                        key in self
+                        or key in self._dirty
+                        or key in self._flushing
+                        or self._written_since(key, started)
+                    ):
+                        continue
+                    self[key] = entry["doc"]
+                    self._hits[key] = entry["hits"]
+                    warmed += 1
+        finally:
+            self._loaded()
+        if entries:
+            logger.info(
+                f"Warmed the cache with {warmed}/{len(entries)} snapshot entries"
+            )
+
+    # ==== index upkeep ====
+
+    @staticmethod
+    def _index_shapes(collectionkey: str) -> Tuple[Tuple[str, ...], ...]:
+        return (("_id",), *CACHE_INDEXES.get(collectionkey, ()))
 
-    def updateLITdat(
+    def _index_entries(self, value: Mapping[str, Any]):
+        collectionkey = value.get("collectionkey")
+        for shape in self._index_shapes(collectionkey):
+            try:
+                fieldvals = tuple(value[x] for x in shape)
+                hash(fieldvals)
+            except (KeyError, TypeError):
+                # documents missing an indexed field (or holding an unhashable value)
+                # are still reachable through the fallback scan
+                continue
+            yield (collectionkey, shape), fieldvals
+
+    def _index(self, key: str, value: Mapping[str, Any]):
+        entries = list(self._index_entries(value))
+        for indexkey, fieldvals in entries:
+            self._indexes.setdefault(indexkey, {})[fieldvals] = key
+        self._indexed[key] = entries
+
+    def _unindex(self, key: str):
+        for indexkey, fieldvals in self._indexed.pop(key, ()):
+            index = self._indexes.get(indexkey)
+            if index is not None and index.get(fieldvals) == key:
+                del index[fieldvals]
+
+    def _find_indexed(
+        self, collectionkey: str, searchfilter: Mapping[str, Any]
+    ) -> Optional[List[MutableMapping[str, Any]]]:
+        """Resolves a filter through the cache indexes.
+        Returns None when the filter shape isn't indexed and has to be scanned for instead."""
+        shape = tuple(sorted(searchfilter))
+        if shape not in self._index_shapes(collectionkey):
+            return None
+        try:
+            key = self._indexes.get((collectionkey, shape), {}).get(
+                tuple(searchfilter[x] for x in shape)
+            )
+        except TypeError:
+            return None
+        if key is None:
+            return []
+        try:
+            return [self[key]]
+        except KeyError:
+            # expired but not purged yet
+            return []
+
+    # ==== eviction ====
+    def _evict(self, key: str, value: MutableMapping[str, Any]):
+        """Called by a partition that's out of room, after it dropped key.
+        Clean documents are in the database already. Dirty ones stay queued (and readable through
+        find_one) until their flush, which the eviction writers get going right away. Their changes
+        are journaled in the meantime, in case we go down first."""
+        pending = self._dirty.get(key)
+        if pending is None:
+            return
+        pending.seq = self.journal.append(
+            key,
+            {
+                "collectionkey": pending.collectionkey,
+                "_id": pending.document["_id"],
+                "version": pending.base,
+                "update": pending.update,
+            },
+        )
+        self.evictions.submit(key, value, pending.seq)
+        # print('Key "%s" evicted with value "%s"' % (key, value))
+
+    async def updatedb(
         self,
         key: str,
-        value: Dict[str, Union[str, int, List, Dict, ObjectId, datetime, float]],
+        value: Union[MutableMapping[str, Any], RawBSONDocument],
+        seq: int,
     ):
-        # open our sessions lost in transit data file in read only mode
-        # and store the contents in a variable
-        # we then close the file
-        with open(self.path, "r") as LITdat:
-            data = LITdat.read(-1)
-
-        # next we run split on the file contents to create a list separated by newlines
-        # we then convert this back into a string to then strip the list "brackets" off
-        data = data.splitlines()
-        data = str(data)
-        data.strip("[]")
-
-        # now we encase the string in braces, then evaluate the string as code with literal_eval
-        data = f"{{{data}}}"
-        data = ast.literal_eval(data)
-
-        # make our changes to the data...
-        # by processing the data into a dict, we can overwrite data with matching keys
-        # this allows us to "remember" if the same item has previously failed to
-        # send to the database, so we only ever store the "newest" version of the item
-        # (this doesnt account for if an even newer iteration of the item successfully wrote to database)
-        data[key] = value
-
-        # time to join the data back together with newlines for text editor readability
-        # data is stored as "key: value" per line
-        data = "\n".join(
-            [f"{datakey}: {datavalue}" for datakey, datavalue in data.items()]
-        )
+        """Eviction writer, flushes an evicted document's changes. The flush acks the journal
+        once they're written (or the document turned out to be deleted)."""
+        await self._flush_key(key)
+        pending = self._dirty.get(key)
+        if pending is not None and pending.seq == seq:
+            # the flush failed and requeued them, the pipeline retries with backoff
+            raise PyMongoError(f"Failed to flush evicted document {key}")
 
-        # overwrite the contents of the original file, then close it.
-        with open(self.path, "w") as LITdat:
-            LITdat.write(data)
-
-    def removefromLITdat(self, key: str):
-        # open our sessions lost in transit data file in read only mode
-        # and store the contents in a variable
-        # we then close the file
-        with open(self.path, "r") as LITdat:
-            data = LITdat.read(-1)
-
-        # next we run split on the file contents to create a list separated by newlines
-        # we then convert this back into a string to then strip the list "brackets" off
-        data = data.splitlines()
-        data = str(data)
-        data.strip("[]")
-
-        # now we encase the string in braces, then evaluate the string as code with literal_eval
-        data = f"{{{data}}}"
-        data = ast.literal_eval(data)
-
-        # make our changes to the data...
-        # by processing the data into a dict, we can overwrite data with matching keys
-        # this allows us to "remember" if the same item has previously failed to
-        # send to the database, so we only ever store the "newest" version of the item
-        # (this doesnt account for if an even newer iteration of the item successfully wrote to database)
-        data.pop(key)
-
-        # time to join the data back together with newlines for text editor readability
-        # data is stored as "key: value" per line
-        data = "\n".join(
-            [f"{datakey}: {datavalue}" for datakey, datavalue in data.items()]
-        )
+    async def start(self):
+        """Startup hook, replays the journal and spins up the eviction writers
+        (and the invalidation listener when there's a shared tier)."""
+        await self.replay_journal()
+        self.evictions.start()
+        if self._warmer is None:
+            self._warmer = asyncio.create_task(self.warm())
+        if self._autotuner is None:
+            self._autotuner = asyncio.create_task(self._autotune())
+        if self.watcher is not None:
+            self.watcher.start()
+        if self.backend is not None and self._listener is None:
+            self._listener = asyncio.create_task(
+                listen_for_invalidations(
+                    self.backend, DBCACHE_CHANNEL, self._on_invalidation
+                )
+            )
+
+    async def close(self):
+        """Shutdown hook, nothing queued for the database should be left behind in memory."""
+        await self.flush()
+        await self.evictions.close()
+        self.journal.close()
+        if self.watcher is not None:
+            await self.watcher.close()
+        try:
+            self.save_snapshot()
+        except OSError:
+            logger.exception("Failed to snapshot the cache")
+        for task in (self._listener, self._autotuner, self._warmer):
+            if task is not None:
+                task.cancel()
+        self._listener = self._autotuner = self._warmer = None
 
-        # overwrite the contents of the original file, then close it.
-        with open(self.path, "w") as LITdat:
-            LITdat.write(data)
+    async def replay_journal(self):
+        """Replays evicted changes that never made it to the database (i.e. the bot crashed or
+        lost its connection before their flush) back into Mongo, called once on startup.
+        They only land on the version they were made on top of, if the database has a newer
+        copy (or none at all) they're dropped."""
+        replayed = 0
+        for key, (seq, record) in list(self.journal.pending.items()):
+            try:
+                replayed += await self._replay(record)
+            except PyMongoError:
+                logger.exception(f"Failed to replay journaled document {key}")
+                continue
+            self.journal.ack(key, seq)
+        if replayed:
+            logger.info(f"Replayed {replayed} journaled document(s)")
+        self.journal.compact()
+
+    async def _replay(self, record: Mapping[str, Any]) -> bool:
+        collection = self.bot.sdb[record["collectionkey"]]
+        if "update" in record:
+            version = record["version"]
+            result: UpdateResult = await collection.update_one(
+                {"_id": record["_id"], "version": version or {"$in": [0, None]}},
+                record["update"],
+            )
+            return result.matched_count > 0
+        # a whole document, from before evictions only journaled changes
+        if record.get("version") is not None:
+            older = {"version": {"$lt": record["version"]}}
+        elif record.get("updatedAt") is not None:
+            older = {"updatedAt": {"$lt": record["updatedAt"]}}
+        else:
+            # no telling which copy is newer
+            return False
+        document = {x: y for x, y in record.items() if x != "collectionkey"}
+        result = await collection.replace_one({"_id": record["_id"], **older}, document)
+        return result.matched_count > 0
 
     def _find_matches_in_self(
         self, collectionkey: str, searchfilter: Mapping[str, Any]
     ):
         """Searches through the cache and returns a list of cache values that match the provided filter
         filter is expected to be a dict where every key value pair must match a key value pair in a cache document"""
+        indexed = self._find_indexed(collectionkey, searchfilter)
+        if indexed is not None:
+            return indexed
         filt = {"collectionkey": collectionkey, **searchfilter}
         return list(
             filter(
                 lambda item: all(x in item and item[x] == y for x, y in filt.items()),
-                self.values(),
+                self.partition(collectionkey).values(),
             )
         )
 
@@ -186,37 +633,294 @@ class MongoCache(cachetools.TTLCache):
         *args,
         **kwargs,
     ) -> InsertOneResult:
+        if isinstance(document, MutableMapping):
+            document["updatedAt"] = utcnow_ms()
+            document.setdefault("version", 0)
         result: InsertOneResult = await self.bot.sdb[collectionkey].insert_one(
             document, *args, **kwargs
         )
-        data = document
-        if "_id" not in data:
-            data["_id"] = result.inserted_id  # type: ignore
-        if "collectionkey" not in data:
-            data["collectionkey"] = collectionkey  # type: ignore
+        await self.evictions.wait_for_capacity()
+        # cached documents are shared by every reader, so they get their own copy
+        data = deepcopy(document)
+        data["_id"] = result.inserted_id
+        data["collectionkey"] = collectionkey
         self[str(result.inserted_id)] = data
+        await self._share(str(result.inserted_id), data)
         # print(yaml.dump(self._Cache__data, sort_keys=False, default_flow_style=False))
         return result
 
     async def find_one(
-        self, collectionkey: str, filter: Mapping[str, Any], *args: Any, **kwargs: Any
-    ):
-        data = None  # type: ignore
-        cachematches = deepcopy(self._find_matches_in_self(collectionkey, filter))
+        self,
+        collectionkey: str,
+        filter: Mapping[str, Any],
+        *args: Any,
+        projection: Optional[Iterable[str]] = None,
+        **kwargs: Any,
+    ) -> Optional[FrozenDocument]:
+        """Returns a read only view of the matching document, cache hits copy nothing.
+        Callers copy whatever part of the document they intend to change.
+
+        With a projection (field names to include) only those fields and _id are returned,
+        and a miss only fetches and caches those fields, see _find_partial."""
+        if projection is not None:
+            projection = tuple(sorted(set(projection)))
+        cachematches = self._find_matches_in_self(collectionkey, filter)
+        partition = self.partition(collectionkey)
         if cachematches:
-            cachematches[0].pop("collectionkey")
+            partition.hits += 1
+            key = str(cachematches[0]["_id"])
+            self._hits[key] = self._hits.get(key, 0) + 1
             # print(yaml.dump(self._Cache__data, sort_keys=False, default_flow_style=False))
-            return cachematches[0]
+            return self._view(cachematches[0], projection)
+        if dirtymatch := self._find_matches_in_dirty(collectionkey, filter):
+            partition.misses += 1
+            # evicted before its flush, the database copy is older than this one
+            await self.evictions.wait_for_capacity()
+            self[str(dirtymatch["_id"])] = dirtymatch
+            return self._view(dirtymatch, projection)
+        if projection is not None:
+            return await self._find_partial(collectionkey, filter, projection)
+        partition.misses += 1
+
+        flightkey = (
+            self._flight_key(collectionkey, filter) if not args and not kwargs else None
+        )
+        if flightkey is None:
+            data = await self._load(collectionkey, filter, *args, **kwargs)
         else:
-            data: MutableMapping[str, Any] = await self.bot.sdb[collectionkey].find_one(
-                filter, *args, **kwargs
+            inflight = self._inflight.get(flightkey)
+            if inflight is None:
+                inflight = self._inflight[flightkey] = asyncio.create_task(
+                    self._load(collectionkey, filter)
+                )
+                inflight.add_done_callback(self._landed(flightkey))
+            if self.serve_stale:
+                # expired entries only move to the stale store once the partition purges them
+                getattr(partition, "expire", lambda: None)()
+            if self.serve_stale and (
+                stalematch := self._find_stale(collectionkey, filter)
+            ):
+                # the load above carries on by itself and puts the fresh copy in the cache
+                return FrozenDocument(stalematch, hidden=("collectionkey",))
+            # shielded so one caller giving up doesn't cancel the load for everybody else
+            data = await asyncio.shield(inflight)
+        if data is None:
+            return None
+        return FrozenDocument(data, hidden=("collectionkey",))
+
+    @staticmethod
+    def _view(
+        document: Mapping[str, Any], projection: Optional[Tuple[str, ...]] = None
+    ) -> FrozenDocument:
+        if projection is None:
+            return FrozenDocument(document, hidden=("collectionkey",))
+        return FrozenDocument(
+            {x: document[x] for x in ("_id", *projection) if x in document}
+        )
+
+    async def find_many(
+        self,
+        collectionkey: str,
+        filter: Mapping[str, Any],
+        *,
+        projection: Optional[Iterable[str]] = None,
+        batch_size: int = 200,
+    ) -> AsyncIterator[FrozenDocument]:
+        """Streams every matching document from the database (read only), batch_size per round trip.
+        For scans too big to be worth caching, i.e. guild wide reports, nothing read here gets cached."""
+        # so the database has our newest copies
+        await self._flush_pending()
+        async for document in self.bot.sdb[collectionkey].find(
+            filter,
+            None if projection is None else list(projection),
+            batch_size=batch_size,
+        ):
+            yield FrozenDocument(document)
+
+    # ==== misses ====
+    @staticmethod
+    def _flight_key(
+        collectionkey: str, searchfilter: Mapping[str, Any]
+    ) -> Optional[Tuple]:
+        flightkey = (collectionkey, tuple(sorted(searchfilter.items())))
+        try:
+            hash(flightkey)
+        except TypeError:
+            # filters on subdocuments just don't get coalesced
+            return None
+        return flightkey
+
+    def _landed(self, flightkey: Tuple) -> Callable[["asyncio.Task[Any]"], None]:
+        def landed(task: "asyncio.Task[Any]"):
+            self._inflight.pop(flightkey, None)
+            # loads started for a stale hit finish with nobody awaiting them
+            if not task.cancelled() and (error := task.exception()) is not None:
+                logger.debug(f"Load for {flightkey} failed", exc_info=error)
+
+        return landed
+
+    async def _load(
+        self, collectionkey: str, filter: Mapping[str, Any], *args: Any, **kwargs: Any
+    ) -> Optional[MutableMapping[str, Any]]:
+        """Fetches a document that missed the cache from the shared tier or the database and caches it.
+        find_one runs a single one of these per filter no matter how many callers missed at once."""
+        self._loading += 1
+        try:
+            return await self._fetch(
+                self._writeseq, collectionkey, filter, *args, **kwargs
             )
-            if data is not None:
-                datacopy = deepcopy(data)
-                datacopy["collectionkey"] = collectionkey
-                self[str(datacopy["_id"])] = datacopy
-            # print(yaml.dump(self._Cache__data, sort_keys=False, default_flow_style=False))
+        finally:
+            self._loaded()
+
+    async def _fetch(
+        self,
+        started: int,
+        collectionkey: str,
+        filter: Mapping[str, Any],
+        *args: Any,
+        **kwargs: Any,
+    ) -> Optional[MutableMapping[str, Any]]:
+        if (
+            not args
+            and not kwargs
+            and (sharedmatch := await self._find_shared(collectionkey, filter))
+        ):
+            await self.evictions.wait_for_capacity()
+            if not self._written_since(str(sharedmatch["_id"]), started):
+                self[str(sharedmatch["_id"])] = sharedmatch
+            return sharedmatch
+        data: MutableMapping[str, Any] = await self.bot.sdb[collectionkey].find_one(
+            filter, *args, **{**self._readopts, **kwargs}
+        )
+        if data is None:
+            return None
+        session = kwargs.get("session")
+        if session is not None and id(session) in self._txwrites:
+            # may hold the transaction's own writes, which can't be cached, see update_one
+            return data
+        key = str(data["_id"])
+        if key in self:
+            # written while we were waiting on the database, what's cached is newer
+            return self[key]
+        await self.evictions.wait_for_capacity()
+        data["collectionkey"] = collectionkey
+        if key in self:
+            return self[key]
+        if self._written_since(key, started):
+            # written or invalidated after we started reading, we may have read the old copy
             return data
+        self[key] = data
+        await self._share(key, data)
+        # print(yaml.dump(self._Cache__data, sort_keys=False, default_flow_style=False))
+        return data
+
+    def _expired(self, key: str, value: MutableMapping[str, Any]):
+        """Called by the ttl partitions for everything that expired."""
+        self._forget(key)
+        if self.serve_stale:
+            self._stale.pop(key, None)
+            self._stale[key] = value
+            while len(self._stale) > self.stale_maxsize:
+                self._stale.popitem(last=False)
+
+    def _find_stale(
+        self, collectionkey: str, searchfilter: Mapping[str, Any]
+    ) -> Optional[MutableMapping[str, Any]]:
+        # bounded by stale_maxsize, a scan is fine here
+        for document in reversed(self._stale.values()):
+            if document.get("collectionkey") == collectionkey and all(
+                x in document and document[x] == y for x, y in searchfilter.items()
+            ):
+                return document
+        return None
+
+    def _drop(self, key: str):
+        """Drops a document that's out of date, stale copy and partials included."""
+        self.pop(key, None)
+        self._stale.pop(key, None)
+        self._wrote(key)
+
+    def _wrote(self, key: str):
+        """Called for every write or invalidation of a document, drops its partials and keeps
+        loads that started before now from caching what they read."""
+        self._partials.pop(key, None)
+        self._writeseq += 1
+        if self._loading:
+            self._written[key] = self._writeseq
+
+    def _written_since(self, key: str, seq: int) -> bool:
+        return self._written.get(key, 0) > seq
+
+    def _loaded(self):
+        self._loading -= 1
+        if not self._loading:
+            self._written.clear()
+
+    # ==== partial documents ====
+    async def _find_partial(
+        self,
+        collectionkey: str,
+        filter: Mapping[str, Any],
+        projection: Tuple[str, ...],
+    ) -> Optional[FrozenDocument]:
+        """Projected lookups that missed the full document cache are served from a cache of partial
+        documents, keyed by _id and then projection. A lookup only ever fetches its own projection
+        (plus the filter fields, so cached partials can be checked against later filters)."""
+        partition = self.partition(collectionkey)
+        filterkey = self._flight_key(collectionkey, filter)
+        if filterkey is None:
+            partition.misses += 1
+            data = await self.bot.sdb[collectionkey].find_one(
+                filter, {x: 1 for x in projection}, **self._readopts
+            )
+            return None if data is None else self._view(data, projection)
+
+        key = self._partial_keys.get(filterkey)
+        partial = self._partials.get(key, {}).get(projection) if key else None
+        # the pointer can outlive a rename, so the partial has to match the filter too
+        if partial is not None and all(
+            x in partial and partial[x] == y for x, y in filter.items()
+        ):
+            partition.hits += 1
+            return self._view(partial, projection)
+        partition.misses += 1
+
+        flightkey = (*filterkey, projection)
+        inflight = self._inflight.get(flightkey)
+        if inflight is None:
+            inflight = self._inflight[flightkey] = asyncio.create_task(
+                self._load_partial(collectionkey, filter, projection, filterkey)
+            )
+            inflight.add_done_callback(lambda _: self._inflight.pop(flightkey, None))
+        data = await asyncio.shield(inflight)
+        return None if data is None else self._view(data, projection)
+
+    async def _load_partial(
+        self,
+        collectionkey: str,
+        filter: Mapping[str, Any],
+        projection: Tuple[str, ...],
+        filterkey: Tuple,
+    ) -> Optional[Mapping[str, Any]]:
+        self._loading += 1
+        started = self._writeseq
+        try:
+            data = await self.bot.sdb[collectionkey].find_one(
+                filter, {x: 1 for x in (*projection, *filter)}, **self._readopts
+            )
+            if data is None:
+                return None
+            key = str(data["_id"])
+            if key in self:
+                # the full document got cached while we were waiting
+                return self[key]
+            if not self._written_since(key, started):
+                # a write in the meantime may have changed what we just read
+                self._partial_keys[filterkey] = key
+                self._partials.setdefault(key, {})[projection] = data
+            return data
+        finally:
+            self._loaded()
 
     async def replace_one(
         self,
@@ -227,18 +931,36 @@ class MongoCache(cachetools.TTLCache):
         *args,
         **kwargs,
     ) -> UpdateResult:
-        if "collectionkey" not in replacement:
-            replacement["collectionkey"] = collectionkey
-        if str(replacement["_id"]) in self.keys():
-            self[str(replacement["_id"])] = replacement
-        else:
-            cachematches = self._find_matches_in_self(collectionkey, filter)
-            idkey = str(cachematches[0]["_id"])
-            self[idkey] = replacement
-        replacement.pop("collectionkey")
-        result: UpdateResult = await self.bot.sdb[collectionkey].replace_one(
-            filter, replacement, upsert, *args, **kwargs
-        )
+        """Replaces a whole document, compare-and-swapped on the version it was read at (its version
+        field, documents from before versioning count as version 0), so it can't overwrite a write
+        it never saw. Raises VersionConflictError if the database has another version."""
+        await self._flush_pending()
+        version = replacement.get("version") or 0
+        replacement = {**replacement, "updatedAt": utcnow_ms(), "version": version + 1}
+        casfilter = {**filter, "version": version or {"$in": [0, None]}}
+        try:
+            result: UpdateResult = await self.bot.sdb[collectionkey].replace_one(
+                casfilter, replacement, upsert, *args, **kwargs
+            )
+        except DuplicateKeyError:
+            # the upsert ran into the version we didn't expect
+            result = None
+        if result is None or (not result.matched_count and result.upserted_id is None):
+            # whatever we have cached lost the race too
+            for match in self._find_matches_in_self(collectionkey, filter):
+                await self.invalidate(collectionkey, str(match["_id"]))
+            collection = self.bot.sdb[collectionkey]
+            if result is None or await collection.find_one(filter, {"_id": 1}):
+                raise VersionConflictError()
+            return result
+        await self.evictions.wait_for_capacity()
+        # cache a copy so the caller keeps a document without our collectionkey
+        # and later changes to it can't leak into the cache or desync the indexes
+        cached = {**deepcopy(replacement), "collectionkey": collectionkey}
+        key = str(replacement["_id"])
+        self[key] = cached
+        self._wrote(key)
+        await self._share(key, cached, broadcast=True)
         # print(yaml.dump(self._Cache__data, sort_keys=False, default_flow_style=False))
         return result
 
@@ -249,49 +971,607 @@ class MongoCache(cachetools.TTLCache):
         update: Union[Mapping[str, Any], Sequence[Mapping[str, Any]]],
         upsert: bool = False,
         *args,
+        version: Optional[int] = None,
+        session: Optional["AsyncIOMotorClientSession"] = None,
         **kwargs,
-    ) -> Union[UpdateResult, UpdateResultFacade]:
+    ) -> Optional[Union[UpdateResult, UpdateResultFacade]]:
+        """Every update bumps the document's version. Passing the version the caller read makes this
+        a compare-and-swap, raising VersionConflictError if anything else wrote the document since
+        (documents from before versioning count as version 0). Versioned updates never upsert.
+        Returns None when nothing matched the filter."""
+        update = _stamp_update(update)
+        if self.write_behind and session is None and not args and not kwargs:
+            result = self._update_behind(collectionkey, filter, update, version)
+            if result is not None:
+                key = str(result.inserted_id)
+                if key in self:
+                    await self._share(key, self[key], broadcast=True)
+                return result
+        await self._flush_pending()
+        casfilter = filter
+        if version is not None:
+            casfilter = {**filter, "version": version or {"$in": [0, None]}}
+            upsert = False
         document = await self.bot.sdb[collectionkey].find_one_and_update(
             *args,
-            filter=filter,
+            filter=casfilter,
             update=update,
             upsert=upsert,
             return_document=True,
+            session=session,
             **kwargs,
         )
+        if document is None and version is not None:
+            # whatever we have cached lost the race too
+            for match in self._find_matches_in_self(collectionkey, filter):
+                await self.invalidate(collectionkey, str(match["_id"]))
+            raise VersionConflictError()
+        if document is None:
+            return None
         document["collectionkey"] = collectionkey
-        self[str(document["_id"])] = document
+        key = str(document["_id"])
+        if session is not None and id(session) in self._txwrites:
+            # nobody else sees this until the transaction commits, so it can't be cached yet.
+            # with_transaction drops it everywhere once the transaction is over
+            self._txwrites[id(session)].append((collectionkey, key))
+            self._drop(key)
+            return UpdateResultFacade(
+                inserted_id=document["_id"], document=self._view(document)
+            )
+        await self.evictions.wait_for_capacity()
+        self[key] = document
+        self._wrote(key)
+        await self._share(key, document, broadcast=True)
         # print(yaml.dump(self._Cache__data, sort_keys=False, default_flow_style=False))
-        return UpdateResultFacade(inserted_id=document["_id"])
+        return UpdateResultFacade(
+            inserted_id=document["_id"], document=self._view(document)
+        )
+
+    async def bulk_update(
+        self,
+        collectionkey: str,
+        updates: Sequence[Tuple[Mapping[str, Any], Mapping[str, Any], Optional[int]]],
+    ) -> List[Optional[UpdateResultFacade]]:
+        """update_one for many documents, as (filter by _id, update, version) triples, all sent at
+        once (or with write-behind, the ones that can be are queued for the next flush).
+        A version conflict doesn't raise, that update's result is just None like a miss, so
+        the rest of the batch still lands. Results come back in the order of updates.
+
+        Each one is its own find_one_and_update, which runs on the primary and hands back the
+        document it wrote, so what landed is never mistaken for a miss (or the other way around)."""
+        results: List[Optional[UpdateResultFacade]] = [None] * len(updates)
+        stamped = [(x, _stamp_update(y), z) for x, y, z in updates]
+        pending = list(range(len(updates)))
+        if self.write_behind:
+            pending = []
+            for index, (filter, update, version) in enumerate(stamped):
+                result = self._update_behind(collectionkey, filter, update, version)
+                if result is None:
+                    pending.append(index)
+                    continue
+                results[index] = result
+                key = str(result.inserted_id)
+                if key in self:
+                    await self._share(key, self[key], broadcast=True)
+        if not pending:
+            return results
+        await self._flush_pending()
+        collection = self.bot.sdb[collectionkey]
+        written = await asyncio.gather(
+            *(
+                collection.find_one_and_update(
+                    {**filter, "version": version or {"$in": [0, None]}}
+                    if version is not None
+                    else filter,
+                    update,
+                    return_document=ReturnDocument.AFTER,
+                )
+                for filter, update, version in (stamped[x] for x in pending)
+            ),
+            return_exceptions=True,
+        )
+
+        await self.evictions.wait_for_capacity()
+        error: Optional[BaseException] = None
+        for index, document in zip(pending, written):
+            if isinstance(document, BaseException):
+                error = error or document
+                document = None
+            if document is None:
+                # missed, or we can't tell. Either way what we have cached may be out of date
+                for match in self._find_matches_in_self(
+                    collectionkey, stamped[index][0]
+                ):
+                    await self.invalidate(collectionkey, str(match["_id"]))
+                continue
+            document["collectionkey"] = collectionkey
+            key = str(document["_id"])
+            self[key] = document
+            self._wrote(key)
+            await self._share(key, document, broadcast=True)
+            results[index] = UpdateResultFacade(
+                inserted_id=document["_id"], document=self._view(document)
+            )
+        if error is not None:
+            raise error
+        return results
 
     async def delete_one(
         self, collectionkey: str, filter: Mapping[str, Any], *args, **kwargs
     ):
+        # writes queued before the delete land before it
+        await self._flush_pending()
         result = await self.bot.sdb[collectionkey].find_one_and_delete(
             *args, filter=filter, **kwargs
         )
         if result is None:
             return result
-        if str(result["_id"]) in self.keys():
-            self.pop(str(result["_id"]))
+        self._drop(str(result["_id"]))
+        await self._unshare(collectionkey, str(result["_id"]))
+
+    # ==== transactions ====
+    async def supports_transactions(self) -> bool:
+        """Whether the server does multi-document transactions (replica sets and sharded clusters)."""
+        if self._txsupport is None:
+            try:
+                hello = await self.bot.mclient.admin.command("hello")
+            except (PyMongoError, NotImplementedError):
+                hello = {}
+            self._txsupport = "setName" in hello or hello.get("msg") == "isdbgrid"
+        return self._txsupport
+
+    async def with_transaction(
+        self,
+        callback: Callable[[Optional["AsyncIOMotorClientSession"]], Awaitable[Any]],
+    ) -> Any:
+        """Runs callback(session) as one transaction, for writing several documents all or nothing.
+        Pass the session on to update_one. Returns what callback returns.
+
+        Like the driver's with_transaction, callback is run again on a TransientTransactionError
+        (i.e. a write conflict or a failover) and the commit retried on UnknownTransactionCommitResult,
+        so it has to start over cleanly. On servers without transactions it's just callback(None),
+        the writes then land one at a time and undoing them on failure is up to the caller.
+
+        Documents written in the transaction are dropped from the cache (and the shared tier)
+        once it's over, committed or not."""
+        if not await self.supports_transactions():
+            return await callback(None)
+        await self._flush_pending()
+        async with await self.bot.mclient.start_session() as session:
+            writes = self._txwrites[id(session)] = []
+            try:
+                return await session.with_transaction(callback)
+            finally:
+                del self._txwrites[id(session)]
+                for collectionkey, key in writes:
+                    await self.invalidate(collectionkey, key, broadcast=True)
+
+    # ==== shared tier ====
+    @staticmethod
+    def _shared_key(collectionkey: str, key: str) -> str:
+        return f"labyrinthian:doc:{collectionkey}:{key}"
+
+    @staticmethod
+    def _shared_index_key(
+        collectionkey: str, shape: Tuple[str, ...], fieldvals: Tuple
+    ) -> str:
+        return f"labyrinthian:idx:{collectionkey}:{','.join(shape)}:" + "\x1f".join(
+            str(x) for x in fieldvals
+        )
+
+    async def _find_shared(
+        self, collectionkey: str, searchfilter: Mapping[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """Looks a document up in the shared tier, only filters with an indexed shape can be resolved there.
+        Index entries just point at the cache key, so a pointer left behind by a rename
+        fails the filter check below instead of returning the wrong document."""
+        shape = tuple(sorted(searchfilter))
+        if self.backend is None or shape not in self._index_shapes(collectionkey):
+            return None
+        try:
+            fieldvals = tuple(searchfilter[x] for x in shape)
+            if shape == ("_id",):
+                key = str(fieldvals[0])
+            else:
+                pointer = await self.backend.get(
+                    self._shared_index_key(collectionkey, shape, fieldvals)
+                )
+                if pointer is None:
+                    return None
+                key = pointer.decode()
+            payload = await self.backend.get(self._shared_key(collectionkey, key))
+        except Exception:
+            logger.exception("Shared cache lookup failed, falling back to the database")
+            return None
+        if payload is None:
+            return None
+        document = bson.decode(payload)
+        if document.get("collectionkey") != collectionkey or not all(
+            x in document and document[x] == y for x, y in searchfilter.items()
+        ):
+            return None
+        return document
+
+    async def _share(
+        self, key: str, document: Mapping[str, Any], broadcast: bool = False
+    ):
+        """Writes a document through to the shared tier.
+        broadcast tells every other process to drop its in-memory copy, which is needed whenever
+        the document changed rather than just got read."""
+        if self.backend is None:
+            return
+        collectionkey = document["collectionkey"]
+        try:
+            await self.backend.set(
+                self._shared_key(collectionkey, key),
+                bson.encode(document),
+                self.shared_ttl,
+            )
+            for (_, shape), fieldvals in self._index_entries(document):
+                if shape != ("_id",):
+                    await self.backend.set(
+                        self._shared_index_key(collectionkey, shape, fieldvals),
+                        key.encode(),
+                        self.shared_ttl,
+                    )
+            if broadcast:
+                await self._broadcast(key)
+        except Exception:
+            logger.exception(f"Failed to share {key} with the shared cache")
+
+    async def _unshare(self, collectionkey: str, key: str):
+        if self.backend is None:
+            return
+        try:
+            await self.backend.delete(self._shared_key(collectionkey, key))
+            await self._broadcast(key)
+        except Exception:
+            logger.exception(f"Failed to drop {key} from the shared cache")
+
+    async def _broadcast(self, *keys: str):
+        await self.backend.publish(
+            DBCACHE_CHANNEL, bson.encode({"origin": self.origin, "keys": list(keys)})
+        )
+
+    async def _on_invalidation(self, message: bytes):
+        message = bson.decode(message)
+        if message["origin"] == self.origin:
+            return
+        for key in message["keys"]:
+            await self._flush_key(key)
+            self._drop(key)
+
+    async def invalidate(self, collectionkey: str, key: str, broadcast: bool = False):
+        """Drops a document that changed behind our back, from this process and the shared tier.
+        Unflushed write-behind changes to it get flushed first, on top of the outside change
+        and it's reloaded on the next read."""
+        await self._flush_key(key)
+        self._drop(key)
+        if self.backend is None:
+            return
+        try:
+            await self.backend.delete(self._shared_key(collectionkey, key))
+            if broadcast:
+                await self._broadcast(key)
+        except Exception:
+            logger.exception(f"Failed to drop {key} from the shared cache")
+
+    # ==== write-behind ====
+    def _update_behind(
+        self,
+        collectionkey: str,
+        filter: Mapping[str, Any],
+        update: Union[Mapping[str, Any], Sequence[Mapping[str, Any]]],
+        version: Optional[int] = None,
+    ) -> Optional[UpdateResultFacade]:
+        """Applies an update to the cached document and queues it for the next flush.
+        Returns None if the document isn't cached or the update can't be applied locally,
+        in which case the update goes straight to the database.
+
+        So do compare-and-swaps and filters on more than the document's identity (i.e. mutate's
+        guards): the cached copy can be behind the database, only the database can tell
+        whether those hold, and their callers need to know before they return."""
+        if version is not None or tuple(sorted(filter)) not in self._index_shapes(
+            collectionkey
+        ):
+            return None
+        cachematches = self._find_matches_in_self(collectionkey, filter)
+        if not cachematches:
+            return None
+        current = cachematches[0]
+        document = _apply_update(current, update)
+        if document is None:
+            return None
+        key = str(document["_id"])
+        self[key] = document
+        self._wrote(key)
+        pending = self._dirty.get(key)
+        if pending is None:
+            pending = self._dirty[key] = PendingWrite(
+                collectionkey,
+                document,
+                _compose_update({}, update, document),
+                current.get("version", 0),
+            )
+        else:
+            pending.document = document
+            pending.update = _compose_update(pending.update, update, document)
+        flushed = asyncio.get_running_loop().create_future()
+        pending.futures.append(flushed)
+        self._schedule_flush()
+        return UpdateResultFacade(
+            inserted_id=document["_id"], flushed=flushed, document=self._view(document)
+        )
+
+    def _find_matches_in_dirty(
+        self, collectionkey: str, searchfilter: Mapping[str, Any]
+    ) -> Optional[MutableMapping[str, Any]]:
+        # the dirty set never grows much past flush_threshold, a scan is fine here.
+        # Newest first, whatever's being flushed right now isn't in the database yet either
+        for pending in (*self._dirty.values(), *self._flushing.values()):
+            document = pending.document
+            if pending.collectionkey == collectionkey and all(
+                x in document and document[x] == y for x, y in searchfilter.items()
+            ):
+                return document
+        return None
+
+    def _schedule_flush(self):
+        if len(self._dirty) >= self.flush_threshold:
+            self._spawn_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self.flush_interval, self._spawn_flush
+            )
+
+    def _spawn_flush(self):
+        task = asyncio.create_task(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush_pending(self):
+        """For writes that go straight to the database: waits out a flush in progress and
+        writes whatever's dirty first, so writes to a document land in the order they were made."""
+        if self._dirty or self._flushing:
+            await self.flush()
+
+    async def _flush_key(self, key: str):
+        if key in self._dirty or key in self._flushing:
+            await self.flush()
+
+    async def flush(self):
+        """Writes every dirty document to the database, one bulk_write per collection.
+        Also used as the shutdown hook, so nothing queued by write-behind is lost."""
+        async with self._flush_lock:
+            await self._flush()
+
+    async def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        dirty, self._dirty = self._dirty, {}
+        self._flushing = dirty
+        try:
+            await self._write_batches(dirty)
+        finally:
+            self._flushing = {}
+        if self._dirty:
+            self._schedule_flush()
+
+    async def _write_batches(self, dirty: Dict[str, PendingWrite]):
+        batches: Dict[str, List[str]] = {}
+        for key, pending in dirty.items():
+            batches.setdefault(pending.collectionkey, []).append(key)
+
+        for collectionkey, keys in batches.items():
+            operations = [
+                UpdateOne({"_id": dirty[key].document["_id"]}, dirty[key].update)
+                for key in keys
+            ]
+            error: Optional[Exception] = None
+            failed: Set[int] = set()
+            matched = 0
+            try:
+                result = await self.bot.sdb[collectionkey].bulk_write(
+                    operations, ordered=False
+                )
+                matched = result.matched_count
+            except BulkWriteError as e:
+                error = e
+                failed = {x["index"] for x in e.details.get("writeErrors", ())}
+                matched = e.details.get("nMatched", 0)
+            except Exception as e:
+                error = e
+                failed = set(range(len(keys)))
+            written = [x for index, x in enumerate(keys) if index not in failed]
+            gone: Set[str] = set()
+            if matched < len(written):
+                # nothing upserts, so whatever didn't match got deleted behind our back
+                existing = await self._existing(
+                    collectionkey, [dirty[x].document["_id"] for x in written]
+                )
+                gone = {x for x in written if x not in existing}
+            for index, key in enumerate(keys):
+                if index in failed:
+                    self._requeue(key, dirty[key], error)
+                    continue
+                self._settled(key, dirty[key])
+                if key in gone:
+                    # our copy still has it, until the next read
+                    self._drop(key)
+                    await self._unshare(collectionkey, key)
+            if failed:
+                logger.warning(
+                    f"Write-behind flush to {collectionkey} failed for {len(failed)} document(s): {error}"
+                )
+
+    async def _existing(self, collectionkey: str, ids: List[Any]) -> Set[str]:
+        # a secondary that's behind would make our writes look lost
+        collection = self.bot.sdb[collectionkey].with_options(
+            read_preference=ReadPreference.PRIMARY
+        )
+        return {
+            str(x["_id"])
+            async for x in collection.find({"_id": {"$in": ids}}, {"_id": 1})
+        }
+
+    def _settled(self, key: str, pending: PendingWrite):
+        _settle(pending.futures)
+        if pending.seq is not None:
+            self.journal.ack(key, pending.seq)
+
+    def _requeue(self, key: str, pending: PendingWrite, error: Exception):
+        """Puts changes that failed to write back in front of whatever got queued since.
+        Whoever waits on them hears about the failure, the retry is on the next flush."""
+        _settle(pending.futures, error)
+        newer = self._dirty.get(key)
+        if newer is None:
+            self._dirty[key] = replace(pending, futures=[])
+            return
+        self._dirty[key] = replace(
+            newer,
+            update=_compose_update(pending.update, newer.update, newer.document),
+            base=pending.base,
+            seq=pending.seq if newer.seq is None else newer.seq,
+        )
 
 
 class CharlistCache(cachetools.TTLCache):
     def __init__(
-        self, bot: "Labyrinthian", maxsize: float, ttl: float, *args, **kwargs
+        self,
+        bot: "Labyrinthian",
+        maxsize: float,
+        ttl: float,
+        *args,
+        backend: Optional[SharedCacheBackend] = None,
+        serve_stale: bool = False,
+        stale_maxsize: int = 100,
+        workdir: Optional[str] = None,
+        **kwargs,
     ) -> None:
         super().__init__(maxsize, ttl, *args, **kwargs)
         self.bot = bot
+        self.backend = backend
+        self.origin = uuid.uuid4().hex
+        self._listener: Optional["asyncio.Task[None]"] = None
+        # see MongoCache, same single-flight and stale-while-revalidate setup
+        self._inflight: Dict[str, "asyncio.Task[List[str]]"] = {}
+        self.serve_stale = serve_stale
+        self.stale_maxsize = stale_maxsize
+        self._stale: "OrderedDict[str, List[str]]" = OrderedDict()
+        # warm start, the lists themselves are cheap to store but can't be validated without
+        # rerunning the query, so only which users were active gets snapshotted
+        self.snapshot: Optional[CacheSnapshot] = None
+        if workdir is not None:
+            path = Path(workdir, "logs", "snapshots")
+            path.mkdir(parents=True, exist_ok=True)
+            self.snapshot = CacheSnapshot(str(path / "charcache.bson"))
+        self._warmer: Optional["asyncio.Task[None]"] = None
+
+    @staticmethod
+    def _key(guildkey: str, userkey: str) -> str:
+        return f"{guildkey}:{userkey}"
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        if self.serve_stale:
+            for key, value in expired:
+                self._stale.pop(key, None)
+                self._stale[key] = value
+            while len(self._stale) > self.stale_maxsize:
+                self._stale.popitem(last=False)
+        return expired
+
+    def _drop(self, key: str):
+        self.pop(key, None)
+        self._stale.pop(key, None)
+        # a load that started before the change would cache the old list
+        self._inflight.pop(key, None)
+
+    async def start(self):
+        if self.backend is not None and self._listener is None:
+            self._listener = asyncio.create_task(
+                listen_for_invalidations(
+                    self.backend, CHARLIST_CHANNEL, self._on_invalidation
+                )
+            )
+        if self.snapshot is not None and self._warmer is None:
+            self._warmer = asyncio.create_task(self.warm())
+
+    async def close(self):
+        if self.snapshot is not None:
+            try:
+                self.snapshot.save({"key": x} for x in list(self))
+            except OSError:
+                logger.exception("Failed to snapshot the charlist cache")
+        for task in (self._listener, self._warmer):
+            if task is not None:
+                task.cancel()
+        self._listener = self._warmer = None
+
+    async def warm(self, concurrency: int = 5):
+        """Reloads the lists of everyone who was active before the restart."""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def load(key: str):
+            async with semaphore:
+                try:
+                    await self.find_distinct_chardat(*key.split(":", 1))
+                except PyMongoError:
+                    logger.exception(f"Failed to warm the charlist for {key}")
+
+        await asyncio.gather(*(load(x["key"]) for x in self.snapshot.load()))
+
+    async def invalidate(self, guildkey: str, userkey: str):
+        """Drops a user's character list here and in every other process."""
+        self._drop(self._key(guildkey, userkey))
+        if self.backend is None:
+            return
+        try:
+            await self.backend.publish(
+                CHARLIST_CHANNEL,
+                bson.encode(
+                    {"origin": self.origin, "keys": [self._key(guildkey, userkey)]}
+                ),
+            )
+        except Exception:
+            logger.exception("Failed to broadcast charlist invalidation")
+
+    async def _on_invalidation(self, message: bytes):
+        message = bson.decode(message)
+        if message["origin"] == self.origin:
+            return
+        for key in message["keys"]:
+            self._drop(key)
 
     async def find_distinct_chardat(self, guildkey: str, userkey: str) -> List[str]:
-        if f"{guildkey}{userkey}" in self:
+        key = self._key(guildkey, userkey)
+        if key in self:
             # print(yaml.dump(self._Cache__data, sort_keys=False, default_flow_style=False))
-            return self[f"{guildkey}{userkey}"]
-        else:
+            return self[key]
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            inflight = self._inflight[key] = asyncio.create_task(
+                self._load(guildkey, userkey)
+            )
+        if self.serve_stale:
+            self.expire()
+            if key in self._stale:
+                return self._stale[key]
+        return await asyncio.shield(inflight)
+
+    async def _load(self, guildkey: str, userkey: str) -> List[str]:
+        key = self._key(guildkey, userkey)
+        try:
             data: List[str] = await self.bot.sdb[f"charactercollection"].distinct(
                 "name", {"user": userkey, "guild": guildkey}
             )
-            if data:
-                self[f"{guildkey}{userkey}"] = data
+            # invalidated while we were waiting on the database, don't cache what we got
+            if data and self._inflight.get(key) is asyncio.current_task():
+                self._stale.pop(key, None)
+                self[key] = data
             # print(yaml.dump(self._Cache__data, sort_keys=False, default_flow_style=False))
             return data
+        finally:
+            if self._inflight.get(key) is asyncio.current_task():
+                del self._inflight[key]
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Mapping, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+if TYPE_CHECKING:
+    from utils.MongoCache import MongoCache
+
+logger = logging.getLogger("changestreams")
+
+# collections whose documents live in dbcache, xplog never goes through it
+WATCHED_COLLECTIONS = ("srvconf", "userprefs", "charactercollection")
+
+
+class CacheWatcher:
+    """Evicts cached documents that were changed in the database by someone other than us
+    (another process, an admin script, a migration).
+
+    Follows a change stream per collection. Change streams need a replica set, so on a standalone
+    server it polls every poll_interval seconds for documents whose updatedAt moved instead,
+    which MongoCache stamps on every write. Polling can't see deletes, those still age out by TTL."""
+
+    def __init__(
+        self,
+        cache: "MongoCache",
+        collections: Iterable[str] = WATCHED_COLLECTIONS,
+        poll_interval: float = 10.0,
+    ) -> None:
+        self.cache = cache
+        self.collections = tuple(collections)
+        self.poll_interval = poll_interval
+        self.tasks: Dict[str, "asyncio.Task[None]"] = {}
+        # collection -> how it's currently being watched, "stream" or "poll"
+        self.modes: Dict[str, str] = {}
+
+    def start(self):
+        for collectionkey in self.collections:
+            if collectionkey not in self.tasks:
+                self.tasks[collectionkey] = asyncio.create_task(
+                    self._watch(collectionkey)
+                )
+
+    async def close(self):
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks = {}
+
+    # ==== change streams ====
+    async def _watch(self, collectionkey: str):
+        collection = self.cache.bot.sdb[collectionkey]
+        resume_token: Optional[Mapping[str, Any]] = None
+        delay = 1.0
+        while True:
+            try:
+                async with collection.watch(resume_after=resume_token) as stream:
+                    self.modes[collectionkey] = "stream"
+                    delay = 1.0
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        await self._on_change(collectionkey, change)
+            except (OperationFailure, NotImplementedError) as e:
+                # standalone servers (and mocks) don't do change streams at all
+                if self.modes.get(collectionkey) == "stream":
+                    logger.warning(f"Change stream on {collectionkey} failed: {e}")
+                else:
+                    logger.info(
+                        f"Change streams unavailable for {collectionkey}, polling updatedAt instead"
+                    )
+                    return await self._poll(collectionkey)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Lost the change stream on {collectionkey}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+    async def _on_change(self, collectionkey: str, change: Mapping[str, Any]):
+        key = change.get("documentKey", {}).get("_id")
+        if key is None:
+            return
+        operation = change.get("operationType")
+        if operation == "update":
+            updatedat = (
+                change.get("updateDescription", {})
+                .get("updatedFields", {})
+                .get("updatedAt")
+            )
+        elif operation in ("insert", "replace"):
+            updatedat = change.get("fullDocument", {}).get("updatedAt")
+        elif operation == "delete":
+            updatedat = None
+        else:
+            return
+        await self._invalidate(collectionkey, str(key), updatedat)
+
+    # ==== polling ====
+    async def _poll(self, collectionkey: str):
+        self.modes[collectionkey] = "poll"
+        collection = self.cache.bot.sdb[collectionkey]
+        since = utcnow_ms()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                async for document in collection.find(
+                    {"updatedAt": {"$gt": since}}, {"_id": 1, "updatedAt": 1}
+                ):
+                    since = max(since, document["updatedAt"])
+                    await self._invalidate(
+                        collectionkey, str(document["_id"]), document["updatedAt"]
+                    )
+            except PyMongoError:
+                logger.exception(f"Failed to poll {collectionkey} for changes")
+
+    async def _invalidate(
+        self, collectionkey: str, key: str, updatedat: Optional[datetime]
+    ):
+        cached = self.cache.get(key)
+        # our own writes come back through here too, skip the ones we already hold
+        if (
+            cached is not None
+            and updatedat is not None
+            and cached.get("updatedAt") == updatedat
+        ):
+            return
+        await self.cache.invalidate(collectionkey, key)
+
+
+def utcnow_ms() -> datetime:
+    """Now, the way it round trips through the database (naive UTC, millisecond precision),
+    so stamps on cached documents compare equal to the ones read back."""
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
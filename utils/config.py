@@ -24,6 +24,46 @@ COMMAND_TEST_GUILD_IDS = [
 MONGO_URL = os.getenv("MONGO_URL")
 MONGODB_SERVERDB_NAME = os.getenv("MONGODB_SERVERDB_NAME")
 MONGODB_TESTINGDB_NAME = os.getenv("MONGODB_TESTINGDB_NAME")
+# connection pool and timeouts, kept under discord's 3s interaction deadline so a slow
+# database fails the command instead of stalling it
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(
+    os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 2000)
+)
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 2000))
+# off when unset, a socket timeout also cuts off index builds, change streams, transactions
+# and long aggregations. Interactive reads get MONGO_READ_MAX_TIME_MS instead
+MONGO_SOCKET_TIMEOUT_MS = (
+    int(os.getenv("MONGO_SOCKET_TIMEOUT_MS"))
+    if os.getenv("MONGO_SOCKET_TIMEOUT_MS")
+    else None
+)
+# server side limit (maxTimeMS) for the reads behind cache misses
+MONGO_READ_MAX_TIME_MS = int(os.getenv("MONGO_READ_MAX_TIME_MS", 2500))
+# how long an operation waits for a free pooled connection
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 1000))
+# client side timeout for whole operations, retries included (needs pymongo 4.2+), off when unset
+MONGO_TIMEOUT_MS = (
+    int(os.getenv("MONGO_TIMEOUT_MS")) if os.getenv("MONGO_TIMEOUT_MS") else None
+)
+MONGO_RETRY = os.getenv("MONGO_RETRY", "True") == "True"
+# wire compression, in order of preference. ones whose library isn't installed are skipped
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "zstd,snappy,zlib")
+# reads fall back to secondaries while there's no primary, and the xp log (append only,
+# only ever read for display) reads from them when it can
+MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE", "primaryPreferred")
+MONGO_READ_PREFERENCES = os.getenv("MONGO_READ_PREFERENCES", "xplog=secondaryPreferred")
+# explain() the hot queries on startup and warn about any that aren't served by an index
+MONGO_EXPLAIN = os.getenv("MONGO_EXPLAIN") == "True"
+# defer cached document writes and flush them in batches
+CACHE_WRITE_BEHIND = os.getenv("CACHE_WRITE_BEHIND") == "True"
+# shared cache tier + invalidation broadcasts across processes, off when unset
+REDIS_URL = os.getenv("REDIS_URL")
+# evict cached documents changed by other processes/scripts (change streams, or polling updatedAt)
+CACHE_WATCH = os.getenv("CACHE_WATCH") == "True"
+# serve just expired cache entries while a single task refreshes them
+CACHE_SERVE_STALE = os.getenv("CACHE_SERVE_STALE") == "True"
 
 # ---- user ----
 DEFAULT_PREFIX = os.getenv("DEFAULT_PREFIX", "!")
@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+from collections import deque
+from importlib.util import find_spec
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+import motor.motor_asyncio
+from pymongo import monitoring
+from pymongo.read_preferences import ReadPreference, _ServerMode
+
+from utils import config
+
+logger = logging.getLogger("database")
+
+READ_PREFERENCES: Dict[str, _ServerMode] = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+# compressor -> the module pymongo needs for it
+COMPRESSORS = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+
+# checkouts that wait at least this long get logged, the pool is too small for the load
+SLOW_CHECKOUT = 0.5
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """Keeps track of how long operations wait for a pooled connection, per server.
+
+    pymongo calls these from whichever thread is checking out, the driver's events
+    only carry a duration from 4.7 on, so the wait is timed per thread here."""
+
+    def __init__(self, window: int = 1000) -> None:
+        self.window = window
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # address -> counters, plus the last window waits for percentiles
+        self._servers: Dict[Tuple[str, int], Dict[str, Any]] = {}
+
+    def _server(self, address: Tuple[str, int]) -> Dict[str, Any]:
+        server = self._servers.get(address)
+        if server is None:
+            server = self._servers[address] = {
+                "checkouts": 0,
+                "failed": 0,
+                "timeouts": 0,
+                "open": 0,
+                "total_wait": 0.0,
+                "max_wait": 0.0,
+                "waits": deque(maxlen=self.window),
+            }
+        return server
+
+    def _waited(self) -> float:
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+        return 0.0 if started is None else time.perf_counter() - started
+
+    # ==== checkouts ====
+    def connection_check_out_started(
+        self, event: monitoring.ConnectionCheckOutStartedEvent
+    ):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event: monitoring.ConnectionCheckedOutEvent):
+        wait = self._waited()
+        with self._lock:
+            server = self._server(event.address)
+            server["checkouts"] += 1
+            server["total_wait"] += wait
+            server["max_wait"] = max(server["max_wait"], wait)
+            server["waits"].append(wait)
+        if wait >= SLOW_CHECKOUT:
+            logger.warning(
+                f"Waited {wait * 1000:.0f}ms for a connection to {event.address[0]}, "
+                "the pool might be too small"
+            )
+
+    def connection_check_out_failed(
+        self, event: monitoring.ConnectionCheckOutFailedEvent
+    ):
+        wait = self._waited()
+        with self._lock:
+            server = self._server(event.address)
+            server["failed"] += 1
+            if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+                server["timeouts"] += 1
+                logger.warning(
+                    f"Timed out after {wait * 1000:.0f}ms waiting for a connection "
+                    f"to {event.address[0]}"
+                )
+
+    # ==== connections ====
+    def connection_created(self, event: monitoring.ConnectionCreatedEvent):
+        with self._lock:
+            self._server(event.address)["open"] += 1
+
+    def connection_closed(self, event: monitoring.ConnectionClosedEvent):
+        with self._lock:
+            self._server(event.address)["open"] -= 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per server, wait times are in milliseconds, p50/p95 over the last window checkouts."""
+        result = {}
+        with self._lock:
+            for (host, port), server in self._servers.items():
+                waits = sorted(server["waits"])
+                result[f"{host}:{port}"] = {
+                    "open": server["open"],
+                    "checkouts": server["checkouts"],
+                    "failed": server["failed"],
+                    "timeouts": server["timeouts"],
+                    "avg_wait_ms": server["total_wait"]
+                    / max(server["checkouts"], 1)
+                    * 1000,
+                    "p50_wait_ms": _percentile(waits, 0.5) * 1000,
+                    "p95_wait_ms": _percentile(waits, 0.95) * 1000,
+                    "max_wait_ms": server["max_wait"] * 1000,
+                }
+        return result
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+class Database:
+    """The bot's database. Collections come out of it with their own read preference
+    (see config.MONGO_READ_PREFERENCES), everything else is passed through to the motor database."""
+
+    def __init__(
+        self,
+        database: motor.motor_asyncio.AsyncIOMotorDatabase,
+        read_preferences: Mapping[str, _ServerMode],
+    ) -> None:
+        self.database = database
+        self.read_preferences = dict(read_preferences)
+        self._collections: Dict[str, motor.motor_asyncio.AsyncIOMotorCollection] = {}
+
+    def __getitem__(self, name: str) -> motor.motor_asyncio.AsyncIOMotorCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = self.database.get_collection(
+                name, read_preference=self.read_preferences.get(name)
+            )
+        return collection
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.database, name)
+
+
+def available_compressors(names: Iterable[str]) -> List[str]:
+    """The compressors out of names that can actually be used here.
+    pymongo warns about every one whose library isn't installed, they're dropped quietly instead."""
+    available = []
+    for name in names:
+        module = COMPRESSORS.get(name)
+        if module is None:
+            logger.warning(f"Unknown wire compressor {name!r}, ignoring it")
+        elif find_spec(module) is not None:
+            available.append(name)
+    return available
+
+
+def read_preference(name: str) -> _ServerMode:
+    try:
+        return READ_PREFERENCES[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown read preference {name!r}, expected one of {', '.join(READ_PREFERENCES)}"
+        ) from None
+
+
+def parse_read_preferences(value: str) -> Dict[str, _ServerMode]:
+    """Parses "xplog=secondaryPreferred,srvconf=primary" into {collection: read preference}."""
+    result = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        collection, _, mode = item.partition("=")
+        result[collection.strip()] = read_preference(mode.strip())
+    return result
+
+
+def client_options() -> Dict[str, Any]:
+    """Client settings from the MONGO_* config, these win over options in MONGO_URL."""
+    options: Dict[str, Any] = {
+        "minPoolSize": config.MONGO_MIN_POOL_SIZE,
+        "maxPoolSize": config.MONGO_MAX_POOL_SIZE,
+        "serverSelectionTimeoutMS": config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "connectTimeoutMS": config.MONGO_CONNECT_TIMEOUT_MS,
+        "waitQueueTimeoutMS": config.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "retryReads": config.MONGO_RETRY,
+        "retryWrites": config.MONGO_RETRY,
+        "read_preference": read_preference(config.MONGO_READ_PREFERENCE),
+    }
+    compressors = available_compressors(
+        x.strip() for x in config.MONGO_COMPRESSORS.split(",") if x.strip()
+    )
+    if compressors:
+        options["compressors"] = compressors
+    if config.MONGO_SOCKET_TIMEOUT_MS is not None:
+        options["socketTimeoutMS"] = config.MONGO_SOCKET_TIMEOUT_MS
+    if config.MONGO_TIMEOUT_MS is not None:
+        options["timeoutMS"] = config.MONGO_TIMEOUT_MS
+    return options
+
+
+def connect(
+    url: str, pool: Optional[PoolMonitor] = None
+) -> motor.motor_asyncio.AsyncIOMotorClient:
+    return motor.motor_asyncio.AsyncIOMotorClient(
+        url, event_listeners=[] if pool is None else [pool], **client_options()
+    )
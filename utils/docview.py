@@ -0,0 +1,72 @@
+from collections.abc import Mapping
+from copy import deepcopy
+from typing import Any, Dict, Iterable, Iterator
+
+
+def freeze(value: Any) -> Any:
+    """Wraps documents and arrays in read only views, everything else is returned as is."""
+    # documents coming out of the driver are plain dicts and lists, so these checks
+    # stay cheap for the scalars that make up most fields
+    if isinstance(value, dict):
+        return FrozenDocument(value)
+    if isinstance(value, list):
+        return FrozenList(value)
+    return value
+
+
+def thaw(value: Any) -> Any:
+    """Returns a fully mutable copy of a view (or of anything containing views)."""
+    if isinstance(value, Mapping):
+        return {x: thaw(y) for x, y in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(x) for x in value]
+    return deepcopy(value)
+
+
+class FrozenDocument(Mapping):
+    """A read only view over a cached document.
+
+    Nothing gets copied on read, nested documents and arrays come back as views of their own.
+    Anything that needs to change a document copies just the part it changes, i.e.
+    `char = dict(view)` for the top level, `char["coinpurse"] = dict(char["coinpurse"])` below it."""
+
+    __slots__ = ("_data", "_hidden")
+
+    def __init__(self, data: Mapping[str, Any], hidden: Iterable[str] = ()) -> None:
+        self._data = data
+        # internal bookkeeping fields (i.e. MongoCache's collectionkey) readers shouldn't see
+        self._hidden = frozenset(hidden)
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._hidden:
+            raise KeyError(key)
+        return freeze(self._data[key])
+
+    def __contains__(self, key: object) -> bool:
+        return key not in self._hidden and key in self._data
+
+    def __iter__(self) -> Iterator[str]:
+        return (x for x in self._data if x not in self._hidden)
+
+    def __reversed__(self) -> Iterator[str]:
+        return (x for x in reversed(self._data) if x not in self._hidden)
+
+    def __len__(self) -> int:
+        return len(self._data) - len(self._hidden.intersection(self._data))
+
+    def __deepcopy__(self, _) -> Dict[str, Any]:
+        return thaw(self)
+
+    def __repr__(self) -> str:
+        return f"FrozenDocument({dict(self.items())!r})"
+
+
+class FrozenList(tuple):
+    """A read only array from a cached document. It's a tuple so pydantic and
+    bson both accept it anywhere they'd take a list."""
+
+    def __new__(cls, data: Iterable[Any]):
+        return super().__new__(cls, (freeze(x) for x in data))
+
+    def __deepcopy__(self, _):
+        return thaw(self)
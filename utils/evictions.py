@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Mapping, Tuple
+
+logger = logging.getLogger("evictions")
+
+Eviction = Tuple[str, Mapping[str, Any], int]
+
+
+class EvictionPipeline:
+    """Writes evicted cache documents' unflushed changes to the database off of the event loop's
+    critical path. Clean documents never get here, see MongoCache._evict.
+
+    Evictions go onto a bounded queue drained by a fixed pool of writer tasks.
+    Failed writes are retried with exponential backoff, and anything that still fails
+    stays in the Lost In Transit journal to be replayed on the next startup.
+    Callers that are about to insert into the cache await wait_for_capacity() first,
+    which is where backpressure gets applied."""
+
+    def __init__(
+        self,
+        write: Callable[[str, Mapping[str, Any], int], Awaitable[None]],
+        maxsize: int = 500,
+        workers: int = 4,
+        retries: int = 5,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+    ) -> None:
+        self.write = write
+        self.workercount = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.queue: "asyncio.Queue[Eviction]" = asyncio.Queue(maxsize)
+        # evictions that came in while the queue was full, newest per key
+        # popitem can't await, so this is only ever filled by inserts that skipped backpressure
+        self.overflow: "OrderedDict[str, Eviction]" = OrderedDict()
+        self.workers: List["asyncio.Task[None]"] = []
+        self._space = asyncio.Event()
+        self._space.set()
+
+        # ==== metrics ====
+        self.written = 0
+        self.retried = 0
+        self.failed = 0
+        self.latencies: Deque[float] = deque(maxlen=1000)
+
+    # ==== lifecycle ====
+    def start(self):
+        if self.workers:
+            return
+        self.workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.workercount)
+        ]
+
+    async def close(self, timeout: float = 10.0):
+        """Gives queued evictions a chance to finish writing, then stops the writers."""
+        if self.workers:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"Stopped with {self.queue.qsize()} eviction(s) still queued, "
+                    "they will be replayed from the journal"
+                )
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+
+    # ==== queueing ====
+    def submit(self, key: str, value: Mapping[str, Any], seq: int):
+        self.start()
+        try:
+            self.queue.put_nowait((key, value, seq))
+        except asyncio.QueueFull:
+            self.overflow.pop(key, None)
+            self.overflow[key] = (key, value, seq)
+            self._space.clear()
+
+    async def wait_for_capacity(self):
+        while self.queue.full() or self.overflow:
+            self._space.clear()
+            await self._space.wait()
+
+    def _refill(self):
+        while self.overflow and not self.queue.full():
+            _, eviction = self.overflow.popitem(last=False)
+            self.queue.put_nowait(eviction)
+        if not self.overflow and not self.queue.full():
+            self._space.set()
+
+    # ==== writers ====
+    async def _worker(self):
+        while True:
+            key, value, seq = await self.queue.get()
+            self._refill()
+            try:
+                await self._write_with_retry(key, value, seq)
+            except Exception:
+                logger.exception(f"Eviction writer failed on {key}")
+            finally:
+                self.queue.task_done()
+
+    async def _write_with_retry(self, key: str, value: Mapping[str, Any], seq: int):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            try:
+                await self.write(key, value, seq)
+            except Exception as e:
+                if attempt == self.retries:
+                    self.failed += 1
+                    logger.error(
+                        f"Giving up on writing evicted document {key} after {attempt + 1} attempts, "
+                        f"it stays journaled until the next startup: {e}"
+                    )
+                    return
+                self.retried += 1
+                await asyncio.sleep(min(delay, self.max_backoff))
+                delay *= 2
+            else:
+                self.latencies.append(time.perf_counter() - started)
+                self.written += 1
+                return
+
+    # ==== metrics ====
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize() + len(self.overflow)
+
+    def stats(self) -> Dict[str, float]:
+        latencies = sorted(self.latencies)
+        return {
+            "depth": self.depth,
+            "written": self.written,
+            "retried": self.retried,
+            "failed": self.failed,
+            "latency_avg_ms": (
+                1000 * sum(latencies) / len(latencies) if latencies else 0.0
+            ),
+            "latency_p95_ms": (
+                1000 * latencies[int(len(latencies) * 0.95)] if latencies else 0.0
+            ),
+            "latency_max_ms": 1000 * latencies[-1] if latencies else 0.0,
+        }
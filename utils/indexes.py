@@ -0,0 +1,170 @@
+import logging
+from dataclasses import dataclass
+from typing import Any, Iterable, List, Mapping, Optional, Tuple
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+
+from utils.changestreams import WATCHED_COLLECTIONS
+
+logger = logging.getLogger("indexes")
+
+# server error codes
+DUPLICATE_KEY = 11000
+INDEX_OPTIONS_CONFLICT = 85
+INDEX_KEY_SPECS_CONFLICT = 86
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    collection: str
+    keys: Tuple[Tuple[str, int], ...]
+    unique: bool = False
+
+    @property
+    def name(self) -> str:
+        # same as the server's default name, so indexes made by hand before this are recognized
+        return "_".join(f"{x}_{y}" for x, y in self.keys)
+
+
+@dataclass(frozen=True)
+class QueryShape:
+    """A query the bot runs all the time, with placeholder values, for explain().
+    With distinct set it's a distinct on that field instead of a find."""
+
+    collection: str
+    filter: Mapping[str, Any]
+    sort: Optional[Tuple[Tuple[str, int], ...]] = None
+    distinct: Optional[str] = None
+
+
+INDEXES: Tuple[IndexSpec, ...] = (
+    # lookups by name, the charlist distinct on {user, guild} and refresh_chardat's
+    # {user} sorted by guild all run off the prefix
+    IndexSpec(
+        "charactercollection", (("user", 1), ("guild", 1), ("name", 1)), unique=True
+    ),
+    # XPLogBook pages by (timestamp, _id) ranges within a character
+    IndexSpec("xplog", (("charref", 1), ("timestamp", -1), ("_id", -1))),
+    # XPStats.rebuild's pass over a guild's log
+    IndexSpec("xplog", (("guild", 1), ("timestamp", 1), ("_id", 1))),
+    IndexSpec("xpstats", (("guild", 1), ("charref", 1)), unique=True),
+    IndexSpec("srvconf", (("guild", 1),), unique=True),
+    IndexSpec("userprefs", (("user", 1),), unique=True),
+)
+
+# CacheWatcher falls back to polling on updatedAt without change streams
+POLL_INDEXES: Tuple[IndexSpec, ...] = tuple(
+    IndexSpec(x, (("updatedAt", 1),)) for x in WATCHED_COLLECTIONS
+)
+
+QUERY_SHAPES: Tuple[QueryShape, ...] = (
+    QueryShape("charactercollection", {"user": "0", "guild": "0", "name": ""}),
+    QueryShape("charactercollection", {"user": "0", "guild": "0"}, distinct="name"),
+    QueryShape("charactercollection", {"user": "0"}, sort=(("guild", 1),)),
+    QueryShape(
+        "xplog",
+        {
+            "charref": ObjectId(),
+            "$or": [
+                {"timestamp": {"$lt": 0}},
+                {"timestamp": 0, "_id": {"$lt": ObjectId()}},
+            ],
+        },
+        sort=(("timestamp", -1), ("_id", -1)),
+    ),
+    QueryShape("xpstats", {"guild": "0", "charref": None}),
+    QueryShape("srvconf", {"guild": "0"}),
+    QueryShape("userprefs", {"user": "0"}),
+)
+
+
+async def ensure_indexes(db, specs: Iterable[IndexSpec] = INDEXES):
+    """Creates whichever of the indexes don't exist yet, existing ones are left alone.
+    A unique index that existing duplicates get in the way of is created without the constraint."""
+    for spec in specs:
+        collection = db[spec.collection]
+        try:
+            await collection.create_index(
+                list(spec.keys), name=spec.name, unique=spec.unique
+            )
+        except OperationFailure as e:
+            if e.code in (INDEX_OPTIONS_CONFLICT, INDEX_KEY_SPECS_CONFLICT):
+                logger.info(
+                    f"{spec.collection} already has an index on {spec.name} with other options, keeping it"
+                )
+            elif e.code == DUPLICATE_KEY and spec.unique:
+                logger.error(
+                    f"Duplicate {spec.name} in {spec.collection}, indexing it without the unique constraint"
+                )
+                await _create_quietly(collection, spec, unique=False)
+            else:
+                logger.exception(f"Failed to create {spec.collection}.{spec.name}")
+        except PyMongoError:
+            logger.exception(f"Failed to create {spec.collection}.{spec.name}")
+
+
+async def _create_quietly(collection, spec: IndexSpec, unique: bool):
+    try:
+        await collection.create_index(list(spec.keys), name=spec.name, unique=unique)
+    except PyMongoError:
+        logger.exception(f"Failed to create {spec.collection}.{spec.name}")
+
+
+async def explain_queries(
+    db, shapes: Iterable[QueryShape] = QUERY_SHAPES
+) -> List[Tuple[QueryShape, List[str]]]:
+    """Diagnostic, runs explain() on every query shape and warns about the ones the server
+    answers with a collection scan or an in memory sort. Returns those, with the offending stages."""
+    flagged = []
+    for shape in shapes:
+        try:
+            plan = await _explain(db, shape)
+        except (PyMongoError, NotImplementedError) as e:
+            logger.warning(f"Couldn't explain {shape}: {e}")
+            continue
+        stages = sorted(
+            x
+            for x in _stages(plan.get("queryPlanner", plan))
+            if x in ("COLLSCAN", "SORT")
+        )
+        if stages:
+            logger.warning(
+                f"{shape.collection} query {dict(shape.filter)} sort {shape.sort} "
+                f"distinct {shape.distinct} runs a {'/'.join(stages)}, is its index missing?"
+            )
+            flagged.append((shape, stages))
+    if not flagged:
+        logger.info("Every registered query shape is served by an index")
+    return flagged
+
+
+async def _explain(db, shape: QueryShape) -> Mapping[str, Any]:
+    if shape.distinct is not None:
+        return await db.command(
+            {
+                "explain": {
+                    "distinct": shape.collection,
+                    "key": shape.distinct,
+                    "query": dict(shape.filter),
+                },
+                "verbosity": "queryPlanner",
+            }
+        )
+    cursor = db[shape.collection].find(dict(shape.filter))
+    if shape.sort:
+        cursor = cursor.sort(list(shape.sort))
+    return await cursor.explain()
+
+
+def _stages(plan: Any) -> Iterable[str]:
+    """Every stage in a plan, at any depth (sharded plans nest them per shard)."""
+    if isinstance(plan, Mapping):
+        if isinstance(plan.get("stage"), str):
+            yield plan["stage"]
+        for key, value in plan.items():
+            if key != "rejectedPlans":
+                yield from _stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _stages(value)
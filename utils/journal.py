@@ -0,0 +1,102 @@
+import os
+from typing import Any, BinaryIO, Dict, Mapping, Tuple
+
+import bson
+from bson.errors import InvalidBSON
+
+
+class LITJournal:
+    """Append-only Lost In Transit journal for cache evictions that haven't been
+    acknowledged by the database yet.
+
+    Every record is a single BSON document appended to the end of the file:
+        {"op": "put", "seq": 1, "key": "<cache key>", "doc": {...}}
+        {"op": "ack", "seq": 1, "key": "<cache key>"}
+    An ack is the tombstone for the put with the same key and seq.
+    Once enough tombstones pile up, the file is rewritten with only the
+    unacknowledged puts left in it."""
+
+    def __init__(
+        self, path: str, compact_threshold: int = 1000, fsync: bool = False
+    ) -> None:
+        self.path = path
+        self.compact_threshold = compact_threshold
+        self.fsync = fsync
+        self.pending: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+        self.seq = 0
+        self.records = 0
+        torn = self._load()
+        self._file: BinaryIO = open(self.path, "ab")
+        if torn:
+            self.compact()
+
+    def _load(self) -> bool:
+        """Rebuilds the pending set from the file on disk.
+        Returns True if the file ended in a torn record."""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "rb") as journal:
+            try:
+                for record in bson.decode_file_iter(journal):
+                    self._apply(record)
+            except InvalidBSON:
+                # a crash in the middle of an append leaves a partial record at the tail
+                # everything before it is intact, so we keep what we have and compact it away
+                return True
+        return False
+
+    def _apply(self, record: Mapping[str, Any]):
+        self.seq = max(self.seq, record["seq"])
+        self.records += 1
+        if record["op"] == "put":
+            self.pending[record["key"]] = (record["seq"], record["doc"])
+        elif record["op"] == "ack":
+            if self.pending.get(record["key"], (None,))[0] == record["seq"]:
+                self.pending.pop(record["key"])
+
+    def _write(self, record: Mapping[str, Any]):
+        self._file.write(bson.encode(record))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.records += 1
+
+    # ==== records ====
+    def append(self, key: str, document: Mapping[str, Any]) -> int:
+        """Journals a document on its way to the database, returns the seq to ack it with."""
+        self.seq += 1
+        document = dict(document)
+        self._write({"op": "put", "seq": self.seq, "key": key, "doc": document})
+        self.pending[key] = (self.seq, document)
+        return self.seq
+
+    def ack(self, key: str, seq: int):
+        """Tombstones a put once the database has confirmed the write.
+        Acks for a put that has since been superseded by a newer one are dropped."""
+        if self.pending.get(key, (None,))[0] != seq:
+            return
+        self.pending.pop(key)
+        self._write({"op": "ack", "seq": seq, "key": key})
+        # mostly superseded records by now
+        stale = self.records > 2 * len(self.pending)
+        if stale and self.records >= self.compact_threshold:
+            self.compact()
+
+    # ==== maintenance ====
+    def compact(self):
+        """Rewrites the journal with only the unacknowledged puts."""
+        temppath = f"{self.path}.tmp"
+        with open(temppath, "wb") as journal:
+            for key, (seq, document) in self.pending.items():
+                journal.write(
+                    bson.encode({"op": "put", "seq": seq, "key": key, "doc": document})
+                )
+            journal.flush()
+            os.fsync(journal.fileno())
+        self._file.close()
+        os.replace(temppath, self.path)
+        self._file = open(self.path, "ab")
+        self.records = len(self.pending)
+
+    def close(self):
+        self._file.close()
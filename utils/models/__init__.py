@@ -1,12 +1,30 @@
 import inspect
 import typing
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
 
 class LabyrinthianBaseModel(BaseModel):
+    # the document this model was loaded from (read only), what commits diff against.
+    # get_data hands it over under the "_base" key
+    _base: typing.Optional[typing.Mapping[str, typing.Any]] = PrivateAttr(None)
+
+    @classmethod
+    def parse_obj(cls, obj: typing.Any):
+        base = obj.pop("_base", None) if isinstance(obj, dict) else None
+        model = super().parse_obj(obj)
+        model._base = base
+        return model
+
     @classmethod
     def no_validate(cls, data: typing.Dict[str, typing.Any]):
+        base = data.pop("_base", None)
+        model = cls._no_validate(data)
+        model._base = base
+        return model
+
+    @classmethod
+    def _no_validate(cls, data: typing.Dict[str, typing.Any]):
         for field_name, field in cls.__fields__.items():
             if field_name not in data:
                 continue
@@ -55,3 +73,39 @@ class LabyrinthianBaseModel(BaseModel):
         error_msg_templates = {
             "value_error.url.scheme": "This is not an accepted sheet URL."
         }
+
+
+# ==== diffing ====
+def _same(a: typing.Any, b: typing.Any) -> bool:
+    # the loaded document is a read only view, its arrays are tuples
+    if isinstance(a, typing.Mapping) and isinstance(b, typing.Mapping):
+        return a.keys() == b.keys() and all(_same(a[x], b[x]) for x in a)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(_same(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def document_diff(
+    base: typing.Optional[typing.Mapping[str, typing.Any]],
+    data: typing.Mapping[str, typing.Any],
+    prefix: str = "",
+) -> typing.Dict[str, typing.Any]:
+    """The $set that turns base into data, as dotted paths down to the fields that actually changed.
+    Subdocuments that lost fields, or whose keys can't be used in a path, are set whole."""
+    if base is None:
+        return {f"{prefix}{x}": y for x, y in data.items()}
+    changes = {}
+    for field, value in data.items():
+        old = base.get(field, ...)
+        if _same(old, value):
+            continue
+        if (
+            isinstance(value, typing.Mapping)
+            and isinstance(old, typing.Mapping)
+            and old.keys() <= value.keys()
+            and all(x and "." not in x and not x.startswith("$") for x in value)
+        ):
+            changes.update(document_diff(old, value, f"{prefix}{field}."))
+        else:
+            changes[f"{prefix}{field}"] = value
+    return changes
@@ -35,6 +35,9 @@ class AuctionListing(LabyrinthianBaseModel):
         if data is None:
             wasnone = True
             data = {"guild": guild}
+        else:
+            # shallow copy of the cached view, validation replaces the top level fields
+            data = dict(data)
         return (data, wasnone)
 
     @classmethod
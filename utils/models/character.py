@@ -1,19 +1,35 @@
 import re
-from copy import deepcopy
-from typing import TYPE_CHECKING, Any, Dict, NewType, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    NewType,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 from bson import ObjectId
 from pydantic import AnyUrl, validator
 
-from utils.models import LabyrinthianBaseModel
-from utils.models.coinpurse import CoinPurse
+from utils.docview import thaw
+from utils.models import LabyrinthianBaseModel, document_diff
+from utils.models.coinpurse import Coin, CoinPurse
+from utils.models.errors import MissingCharacterDataError, VersionConflictError
+from utils.models.settings.coin import Denominations
 from utils.models.settings.guild import ServerSettings
+from utils.MongoCache import UpdateResultFacade
 
 if TYPE_CHECKING:
     ObjID = ObjectId
+    from motor.motor_asyncio import AsyncIOMotorClientSession
+
     from bot import Labyrinthian
     from utils.models.settings.user import UserPreferences
-    from utils.MongoCache import MongoCache, UpdateResultFacade
+    from utils.MongoCache import MongoCache
 else:
     ObjID = Any
 
@@ -27,6 +43,8 @@ URL_KEY_V2_RE = re.compile(r"/spreadsheets/d/([a-zA-Z0-9-_]+)")
 
 
 DEFAULT_PURSE = {}
+# how many times commit re-reads and merges after losing a race before giving up
+COMMIT_RETRIES = 5
 
 
 UserID = NewType("UserID", str)
@@ -50,6 +68,8 @@ class Character(LabyrinthianBaseModel):
     multiclasses: Dict[str, int] = {}
     xp: float = 0
     lastlog: LastLog = LastLog()
+    # bumped by every write, commits compare-and-swap on it
+    version: int = 0
 
     # ==== properties ====
     @property
@@ -58,11 +78,7 @@ class Character(LabyrinthianBaseModel):
 
     @property
     def expected_level(self):
-        var = "1"
-        for x, y in self.settings.xptemplate.items():
-            if self.xp >= x:
-                var = y
-        return var
+        return self.settings.xptemplate.level_for(self.xp)
 
     # ==== validators ====
     @validator("sheet")
@@ -93,44 +109,259 @@ class Character(LabyrinthianBaseModel):
     # ==== lifecycle ====
     @staticmethod
     async def get_data(
-        bot: "Labyrinthian", filter: Dict[str, Any]
-    ) -> Optional[Dict[str, Any]]:
+        bot: "Labyrinthian",
+        filter: Dict[str, Any],
+        projection: Optional[Iterable[str]] = None,
+    ) -> Optional[Mapping[str, Any]]:
+        """With a projection, returns just those fields of the raw document (read only)
+        without building the settings, user prefs or coinpurse a full character needs."""
         char = await bot.dbcache.find_one(
             "charactercollection",
             filter,
+            projection=projection,
         )
-        if char is None:
-            return None
-        else:
-            settings = await bot.get_server_settings(char["guild"], validate=False)
-            if "id" not in char or char["id"] is None:
-                char["id"] = deepcopy(char["_id"])
-            char.pop("_id")
-            uprefs = await bot.get_user_prefs(char["user"])
-            char = {"settings": settings, **char}
-            if "coinpurse" not in char:
-                char["coinpurse"] = {
-                    "coinlist": [settings.coinconf.gen_coinpurse_dict()],
-                    "uprefs": uprefs,
-                }
-            char["coinpurse"]["config"] = deepcopy(settings.coinconf)
-            char["coinpurse"]["uprefs"] = uprefs
+        if char is None or projection is not None:
             return char
+        settings = await bot.get_server_settings(char["guild"], validate=False)
+        uprefs = await bot.get_user_prefs(char["user"])
+        # settings is freshly built for this call, so its config can be shared
+        return Character.hydrate(char, settings, uprefs)
 
-    async def commit(self, db: "MongoCache"):
-        """Commits the settings to the database."""
-        data = self.dict(exclude={"settings"})
-        data["coinpurse"] = self.coinpurse.to_dict()
-        if self.id:
-            result: "UpdateResultFacade" = await db.update_one(
+    @staticmethod
+    def hydrate(
+        char: Mapping[str, Any],
+        settings: ServerSettings,
+        uprefs: Optional["UserPreferences"],
+    ) -> Dict[str, Any]:
+        """Turns a stored character into what parse_obj/no_validate take. Its coinpurse uses
+        settings.coinconf as is, so characters of one guild can share one settings instance."""
+        # the cache hands out read only views, we only copy the parts we change
+        base, char = char, dict(char)
+        if "id" not in char or char["id"] is None:
+            char["id"] = char["_id"]
+        char.pop("_id")
+        char = {"settings": settings, **char}
+        if "coinpurse" not in char:
+            char["coinpurse"] = {
+                "coinlist": [*settings.coinconf.gen_coinpurse_dict()],
+            }
+        else:
+            char["coinpurse"] = dict(char["coinpurse"])
+        char["coinpurse"]["config"] = settings.coinconf
+        char["coinpurse"]["uprefs"] = uprefs
+        char["_base"] = base
+        return char
+
+    async def commit(
+        self, db: "MongoCache", session: Optional["AsyncIOMotorClientSession"] = None
+    ):
+        """Commits the character to the database, only writing the fields that changed since it was loaded.
+        If someone else wrote it since it was loaded, their changes get merged in and it's retried,
+        see merge_character."""
+        data = self._document()
+        if not self.id:
+            return await db.insert_one("charactercollection", data)
+        for _ in range(COMMIT_RETRIES):
+            update = character_update(self._base, data)
+            if not update:
+                return UpdateResultFacade(inserted_id=self.id)
+            try:
+                result: "UpdateResultFacade" = await db.update_one(
+                    "charactercollection",
+                    {"_id": self.id},
+                    update,
+                    version=self.version,
+                    session=session,
+                )
+            except VersionConflictError:
+                theirs = await db.find_one("charactercollection", {"_id": self.id})
+                if theirs is None:
+                    raise MissingCharacterDataError()
+                merged = merge_character(self._base, data, theirs)
+                self._refresh(data, merged)
+                data = merged
+                self._base = theirs
+                self.version = theirs.get("version", 0)
+            else:
+                self.version += 1
+                self._base = {**data, "version": self.version}
+                return result
+        raise VersionConflictError()
+
+    async def mutate(
+        self,
+        db: "MongoCache",
+        xp: float = 0,
+        coins: Optional[CoinPurse] = None,
+        session: Optional["AsyncIOMotorClientSession"] = None,
+    ) -> bool:
+        """Adds xp and coins (negative to take them away) to the character in the database with $inc,
+        so whatever else wrote the character in the meantime is kept without a read-modify-write.
+        Other changes made to the model go out along with it.
+
+        Returns False without writing anything if the character can't afford the coins.
+        Afterwards the model is what's in the database, with the coins' changes as their history."""
+        for _ in range(COMMIT_RETRIES):
+            purse = self.coinpurse
+            if coins is not None:
+                purse = self.coinpurse.copy()
+                if coins.baseval < 0 and abs(coins.baseval) > purse.baseval:
+                    return False
+                purse.combine_batch(coins)
+            data = {
+                **self._document(),
+                "xp": self.xp + xp,
+                "coinpurse": purse.to_dict(),
+            }
+            compiled = mutation_update(self._base, data, xp)
+            if compiled is None:
+                # the purse got reshaped on the way (new coin types, legacy string counts),
+                # which takes a full write
+                self.xp, self.coinpurse = data["xp"], purse
+                await self.commit(db, session=session)
+                return True
+            update, guards = compiled
+            result: Optional["UpdateResultFacade"] = await db.update_one(
                 "charactercollection",
-                {"_id": self.id},
-                {"$set": data},
-                upsert=True,
+                {"_id": self.id, **guards},
+                update,
+                session=session,
             )
-        else:
-            result = await db.insert_one("charactercollection", data)
-        return result
+            if result is not None:
+                self._reload(result.document)
+                history = {x.uid: y for x, y in zip(purse.types, purse.hist)}
+                for index, type in enumerate(self.coinpurse.types):
+                    self.coinpurse.hist[index] = history.get(type.uid, 0)
+                return True
+            # short on coins, or the purse moved under us. Catch up and try again
+            await db.invalidate("charactercollection", str(self.id))
+            theirs = await db.find_one(
+                "charactercollection", {"_id": self.id}, session=session
+            )
+            if theirs is None:
+                raise MissingCharacterDataError()
+            self._reload(theirs)
+        raise VersionConflictError()
+
+    async def transfer(
+        self, db: "MongoCache", recipient: "Character", coins: CoinPurse
+    ) -> bool:
+        """Moves coins from this character to recipient, in one transaction where the server supports them
+        (retried on write conflicts and failovers, see MongoCache.with_transaction).
+        Otherwise this character is charged first and refunded if paying recipient fails.
+        Returns False if this character can't afford it."""
+        checkpoints = [(x, x._checkpoint()) for x in (self, recipient)]
+
+        async def move(session: Optional["AsyncIOMotorClientSession"]) -> bool:
+            if session is not None:
+                # retried transactions start over from where the models were
+                for char, checkpoint in checkpoints:
+                    char._rollback(checkpoint)
+            if not await self.mutate(db, coins=coins.negative(), session=session):
+                return False
+            try:
+                await recipient.mutate(db, coins=coins.positive(), session=session)
+            except Exception:
+                if session is None:
+                    await self.mutate(db, coins=coins.positive())
+                raise
+            return True
+
+        try:
+            return await db.with_transaction(move)
+        except Exception:
+            if await db.supports_transactions():
+                # the transaction got aborted, none of what the models caught up with happened
+                for char, checkpoint in checkpoints:
+                    char._rollback(checkpoint)
+            raise
+
+    @staticmethod
+    async def mutate_many(
+        db: "MongoCache", characters: Sequence["Character"], coins: CoinPurse
+    ) -> List[bool]:
+        """mutate for a batch of characters with the same coins, i.e. a payout to a party or a
+        server-wide stipend. The purse math runs once over all of them (CoinPurse.apply_many)
+        and they're written with a single bulk update, compare-and-swapped on each one's version.
+        The ones someone else wrote in the meantime get caught up and retried as another batch.
+
+        Returns whether each character got the coins, False for the ones who couldn't afford them
+        or got deleted."""
+        results = [False] * len(characters)
+        pending = list(range(len(characters)))
+        for _ in range(COMMIT_RETRIES):
+            purses = [characters[x].coinpurse.copy() for x in pending]
+            affordable = CoinPurse.apply_many(purses, coins)
+            batch, updates = [], []
+            for index, purse, ok in zip(pending, purses, affordable):
+                if not ok:
+                    continue
+                char = characters[index]
+                data = {**char._document(), "coinpurse": purse.to_dict()}
+                update = character_update(char._base, data)
+                if not update:
+                    results[index] = True
+                    continue
+                batch.append((index, purse))
+                updates.append(({"_id": char.id}, update, char.version))
+            written = await db.bulk_update("charactercollection", updates)
+            pending = []
+            for (index, purse), result in zip(batch, written):
+                char = characters[index]
+                if result is None:
+                    await db.invalidate("charactercollection", str(char.id))
+                    theirs = await db.find_one("charactercollection", {"_id": char.id})
+                    if theirs is None:
+                        # deleted in the meantime, the rest of the batch still gets paid
+                        continue
+                    char._reload(theirs)
+                    pending.append(index)
+                    continue
+                char._reload(result.document)
+                history = {x.uid: y for x, y in zip(purse.types, purse.hist)}
+                for position, type in enumerate(char.coinpurse.types):
+                    char.coinpurse.hist[position] = history.get(type.uid, 0)
+                results[index] = True
+            if not pending:
+                return results
+        raise VersionConflictError()
+
+    def _document(self) -> Dict[str, Any]:
+        """The character as it's stored."""
+        data = self.dict(exclude={"settings", "version"})
+        data["coinpurse"] = self.coinpurse.to_dict()
+        return data
+
+    def _reload(self, document: Mapping[str, Any]):
+        """Catches the model up with the character as it is in the database."""
+        self._refresh(self._document(), thaw(document))
+        self._base = document
+        self.version = document.get("version", 0)
+
+    def _checkpoint(self) -> Tuple[Dict[str, Any], Any, int, CoinPurse]:
+        return self._document(), self._base, self.version, self.coinpurse.copy()
+
+    def _rollback(self, checkpoint: Tuple[Dict[str, Any], Any, int, CoinPurse]):
+        """Puts the model back the way it was at checkpoint."""
+        document, base, version, purse = checkpoint
+        self._refresh(self._document(), document)
+        self._base, self.version, self.coinpurse = base, version, purse
+
+    def _refresh(self, old: Mapping[str, Any], new: Mapping[str, Any]):
+        """Brings the model up to date with a merged document, old being what it was written from."""
+        for field, value in new.items():
+            if field not in self.__fields__ or old.get(field) == value:
+                continue
+            if field == "coinpurse":
+                self.coinpurse = CoinPurse.from_dict(
+                    {
+                        **value,
+                        "config": self.coinpurse.config,
+                        "uprefs": self.coinpurse.uprefs,
+                    }
+                )
+            else:
+                setattr(self, field, value)
 
     async def archive(self, bot: "Labyrinthian", uprefs: "UserPreferences"):
         """Archives the character data, rendering it inaccessible to end users
@@ -173,3 +404,131 @@ class Character(LabyrinthianBaseModel):
     #         recovered = cls.parse_obj(data)
 
     #         return recovered
+
+
+def mutation_update(
+    base: Optional[Mapping[str, Any]], data: Mapping[str, Any], xp: float
+) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """Compiles Character.mutate into an update that $incs xp and the coin counts, and the filter
+    guarding it, which checks every coin being spent is where base has it and there's enough of it.
+
+    None if the purse can't be expressed as increments of base's (coins added, removed or
+    moved around, counts still stored as strings)."""
+    if base is None:
+        return None
+    changes = document_diff(base, data)
+    changes.pop("xp", None)
+    inc: Dict[str, Any] = {"xp": xp} if xp else {}
+    guards: Dict[str, Any] = {}
+    if any(x.startswith("coinpurse") for x in changes):
+        old = base.get("coinpurse", {}).get("coinlist", ())
+        new = data["coinpurse"]["coinlist"]
+        if len(old) != len(new):
+            return None
+        for index, (oldcoin, newcoin) in enumerate(zip(old, new)):
+            if not isinstance(oldcoin["count"], int) or set(
+                document_diff(oldcoin, newcoin)
+            ) - {"count"}:
+                return None
+            delta = newcoin["count"] - oldcoin["count"]
+            if not delta:
+                continue
+            path = f"coinpurse.coinlist.{index}"
+            inc[f"{path}.count"] = delta
+            guards[f"{path}.type.uid"] = newcoin["type"]["uid"]
+            if delta < 0:
+                guards[f"{path}.count"] = {"$gte": -delta}
+        changes = {x: y for x, y in changes.items() if not x.startswith("coinpurse")}
+    update = {}
+    if inc:
+        update["$inc"] = inc
+    if changes:
+        update["$set"] = changes
+    return update, guards
+
+
+# ==== merging ====
+def character_update(
+    base: Optional[Mapping[str, Any]], data: Mapping[str, Any]
+) -> Dict[str, Any]:
+    """The update that takes base to data. xp goes out as an $inc when it can, so it
+    reads as a delta in the oplog/change streams instead of a value."""
+    changes = document_diff(base, data)
+    update = {}
+    if base is not None and "xp" in changes:
+        old, new = base.get("xp"), changes["xp"]
+        # floats, the delta has to land exactly on the new value
+        if (
+            isinstance(old, (int, float))
+            and isinstance(new, (int, float))
+            and old + (new - old) == new
+        ):
+            update["$inc"] = {"xp": changes.pop("xp") - old}
+    if changes:
+        update["$set"] = changes
+    return update
+
+
+def merge_character(
+    base: Optional[Mapping[str, Any]],
+    ours: Mapping[str, Any],
+    theirs: Mapping[str, Any],
+) -> Dict[str, Any]:
+    """Three way merge of a character we failed to write (ours) with what's in the database now
+    (theirs), base being what we originally loaded.
+
+    Fields only one side changed keep that side's value. When both changed the same field,
+    xp and coin counts add both sides' changes up, anything else goes to us.
+    Without a base there's no telling what we changed, so everything goes to us."""
+    if base is None:
+        return dict(ours)
+    base, theirs = thaw(base), thaw(theirs)
+    merged = dict(ours)
+    for field, value in ours.items():
+        if field not in theirs or field not in base:
+            continue
+        old, new = base[field], theirs[field]
+        if value == old:
+            merged[field] = new
+        elif new == old:
+            continue
+        elif field == "xp":
+            merged[field] = new + (value - old)
+        elif field == "coinpurse":
+            merged[field] = _merge_purses(old, value, new)
+    return merged
+
+
+def _merge_purses(
+    base: Mapping[str, Any], ours: Mapping[str, Any], theirs: Mapping[str, Any]
+) -> Dict[str, Any]:
+    """Adds both sides' changes up coin by coin. If that leaves a coin negative (say we spent
+    gold they broke into silver), the merge goes by total value instead, as few coins as possible.
+    Raises VersionConflictError when both sides together spent more than there was."""
+    coinlist = [dict(x) for x in ours.get("coinlist", ())]
+    types = [Coin.from_dict(x).type for x in coinlist]
+
+    def counts(purse: Mapping[str, Any]) -> Optional[List[int]]:
+        found = {x["type"]["uid"]: int(x["count"]) for x in purse.get("coinlist", ())}
+        if set(found) != {x.uid for x in types}:
+            return None
+        return [found[x.uid] for x in types]
+
+    old, new = counts(base), counts(theirs)
+    if old is None or new is None:
+        # the coin config changed underneath one of us, nothing lines up
+        return dict(ours)
+    mine = [int(x["count"]) for x in coinlist]
+    merged = [x + y - z for x, y, z in zip(new, mine, old)]
+    if any(x < 0 for x in merged):
+        # largest coin first, like the config orders them
+        order = sorted(range(len(types)), key=lambda x: types[x].rate)
+        denoms = Denominations([types[x] for x in order])
+        total = denoms.total([merged[x] for x in order])
+        if total < 0:
+            raise VersionConflictError()
+        for index, count in zip(order, denoms.expand(total)):
+            merged[index] = count
+    for coin, count in zip(coinlist, merged):
+        coin["count"] = count
+    return {**ours, "coinlist": coinlist}
@@ -0,0 +1,123 @@
+import re
+from array import array
+from fractions import Fraction
+from typing import TYPE_CHECKING, Dict, Iterator, Optional, Tuple, Union
+
+import cachetools
+import rapidfuzz
+
+if TYPE_CHECKING:
+    from utils.models.settings.coin import BaseCoin, CoinConfig, CoinType
+
+# amount := ["-"] number [unit], a unit runs up to the next number or sign ("2.5 gold piece")
+TOKEN = re.compile(
+    r"(?P<sign>-)?[\s.]*(?P<count>\d+(?:\.\d*)?|\.\d+)\s*\.?\s*(?P<unit>[a-zA-Z'][a-zA-Z' ]*)?"
+)
+
+# compiled parsers by config content, configs are interned so this is one per guild config
+_PARSERS: cachetools.LRUCache = cachetools.LRUCache(maxsize=256)
+
+
+def _normalize(unit: str) -> str:
+    return "".join(x for x in unit.lower() if x.isalpha())
+
+
+class _Node:
+    __slots__ = ("children", "type", "reachable")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_Node"] = {}
+        # the type spelled out up to here, if any
+        self.type: Optional[Union["CoinType", "BaseCoin"]] = None
+        # uid -> type of everything spelled out below here, for completing abbreviations
+        self.reachable: Dict[str, Union["CoinType", "BaseCoin"]] = {}
+
+
+class CoinParser:
+    """Turns amounts like `-5gp 3 sp 2.5 platinum` into a purse delta in one pass.
+
+    Units are matched on a trie of the config's names and prefixes (case and spaces ignored),
+    so an exact unit or an unambiguous abbreviation of one is a walk down the trie. Anything
+    else falls back to fuzzy matching like before. Matches are memoized per unit."""
+
+    def __init__(self, config: "CoinConfig") -> None:
+        self.config = config
+        self.root = _Node()
+        # exact prefixes win over exact names, then the config's order
+        for type in config:
+            self._insert(type.prefix, type)
+        for type in config:
+            self._insert(type.name, type)
+        self._choices = {}
+        for type in config:
+            self._choices.setdefault(type.name, type)
+            self._choices.setdefault(type.prefix, type)
+        # unit as typed -> type, people keep typing the same few
+        self._matched: cachetools.LRUCache = cachetools.LRUCache(maxsize=128)
+
+    @classmethod
+    def for_config(cls, config: "CoinConfig") -> "CoinParser":
+        parser = _PARSERS.get(config.key)
+        if parser is None or parser.config is not config:
+            parser = _PARSERS[config.key] = cls(config)
+        return parser
+
+    def _insert(self, key: str, type: Union["CoinType", "BaseCoin"]):
+        node = self.root
+        for char in _normalize(key):
+            node.reachable.setdefault(type.uid, type)
+            node = node.children.setdefault(char, _Node())
+        node.reachable.setdefault(type.uid, type)
+        if node.type is None:
+            node.type = type
+
+    # ==== matching ====
+    def match(self, unit: Optional[str]) -> Union["CoinType", "BaseCoin"]:
+        """The coin type a unit names, the base currency when there's none."""
+        type = self._matched.get(unit)
+        if type is None:
+            type = self._matched[unit] = self._match(unit)
+        return type
+
+    def _match(self, unit: Optional[str]) -> Union["CoinType", "BaseCoin"]:
+        key = _normalize(unit or "")
+        if not key:
+            return self.config.base
+        node = self.root
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                break
+        else:
+            if node.type is not None:
+                return node.type
+            if len(node.reachable) == 1:
+                return next(iter(node.reachable.values()))
+        choice = rapidfuzz.process.extractOne(unit.strip(), self._choices.keys())[0]
+        return self._choices[choice]
+
+    # ==== parsing ====
+    def tokens(self, input: str) -> Iterator[Tuple[bool, str, Optional[str]]]:
+        """(negative, count, unit) for every amount in input, anything else is skipped."""
+        for token in TOKEN.finditer(input):
+            yield token["sign"] is not None, token["count"], token["unit"]
+
+    def parse(
+        self, input: str, coerce_positive: bool = False, force_int: bool = False
+    ) -> array:
+        """Coin counts in the config's denomination order. Every amount is split into as few
+        coins as possible, none larger than the one it was given in."""
+        denoms = self.config.denominations
+        counts = array("q", bytes(8 * len(denoms.types)))
+        for negative, count, unit in self.tokens(input):
+            if force_int:
+                count = int(Fraction(count))
+            index = denoms.position(self.match(unit).uid)
+            if isinstance(count, str) and "." in count:
+                units = denoms.to_units(count, index)
+            else:
+                units = int(count) * denoms.units[index]
+            if negative and not coerce_positive:
+                units = -units
+            denoms.add(counts, units, index)
+        return counts
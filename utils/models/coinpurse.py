@@ -1,15 +1,14 @@
+from array import array
 from copy import deepcopy
-from math import ceil
-from typing import TYPE_CHECKING, Dict, List, Optional, Union
-
-import disnake
+from fractions import Fraction
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple, Union
 
 from utils.models.settings.coin import BaseCoin, CoinType
 
 if TYPE_CHECKING:
     from settings.guild import ServerSettings
 
-    from utils.models.settings.coin import CoinConfig
+    from utils.models.settings.coin import CoinConfig, Denominations
     from utils.models.settings.user import UserPreferences
 
 
@@ -215,7 +214,7 @@ class Coin(int):
 
     def to_dict(self):
         return {
-            "count": str(self),
+            "count": int(self),
             "base": self.base.to_dict(),
             "type": self.type.to_dict(),
             "isbase": self.isbase,
@@ -229,73 +228,156 @@ class Coin(int):
 
 
 # ==== CoinPurse ====
+def _zeros(length: int) -> array:
+    return array("q", bytes(8 * length))
+
+
+def _plan(
+    denoms: "Denominations", pairs: List[Tuple[Union["CoinType", "BaseCoin"], int]]
+) -> Tuple[int, List[Tuple[Optional[int], int]]]:
+    """What adding pairs to a purse of denoms takes, as its total in units and the steps
+    _run_steps makes: (index, count) per denomination, or (None, units) for coins of types
+    the config doesn't know, which get added by value."""
+    steps = []
+    total = 0
+    # whatever's being added can pay for what's being taken out
+    for type, count in sorted(pairs, key=lambda x: x[1] < 0):
+        if count == 0:
+            continue
+        index = denoms.index_of(type)
+        if index is None:
+            units = denoms.units_of(count, type)
+            steps.append((None, units))
+            total += units
+        else:
+            steps.append((index, count))
+            total += count * denoms.units[index]
+    return total, steps
+
+
 class CoinPurse:
+    """Coin counts and their last change as two int64 arrays, next to the coin types they're for.
+    Purses made from a config share its type list, so a purse costs a couple of small arrays
+    and arithmetic on it never builds Coin objects. Iterating one does hand out Coins
+    (copies, changing them doesn't change the purse)."""
+
+    __slots__ = ("config", "uprefs", "events", "types", "counts", "hist")
+
     def __init__(
         self,
         coinlist: List[Coin],
         config: "CoinConfig",
         uprefs: "UserPreferences" = None,
     ):
-        self.coinlist = coinlist
         self.config = config
         self.uprefs = uprefs
         self.events = []
+        self.coinlist = coinlist
+
+    @classmethod
+    def _new(
+        cls,
+        types: List[Union["CoinType", "BaseCoin"]],
+        counts: array,
+        hist: array,
+        config: "CoinConfig",
+        uprefs: "UserPreferences" = None,
+    ) -> "CoinPurse":
+        purse = cls.__new__(cls)
+        purse.config = config
+        purse.uprefs = uprefs
+        purse.events = []
+        purse.types, purse.counts, purse.hist = types, counts, hist
+        return purse
+
+    @property
+    def coinlist(self) -> List[Coin]:
+        return list(self)
+
+    @coinlist.setter
+    def coinlist(self, value: List[Coin]):
+        self.types = [x.type for x in value]
+        self.counts = array("q", (int(x) for x in value))
+        self.hist = array("q", (x.hist for x in value))
+
+    def copy(self) -> "CoinPurse":
+        return self._new(
+            self.types,
+            array("q", self.counts),
+            array("q", self.hist),
+            self.config,
+            self.uprefs,
+        )
 
     # ==== magic methods ====
     def __len__(self):
-        return self.coinlist.__len__()
+        return len(self.counts)
 
     def __repr__(self):
         return f"CoinPurse(coinlist={self.coinlist!r}, config={self.config!r})"
 
     def __iter__(self):
-        for x in self.coinlist:
-            yield x
+        for type, count, hist in zip(self.types, self.counts, self.hist):
+            yield Coin(count, self.config.base, type, history=hist)
 
     # ==== methods ====
     def combine_batch(self, coins_to_combine: Union["CoinPurse", Coin, List[Coin]]):
-        if isinstance(coins_to_combine, Coin):
-            coins_to_combine = [coins_to_combine]
-        elif isinstance(coins_to_combine, CoinPurse):
-            coins_to_combine = coins_to_combine.coinlist
         self._validate_self()
-        self.coinlist = self._start_math(coins_to_combine)
+        self._start_math(self._pairs(coins_to_combine))
         if self.uprefs.coinconvert:
             self._compaction_math()
 
+    @classmethod
+    def apply_many(
+        cls,
+        purses: Sequence["CoinPurse"],
+        coins_to_combine: Union["CoinPurse", Coin, List[Coin]],
+    ) -> List[bool]:
+        """combine_batch for many purses at once, i.e. a payout to a whole party. The coins
+        are resolved against each config once rather than once per purse, and what they cost
+        is checked in whole units. Purses that can't afford it are left alone and come back False."""
+        pairs = cls._pairs(coins_to_combine)
+        plans: Dict[int, Tuple[int, List[Tuple[Optional[int], int]]]] = {}
+        results = []
+        for purse in purses:
+            purse._validate_self()
+            denoms = purse.config.denominations
+            if id(denoms) not in plans:
+                plans[id(denoms)] = _plan(denoms, pairs)
+            cost, steps = plans[id(denoms)]
+            if cost < 0 and -cost > denoms.total(purse.counts):
+                results.append(False)
+                continue
+            purse._run_steps(steps)
+            if purse.uprefs.coinconvert:
+                purse._compaction_math()
+            results.append(True)
+        return results
+
     def set_coins(self, coins_to_set: Union["CoinPurse", Coin, List[Coin]]):
-        if isinstance(coins_to_set, Coin):
-            coins_to_set = [coins_to_set]
-        elif isinstance(coins_to_set, CoinPurse):
-            coins_to_set = coins_to_set.coinlist
         self._validate_self()
-        for setcoin in coins_to_set:
-            targindex, targcoin = next(
-                (index, coin)
-                for index, coin in enumerate(self.coinlist)
-                if setcoin.type.name == coin.type.name
-            )
-            setcoin.hist = int(setcoin) - int(targcoin)
-            self.coinlist[targindex] = abs(setcoin)
+        denoms = self.config.denominations
+        for type, count in self._pairs(coins_to_set):
+            index = denoms.position(self.config.by_name[type.name].uid)
+            self.hist[index] = count - self.counts[index]
+            self.counts[index] = abs(count)
 
     def force_positive(self):
-        for index, coin in enumerate(self.coinlist):
-            self.coinlist[index] = abs(coin)
+        for index, count in enumerate(self.counts):
+            self.counts[index] = abs(count)
 
     def force_negative(self):
-        for index, coin in enumerate(self.coinlist):
-            self.coinlist[index] = -abs(coin)
+        for index, count in enumerate(self.counts):
+            self.counts[index] = -abs(count)
 
     def positive(self) -> "CoinPurse":
-        newpurse = CoinPurse(self.coinlist, self.config, self.uprefs)
-        for index, coin in enumerate(newpurse.coinlist):
-            newpurse.coinlist[index] = abs(coin)
+        newpurse = self.copy()
+        newpurse.force_positive()
         return newpurse
 
     def negative(self) -> "CoinPurse":
-        newpurse = CoinPurse(self.coinlist, self.config, self.uprefs)
-        for index, coin in enumerate(newpurse.coinlist):
-            newpurse.coinlist[index] = -abs(coin)
+        newpurse = self.copy()
+        newpurse.force_negative()
         return newpurse
 
     def convert(self):
@@ -303,178 +385,92 @@ class CoinPurse:
         self._compaction_math()
 
     # ==== helpers ====
-    def _start_math(self, other: Union["CoinPurse", Coin, List[Coin]]):
-        freshcoins = self._sort_coins(x.copy_no_hist() for x in self.coinlist)
-        return self._add_coin(freshcoins, other)
+    @staticmethod
+    def _pairs(
+        coins: Union["CoinPurse", Coin, List[Coin]]
+    ) -> List[Tuple[Union["CoinType", "BaseCoin"], int]]:
+        if isinstance(coins, CoinPurse):
+            return list(zip(coins.types, coins.counts))
+        if isinstance(coins, Coin):
+            coins = [coins]
+        return [(x.type, int(x)) for x in coins]
+
+    def _start_math(self, other: List[Tuple[Union["CoinType", "BaseCoin"], int]]):
+        """Adds other to the (validated) purse in one pass over the rate vector,
+        coins of types this config doesn't know are added by value."""
+        self._run_steps(_plan(self.config.denominations, other)[1])
+
+    def _run_steps(self, steps: List[Tuple[Optional[int], int]]):
+        denoms = self.config.denominations
+        start = array("q", self.counts)
+        for index, count in steps:
+            if index is None:
+                denoms.add(self.counts, count)
+            elif count < 0:
+                denoms.subtract(self.counts, index, -count)
+            else:
+                self.counts[index] += count
+        for index, count in enumerate(self.counts):
+            self.hist[index] = count - start[index]
 
     def _validate_self(self):
         """This function is called to check that all Coin type data matches that contained
-        in self.config.
+        in self.config, leaving the purse with exactly the config's types in its order.
 
         Slight or partial mismatches (i.e. cointype has a matching name, but the rate is mismatched)
         should be soft corrected, value conversion should be unecessary in these situations.
 
         Complete mismatches (i.e. the cointype is completely unrecognized) are passed off to
         a converter function to convert it into an equal value of valid currency."""
-        newcoins: List[Coin] = []
-        unrecognized: List[Coin] = []
-        uidset = [cointype.uid for cointype in self.config]
-        for coin in self.coinlist:
-            coin = coin.copy_no_hist()
-
-            # if the uid isnt found in our set of valid uids for this server
-            # we append the coin to our list of unrecognized coins to be processed later
-            # we then continue the loop
-            if coin.uid not in uidset:
-                unrecognized.append(coin)
+        denoms = self.config.denominations
+        if self.types is denoms.types:
+            self.hist = _zeros(len(self.types))
+            return
+        counts = _zeros(len(denoms.types))
+        unrecognized = []
+        for type, count in zip(self.types, self.counts):
+            index = denoms.position(type.uid)
+            if index is None:
+                unrecognized.append((type, count))
                 continue
-
-            # check if the coins basetype matches, and update it if not
-            if coin.base != self.config.base:
-                coin.base = self.config.base
-
-            # check if the coins type perfectly matches one of the valid types for this server
-            # if not, we individually cheak each type attribute, update it, and register the change
-            # in an event dict for displaying changes to the user
-            elif not any(coin.type == cointype for cointype in self.config):
-                targettype = next(
-                    cointype for cointype in self.config if coin.uid == cointype.uid
-                )
-                eventdict = {}
-                if coin.type.name != targettype.name:
-                    eventdict["namechanged"] = {
-                        "old": coin.type.name,
-                        "new": targettype.name,
-                    }
-                    coin.type.name = targettype.name
-                if coin.type.prefix != targettype.prefix:
-                    eventdict["prefixchanged"] = {
-                        "old": coin.type.prefix,
-                        "new": targettype.prefix,
-                    }
-                    coin.type.prefix = targettype.prefix
-                if coin.type.rate != targettype.rate:
-                    eventdict["ratechanged"] = {
-                        "old": coin.type.rate,
-                        "new": targettype.rate,
+            # the type got edited since, register the changes in an event dict
+            # for displaying them to the user
+            target = denoms.types[index]
+            eventdict = {}
+            for attr in ("name", "prefix", "rate", "emoji"):
+                if getattr(type, attr) != getattr(target, attr):
+                    eventdict[f"{attr}changed"] = {
+                        "old": getattr(type, attr),
+                        "new": getattr(target, attr),
                     }
-                    coin.type.rate = targettype.rate
-                if coin.type.emoji != targettype.emoji:
-                    eventdict["emojichanged"] = {
-                        "old": coin.type.emoji,
-                        "new": targettype.emoji,
-                    }
-                    coin.type.emoji = targettype.emoji
-                if eventdict:
-                    self.events.append(eventdict)
-            newcoins.append(coin)
-
-        # next we want to check to make sure the coinpurse has a Coin object for each
-        # valid cointype in this server.
-        newcoin_names = [coin.type.name for coin in newcoins]
-        for cointype in filter(
-            lambda cointype: not cointype.name in newcoin_names,
-            self.config,
-        ):
-            newcoins.append(Coin(0, self.config.base, cointype))
-
+            if eventdict:
+                self.events.append(eventdict)
+            counts[index] += count
+        self.types, self.counts = denoms.types, counts
+        self.hist = _zeros(len(counts))
         # now we want to process any of the unrecognized coins
-        # that have piled up and add them to our coinlist
+        # that have piled up and add them to our coins
         if unrecognized:
-            self._compensate(newcoins, unrecognized)
+            self._compensate(unrecognized)
 
-        self.coinlist = self._sort_coins(x.copy_no_hist() for x in newcoins)
-
-    def _compensate(
-        self, coinlist: Union["CoinPurse", List[Coin]], oddcoinlist: List[Coin]
-    ):
+    def _compensate(self, oddcoins: List[Tuple[Union["CoinType", "BaseCoin"], int]]):
         """When an unrecognizable coin is found, this function is called to convert it
         into recognized currency as close to the original value as possible."""
-        for oddcoin in oddcoinlist:
-            if targetcoin := disnake.utils.get(coinlist, type__name=oddcoin.type.name):
-                targetcoin += int(oddcoin)
-                continue
-            valdict = self.valuedict_from_count(
-                int(oddcoin) / oddcoin.type.rate,
-                self.config.base,
-                self.config,
-                capped=False,
-            )
-            oddcoinlist = self._start_math(self.from_simple_dict(valdict, self.config))
-
-    def _add_coin(self, coinlist: List[Coin], other: Union["CoinPurse", List[Coin]]):
-        for otherindex, othercoin in enumerate(other):
-            if othercoin == 0:
-                continue
-            try:
-                targetindex = next(
-                    coinindex
-                    for coinindex, coin in enumerate(coinlist)
-                    if coin.type.name == othercoin.type.name
-                )
-            except StopIteration:
-                coinlist.append(
-                    Coin(
-                        int(othercoin),
-                        self.config.base,
-                        othercoin.type,
-                        history=int(othercoin),
-                    )
-                )
-                coinlist = self._sort_coins(coinlist)
-                continue
-            if othercoin < 0:
-                subbed = self._sub_coin(coinlist, othercoin, targetindex)
-                coinlist = self._sort_coins(subbed)
-            elif othercoin > 0:
-                coinlist[targetindex] += othercoin
-        return coinlist
-
-    def _sub_coin(self, coinlist: List[Coin], other: Coin, targetindex: int):
-        while coinlist[targetindex] > 0 and other < 0:
-            if coinlist[targetindex] >= abs(other):
-                coinlist[targetindex] += other
-                other += abs(other)
-            elif coinlist[targetindex] < abs(other):
-                other += coinlist[targetindex]
-                coinlist[targetindex] -= coinlist[targetindex]
+        denoms = self.config.denominations
+        for type, count in oddcoins:
+            # same name, it probably just got a new uid
+            match = self.config.by_name.get(type.name)
+            if match is not None:
+                index = denoms.position(match.uid)
+                self.counts[index] += count
             else:
-                coinlist[targetindex] -= 1
-                other += 1
-        if other > -1:
-            return coinlist
-        thievery = next(
-            x for x, y in reversed(list(enumerate(coinlist[:targetindex]))) if y > 0
-        )
-        x = (1 / coinlist[thievery].type.rate) * other.type.rate
-        amt = ceil(abs(other) / x)
-        return self._add_coin(
-            coinlist,
-            self._sort_coins(
-                [
-                    other,
-                    Coin(int(amt * x), self.config.base, other.type),
-                    Coin(-int(amt), self.config.base, coinlist[thievery].type),
-                ]
-            ),
-        )
+                denoms.add(self.counts, denoms.units_of(count, type))
 
     def _compaction_math(self):
-        typelist = list(reversed(self.config))[1:]
-        conlist = list(reversed(self.coinlist))
-        for index, (coin, ctype) in enumerate(zip(conlist, typelist)):
-            stepupcost = int((1 / ctype.rate) * coin.type.rate)
-            conlist[index + 1] += Coin(int(coin) // stepupcost, coin.base, ctype)
-            conlist[index] -= Coin(
-                int(coin) - (int(coin) % stepupcost), coin.base, coin.type
-            )
-        self.coinlist = self._sort_coins(conlist)
-
-    @staticmethod
-    def _sort_coins(coinlist: List[Coin]) -> List[Coin]:
-        return sorted(
-            coinlist, key=lambda i: (i.type.rate, i.type.name, i.type.prefix, -i)
-        )
+        start = array("q", self.counts)
+        self.config.denominations.compact(self.counts)
+        for index, count in enumerate(self.counts):
+            self.hist[index] += count - start[index]
 
     @staticmethod
     def valuedict_from_count(
@@ -483,48 +479,34 @@ class CoinPurse:
         config: "CoinConfig",
         capped: bool = True,
     ) -> Dict[str, int]:
-        count = float(count)  # JIC typecast
-        result = {}
-        smallestcoin = next(reversed(config))
-        minval = int((count / type.rate) * smallestcoin.rate)
-        found_start = False
-        for cointype in config:
-            if (
-                (not capped)
-                or found_start
-                or (found_start := (cointype.name == type.name))
-            ):
-                val_in_smallest = (1 / cointype.rate) * smallestcoin.rate
-                tempvar, minval = (
-                    int(minval / val_in_smallest),
-                    minval % val_in_smallest,
-                )
-                result[cointype.prefix] = tempvar
-                minval *= -1 if count < 0 else 1
-            else:
-                result[cointype.prefix] = 0
-        return result
+        """Splits count coins of type into as few coins as possible, only using coins up to
+        type's size when capped. Whatever's smaller than the smallest coin is dropped."""
+        denoms = config.denominations
+        index = denoms.index_of(type)
+        if index is None:
+            units = denoms.units_of(Fraction(str(count)), type)
+            index = 0
+        else:
+            units = denoms.to_units(count, index)
+        counts = denoms.expand(units, index if capped else 0)
+        return {x.prefix: y for x, y in zip(denoms.types, counts)}
 
     # ==== properties ====
     @property
     def base(self) -> Coin:
-        return self.coinlist[
-            next(
-                x for x, y in enumerate(self.coinlist) if isinstance(y.type, "BaseCoin")
-            )
-        ]
+        return next(x for x in self if isinstance(x.type, BaseCoin))
 
     @property
     def baseval(self) -> float:
-        return float(sum(x.value for x in self.coinlist))
+        return self.config.denominations.value(self.types, self.counts)
 
     @property
     def basechangeval(self) -> float:
-        return float(sum(x.histbaseval for x in self.coinlist))
+        return self.config.denominations.value(self.types, self.hist)
 
     @property
     def display_operation(self) -> str:
-        return "\n".join(x.full_operation_str for x in self.coinlist)
+        return "\n".join(x.full_operation_str for x in self)
 
     @property
     def display_total(self) -> str:
@@ -541,30 +523,63 @@ class CoinPurse:
     # ==== lifecycle ====
     @classmethod
     def from_simple_dict(cls, input: Dict[str, int], config: "CoinConfig"):
-        return cls(
-            cls._sort_coins(
-                Coin(
-                    y,
-                    config.base,
-                    disnake.utils.find(lambda ctype: ctype.prefix == x, config),
-                )
-                for x, y in input.items()
-            ),
-            config,
-        )
+        denoms = config.denominations
+        counts = _zeros(len(denoms.types))
+        for prefix, count in input.items():
+            index = denoms.position(config.by_prefix.get(prefix, config.base).uid)
+            counts[index] += int(count)
+        return cls.from_counts(counts, config)
+
+    @classmethod
+    def from_counts(cls, counts: Sequence[int], config: "CoinConfig"):
+        """A purse holding counts of the config's denominations, in their order."""
+        denoms = config.denominations
+        return cls._new(denoms.types, array("q", counts), _zeros(len(counts)), config)
 
     @classmethod
     def from_dict(cls, input: Dict[str, Union[List[Coin], "CoinConfig"]]):
+        """Coin types matching the config's are shared with it rather than rebuilt,
+        when all of them do (the usual case) the purse shares the config's type list."""
+        config: "CoinConfig" = input["config"]
+        denoms = config.denominations
         if "coinlist" not in input:
-            input["coinlist"] = [
-                Coin(0, base=input["config"].base, type=x) for x in input["config"]
-            ]
-        else:
-            input["coinlist"] = [Coin.from_dict(x) for x in input["coinlist"]]
-        return CoinPurse(**input)
+            length = len(denoms.types)
+            return cls._new(
+                denoms.types,
+                _zeros(length),
+                _zeros(length),
+                config,
+                input.get("uprefs"),
+            )
+        types = []
+        for coin in input["coinlist"]:
+            index = denoms.position(coin["type"]["uid"])
+            if index is not None and _same_type(denoms.types[index], coin):
+                types.append(denoms.types[index])
+            elif coin["isbase"]:
+                types.append(BaseCoin.from_dict(coin["type"]))
+            else:
+                types.append(CoinType.from_dict(coin["type"]))
+        if len(types) == len(denoms.types) and all(
+            x is y for x, y in zip(types, denoms.types)
+        ):
+            types = denoms.types
+        counts = array("q", (int(x["count"]) for x in input["coinlist"]))
+        return cls._new(types, counts, _zeros(len(counts)), config, input.get("uprefs"))
 
     def to_dict(self):
-        return {"coinlist": [x.to_dict() for x in self.coinlist]}
+        base = self.config.base.to_dict()
+        return {
+            "coinlist": [
+                {
+                    "count": count,
+                    "base": base,
+                    "type": type.to_dict(),
+                    "isbase": isinstance(type, BaseCoin),
+                }
+                for type, count in zip(self.types, self.counts)
+            ]
+        }
 
     # ==== pydantic jank ====
     @classmethod
@@ -574,3 +589,15 @@ class CoinPurse:
             if not isinstance(cls, CoinPurse)
             else cls.from_dict(input)
         )
+
+
+def _same_type(type: Union["CoinType", "BaseCoin"], coin: Dict[str, Any]) -> bool:
+    """Whether a stored coin's type is exactly type."""
+    data = coin["type"]
+    return (
+        coin["isbase"] == isinstance(type, BaseCoin)
+        and data["name"] == type.name
+        and data["prefix"] == type.prefix
+        and data.get("rate", 1.0) == type.rate
+        and data.get("emoji") == type.emoji
+    )
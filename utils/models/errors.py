@@ -55,3 +55,12 @@ class MissingCharacterDataError(LabyrinthianException):
 
     def __init__(self):
         super().__init__("It seems that characters data is missing, or lost.")
+
+
+class VersionConflictError(LabyrinthianException):
+    """Raised when a versioned write loses the race against another write to the same document."""
+
+    def __init__(self, msg=None):
+        super().__init__(
+            msg or "Someone else changed this at the same time, please try that again."
+        )
@@ -1,4 +1,5 @@
-from typing import Dict, List, Union
+import bisect
+from typing import Dict, List, Optional, Tuple, Union
 
 from utils.models.errors import IntegerConversionError, LabyrinthianException
 
@@ -51,6 +52,26 @@ class XPConfig:
     def __init__(self, fields: List[XPField]):
         self.fields = fields
 
+    @property
+    def fields(self) -> List[XPField]:
+        return self._fields
+
+    @fields.setter
+    def fields(self, value: List[XPField]):
+        self._fields = value
+        # (sorted thresholds, their level names), built on the first level_for
+        self._levels: Optional[Tuple[List[int], List[str]]] = None
+
+    def level_for(self, xp: float) -> str:
+        """The name of the highest level xp reaches, "1" while it's below every requirement."""
+        if self._levels is None:
+            # stable, so of two levels with the same requirement the later one still wins
+            ordered = sorted(self.fields, key=int)
+            self._levels = ([int(x) for x in ordered], [x.name for x in ordered])
+        thresholds, names = self._levels
+        index = bisect.bisect_right(thresholds, xp)
+        return names[index - 1] if index else "1"
+
     def __iter__(self):
         for x in self.fields:
             yield x
@@ -1,5 +1,21 @@
-from typing import Dict, Generator, Iterator, List, Union
+import math
 import uuid
+from fractions import Fraction
+from typing import (
+    Any,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    MutableSequence,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+from weakref import WeakValueDictionary
 
 
 class CoinType:
@@ -110,34 +126,186 @@ class BaseCoin:
         return f"BaseCoin(name={self.name!r}, prefix={self.prefix!r}, rate={self.rate}, uid={self.uid!r})"
 
 
+class Denominations:
+    """A coin config's denominations as whole multiples of the smallest unit of value
+    the config can express, largest first (the same order as iterating the config).
+
+    Purses are summed into one integer count of that unit and split back out with divmod,
+    so nothing in here ever touches a float and every operation is O(denominations).
+    Counts are changed in place, they're the arrays CoinPurse keeps them in."""
+
+    def __init__(self, types: Sequence[Union[CoinType, BaseCoin]]) -> None:
+        self.types = list(types)
+        # what one coin is worth in the base currency, exactly. str() so 0.1 stays 1/10
+        values = [1 / Fraction(str(x.rate)) for x in self.types]
+        denominator = math.lcm(*(x.denominator for x in values))
+        numerators = [int(x * denominator) for x in values]
+        unit = math.gcd(*numerators)
+        self.units = [x // unit for x in numerators]
+        self.per_base = denominator // unit
+        self._index = {x.uid: index for index, x in enumerate(self.types)}
+
+    def position(self, uid: str) -> Optional[int]:
+        return self._index.get(uid)
+
+    def index_of(self, type: Union[CoinType, BaseCoin]) -> Optional[int]:
+        """Where type sits in the rate vector, None if it isn't one of these (or its rate moved)."""
+        index = self._index.get(type.uid)
+        if index is None or self.types[index].rate != type.rate:
+            return None
+        return index
+
+    def to_units(self, count: Union[int, float, str], index: int) -> int:
+        """count coins of one denomination in units, truncated like int() would."""
+        return int(Fraction(str(count)) * self.units[index])
+
+    def units_of(
+        self, count: Union[int, Fraction], type: Union[CoinType, BaseCoin]
+    ) -> int:
+        """count coins of a type that isn't one of these in units, by value."""
+        return int(Fraction(count) / Fraction(str(type.rate)) * self.per_base)
+
+    def total(self, counts: Sequence[int]) -> int:
+        return sum(x * y for x, y in zip(counts, self.units))
+
+    def value(
+        self, types: Sequence[Union[CoinType, BaseCoin]], counts: Sequence[int]
+    ) -> float:
+        """What counts of types are worth in the base currency."""
+        if types is self.types:
+            return self.total(counts) / self.per_base
+        units = 0
+        other = Fraction(0)
+        for type, count in zip(types, counts):
+            index = self.index_of(type)
+            if index is None:
+                other += Fraction(count) / Fraction(str(type.rate))
+            else:
+                units += count * self.units[index]
+        return float(Fraction(units, self.per_base) + other)
+
+    def expand(self, units: int, start: int = 0) -> List[int]:
+        """Splits units into as few coins as possible, none larger than the start denomination."""
+        counts = [0] * len(self.types)
+        self.add(counts, units, start)
+        return counts
+
+    def add(self, counts: MutableSequence[int], units: int, start: int = 0):
+        """Adds units as as few coins as possible, none larger than the start denomination.
+        Whatever's smaller than the smallest coin is dropped."""
+        sign = -1 if units < 0 else 1
+        units = abs(units)
+        for index in range(start, len(self.types)):
+            if not units:
+                break
+            count, units = divmod(units, self.units[index])
+            counts[index] += sign * count
+
+    def compact(self, counts: MutableSequence[int]):
+        total = self.total(counts)
+        for index in range(len(counts)):
+            counts[index] = 0
+        self.add(counts, total)
+
+    def subtract(self, counts: MutableSequence[int], index: int, count: int):
+        """Takes count coins of one denomination out. When there aren't enough of them
+        the nearest larger coin gets broken, with the change in the denomination that was
+        short, working up one denomination at a time. Smaller coins only get broken once
+        every larger one is gone, and if the whole purse can't cover it nothing gets broken,
+        the denomination just goes negative."""
+        if self.total(counts) < count * self.units[index]:
+            counts[index] -= count
+            return
+        taken = max(min(counts[index], count), 0)
+        counts[index] -= taken
+        owed = (count - taken) * self.units[index]
+        if not owed:
+            return
+        larger = range(index - 1, -1, -1)
+        if sum(counts[x] * self.units[x] for x in larger if counts[x] > 0) >= owed:
+            short = index
+            for other in larger:
+                if counts[other] <= 0:
+                    continue
+                broken = -(-owed // self.units[other])
+                self.add(counts, broken * self.units[other] - owed, short)
+                if counts[other] >= broken:
+                    counts[other] -= broken
+                    return
+                owed = (broken - counts[other]) * self.units[other]
+                counts[other] = 0
+                short = other
+        for other in larger:
+            if counts[other] > 0:
+                owed -= counts[other] * self.units[other]
+                counts[other] = 0
+        for other in range(index + 1, len(counts)):
+            if owed <= 0:
+                break
+            if counts[other] <= 0:
+                continue
+            broken = min(counts[other], -(-owed // self.units[other]))
+            counts[other] -= broken
+            owed -= broken * self.units[other]
+            self.add(counts, max(-owed, 0), other + 1)
+
+
+def _sort_key(type: Union[CoinType, BaseCoin]):
+    return type.rate, type.name, type.prefix
+
+
+# every config in use, by content. Entries go away with the last config referencing them
+_CONFIGS: "WeakValueDictionary[Tuple, CoinConfig]" = WeakValueDictionary()
+
+
 class CoinConfig:
-    def __init__(self, base: BaseCoin, types: List[CoinType]) -> None:
+    """A guild's currencies. Configs are immutable and interned by content (from_dict and
+    intern hand out the one instance per content), so every settings object, character and
+    purse of a guild shares one, along with its sorted views, lookup tables and rate vector.
+    Edits make a new config with replace(). Don't change the types in place either."""
+
+    def __init__(self, base: BaseCoin, types: Iterable[CoinType]) -> None:
         self.base = base
-        self.types = sorted(types, key=lambda i: (i.rate, i.name, i.prefix))
+        self.types: Tuple[CoinType, ...] = tuple(sorted(types, key=_sort_key))
+        self._sorted = tuple(sorted((base, *self.types), key=_sort_key))
+        self.by_uid: Dict[str, Union[CoinType, BaseCoin]] = {}
+        self.by_name: Dict[str, Union[CoinType, BaseCoin]] = {}
+        self.by_prefix: Dict[str, Union[CoinType, BaseCoin]] = {}
+        for x in self._sorted:
+            self.by_uid.setdefault(x.uid, x)
+            self.by_name.setdefault(x.name, x)
+            self.by_prefix.setdefault(x.prefix, x)
+        self.key = (
+            _base_key(base.to_dict()),
+            frozenset(_type_key(x.to_dict()) for x in self.types),
+        )
+        self._denominations: Optional[Denominations] = None
+
+    @classmethod
+    def intern(cls, base: BaseCoin, types: Iterable[CoinType]) -> "CoinConfig":
+        config = cls(base, types)
+        return _CONFIGS.setdefault(config.key, config)
+
+    def replace(self, types: Iterable[CoinType]) -> "CoinConfig":
+        """This config with other types."""
+        return self.intern(self.base, types)
+
+    @property
+    def denominations(self) -> Denominations:
+        if self._denominations is None:
+            self._denominations = Denominations(self._sorted)
+        return self._denominations
 
     def __iter__(self) -> Iterator[CoinType | BaseCoin]:
-        templist = sorted(
-            (self.base, *self.types), key=lambda i: (i.rate, i.name, i.prefix)
-        )
-        for x in templist:
-            yield x
+        return iter(self._sorted)
 
     def __reversed__(self):
-        templist = sorted(
-            (self.base, *self.types),
-            key=lambda i: (i.rate, i.name, i.prefix),
-            reverse=True,
-        )
-        for x in templist:
-            yield x
-
-    def sort_items(self):
-        self.types = sorted(self.types, key=lambda i: (i.rate, i.name, i.prefix))
+        return reversed(self._sorted)
 
     def gen_coinpurse_dict(self) -> Generator[Dict, None, None]:
         for x in self:
             yield {
-                "count": str(0),
+                "count": 0,
                 "base": self.base.to_dict(),
                 "type": x.to_dict(),
                 "isbase": True if isinstance(x, BaseCoin) else False,
@@ -150,8 +318,18 @@ class CoinConfig:
             str, Union[Dict[str, str], List[Dict[str, Union[str, float, int]]]]
         ],
     ):
+        if input["basecoin"].get("uid") and all(
+            x.get("uid") for x in input["cointypes"]
+        ):
+            key = (
+                _base_key(input["basecoin"]),
+                frozenset(_type_key(x) for x in input["cointypes"]),
+            )
+            config = _CONFIGS.get(key)
+            if config is not None:
+                return config
         types = [CoinType(**x) for x in input["cointypes"]]
-        return cls(BaseCoin(**input["basecoin"]), types)
+        return cls.intern(BaseCoin(**input["basecoin"]), types)
 
     def to_dict(self):
         return {
@@ -168,7 +346,21 @@ class CoinConfig:
         )
 
     def __deepcopy__(self, _):
-        return CoinConfig(self.base, self.types)
+        return self
 
     def __repr__(self) -> str:
         return f"CoinConfig(base={self.base!r}, types={self.types!r})"
+
+
+def _base_key(data: Mapping[str, Any]) -> Tuple:
+    return data["name"], data["prefix"], data.get("emoji"), data.get("uid")
+
+
+def _type_key(data: Mapping[str, Any]) -> Tuple:
+    return (
+        data["name"],
+        data["prefix"],
+        data["rate"],
+        data.get("emoji"),
+        data.get("uid"),
+    )
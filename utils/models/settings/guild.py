@@ -1,7 +1,8 @@
-from typing import TYPE_CHECKING, List, Optional, Union
+from typing import TYPE_CHECKING, List, Optional, Set, Union
 
 import disnake
-from utils.models import LabyrinthianBaseModel
+from pydantic import PrivateAttr
+from utils.models import LabyrinthianBaseModel, document_diff
 from utils.models.coinpurse import Coin
 from utils.models.settings.auction import ListingDurationsConfig, RaritiesConfig
 from utils.models.settings.charlog import XPConfig
@@ -270,7 +271,15 @@ DEFAULT_THRESHOLD = {
 }
 
 
+# fees and thresholds are counted in the server's coins, so they get re-resolved
+# and written again whenever the coin config changes
+COIN_DEPENDENT_SETTINGS = ("listingdurs", "rarities", "outbidthreshold")
+
+
 class ServerSettings(LabyrinthianBaseModel):
+    # settings that were reassigned or flagged since the last commit
+    _dirty: Set[str] = PrivateAttr(default_factory=set)
+
     guild: str
     dmroles: Optional[List[Union[str, int]]] = []
     classlist: List[str] = DEFAULT_CLASS_LIST
@@ -322,6 +331,9 @@ class ServerSettings(LabyrinthianBaseModel):
         if data is None:
             wasnone = True
             data = {"guild": guild}
+        else:
+            # shallow copy of the cached view, validation replaces the top level fields
+            data = {**data, "_base": data}
         return (data, wasnone)
 
     @classmethod
@@ -340,29 +352,56 @@ class ServerSettings(LabyrinthianBaseModel):
             if hasattr(x, "cascade_guildid"):
                 x.cascade_guildid()
 
-    def run_updates(self):
-        for x in self:
+    def run_updates(self, fields=None):
+        for field in self.__fields__ if fields is None else fields:
+            x = getattr(self, field)
             if hasattr(x, "run_updates") and callable(x.run_updates):
                 x.run_updates()
             elif hasattr(x, "update_types") and callable(x.update_types):
                 x.update_types()
 
     def dict(self, *args, **kwargs):
-        data = super().dict()
-        data["xptemplate"] = self.xptemplate.to_dict()
-        data["coinconf"] = self.coinconf.to_dict()
-        data["listingdurs"] = self.listingdurs.to_dict()
-        data["rarities"] = self.rarities.to_dict()
-        data["outbidthreshold"] = self.outbidthreshold.to_dict()
+        data = super().dict(*args, **kwargs)
+        for field in (
+            "xptemplate",
+            "coinconf",
+            "listingdurs",
+            "rarities",
+            "outbidthreshold",
+        ):
+            if field in data:
+                data[field] = getattr(self, field).to_dict()
         return data
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in self.__fields__:
+            self.mark_dirty(name)
+
+    def mark_dirty(self, *fields: str):
+        """Flags settings for the next commit, for configs that were changed in place."""
+        for field in fields:
+            self._dirty.add(field)
+            if field == "coinconf":
+                self._dirty.update(COIN_DEPENDENT_SETTINGS)
+
     async def commit(self, db):
-        """Commits the settings to the database."""
-        self.run_updates()
-        data = self.dict()
-        await db.update_one(
-            "srvconf", {"guild": self.guild}, {"$set": data}, upsert=True
-        )
+        """Commits the settings that changed since they were loaded to the database.
+        Only the dirty ones get serialized, unless the guild has no document yet."""
+        fields = set(self.__fields__) if self._base is None else set(self._dirty)
+        if not fields:
+            return None
+        self.run_updates(fields)
+        data = self.dict(include=fields)
+        changes = document_diff(self._base, data)
+        result = None
+        if changes:
+            result = await db.update_one(
+                "srvconf", {"guild": self.guild}, {"$set": changes}, upsert=True
+            )
+        self._base = {**(self._base or {}), **data}
+        self._dirty.difference_update(fields)
+        return result
 
     @classmethod
     def no_validate(cls, data):
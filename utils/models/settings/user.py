@@ -2,7 +2,7 @@ from typing import TYPE_CHECKING, Any, Dict, NewType, Optional
 
 from bson import ObjectId
 
-from utils.models import LabyrinthianBaseModel
+from utils.models import LabyrinthianBaseModel, document_diff
 
 if TYPE_CHECKING:
     ObjID = ObjectId
@@ -44,19 +44,30 @@ class UserPreferences(LabyrinthianBaseModel):
         if data is None:
             wasnone = True
             data = {"user": user}
+        else:
+            # shallow copy of the cached view, validation replaces the top level fields
+            data = {**data, "_base": data}
         return (data, wasnone)
 
     async def commit(self, db):
-        """Commits the settings to the database."""
+        """Commits the settings that changed since they were loaded to the database."""
         data = self.dict()
-        await db.update_one(
-            "userprefs", {"user": self.user}, {"$set": data}, upsert=True
+        changes = document_diff(self._base, data)
+        if not changes:
+            return None
+        result = await db.update_one(
+            "userprefs", {"user": self.user}, {"$set": changes}, upsert=True
         )
+        self._base = data
+        return result
 
     async def refresh_chardat(self, bot: "Labyrinthian"):
-        chardat = (
-            await bot.sdb["charactercollection"].find({"user": self.user}).sort("guild")
-        ).to_list(None)
+        chardat = [
+            x
+            async for x in bot.dbcache.find_many(
+                "charactercollection", {"user": self.user}, projection=("guild", "name")
+            )
+        ]
         for guild in list(self.characters.keys()):
             match = bot.get_guild(int(guild))
             self.characters.pop(guild)
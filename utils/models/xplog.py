@@ -1,12 +1,16 @@
+import asyncio
 import math
-from typing import TYPE_CHECKING, Any, Generator, List, NewType, Tuple
+from typing import TYPE_CHECKING, Any, Dict, List, Mapping, NewType, Optional, Tuple
 
 from bson import ObjectId
+from pymongo import ReturnDocument
 from utils.models import LabyrinthianBaseModel
 
 if TYPE_CHECKING:
     ObjID = ObjectId
     from pymongo.results import InsertOneResult
+
+    from utils.models.settings.charlog import XPConfig
 else:
     ObjID = Any
 
@@ -15,6 +19,8 @@ UserID = NewType("UserID", str)
 DMUID = NewType("DMUID", str)
 GuildID = NewType("GuildID", str)
 CharacterName = NewType("CharacterName", str)
+# where an entry sits in the log, timestamps alone can tie
+LogKey = Tuple[int, ObjectId]
 
 
 class XPLogEntry(LabyrinthianBaseModel):
@@ -28,38 +34,278 @@ class XPLogEntry(LabyrinthianBaseModel):
     timestamp: int
 
     # ==== database ====
-    async def commit(self, db):
-        """Commits the settings to the database."""
+    async def commit(self, sdb, xptemplate: Optional["XPConfig"] = None):
+        """Commits the entry to the database and adds it to the character's and guild's XPStats.
+        With the guild's xptemplate the character's level gets materialized too.
+        Neither goes through dbcache, entries are never read back by _id and the stats are
+        counters a write-back of an older cached copy would undo."""
         data = self.dict()
-        result: "InsertOneResult" = await db.insert_one("xplog", data)
+        result: "InsertOneResult" = await sdb["xplog"].insert_one(data)
+        await self.update_stats(sdb, result.inserted_id, xptemplate)
         return result
 
+    async def update_stats(
+        self, sdb, entry: ObjectId, xptemplate: Optional["XPConfig"] = None
+    ):
+        """Adds the entry with id entry to the stats. Whatever the guild logged before its
+        stats existed is left to XPStats.rebuild."""
+        update = {
+            "$inc": {
+                "gained": max(self.xpadded, 0),
+                "lost": max(-self.xpadded, 0),
+                "entries": 1,
+            },
+            "$set": {
+                f"dms.{self.dm}": {
+                    "xp": self.xpadded,
+                    "timestamp": self.timestamp,
+                    "charref": self.charref,
+                }
+            },
+        }
+        charupdate = update
+        if xptemplate is not None:
+            level = xptemplate.level_for(self.prevxp + self.xpadded)
+            charupdate = {**update, "$set": {**update["$set"], "level": level}}
+        await asyncio.gather(
+            sdb["xpstats"].update_one(
+                {"guild": self.guild, "charref": self.charref},
+                charupdate,
+                upsert=True,
+            ),
+            sdb["xpstats"].update_one(
+                {"guild": self.guild, "charref": None},
+                {**update, "$setOnInsert": {"since": entry}},
+                upsert=True,
+            ),
+        )
+
+
+class LastAward(LabyrinthianBaseModel):
+    xp: float
+    timestamp: int
+    charref: ObjID
+
+
+class XPStats(LabyrinthianBaseModel):
+    """Running totals over a character's xp log, or with no charref, over a whole guild's.
+    XPLogEntry.commit keeps them current so nothing has to scan xplog to answer these."""
+
+    guild: GuildID
+    charref: Optional[ObjID] = None
+    gained: float = 0
+    lost: float = 0
+    entries: int = 0
+    # expected level after the newest entry, characters only
+    level: Optional[str] = None
+    # the newest award each dm gave
+    dms: Dict[DMUID, LastAward] = {}
+    # guild only, the first entry counted as it got logged and whether rebuild
+    # has counted the ones before it
+    since: Optional[ObjID] = None
+    rebuilt: bool = False
+
+    @classmethod
+    async def find(
+        cls, sdb, guild: str, charref: Optional[ObjectId] = None
+    ) -> Optional["XPStats"]:
+        data = await sdb["xpstats"].find_one({"guild": guild, "charref": charref})
+        return None if data is None else cls.parse_obj(data)
+
+    @classmethod
+    async def rebuild(cls, sdb, guild: str, xptemplate: Optional["XPConfig"] = None):
+        """Counts the entries a guild logged before it had stats, one aggregation over xplog.
+        Runs once per guild (see Labyrinthian.setup_database), the guild document marks it done.
+        The counts get added to what's there, so entries logged meanwhile aren't lost."""
+        ensured = await sdb["xpstats"].find_one_and_update(
+            {"guild": guild, "charref": None},
+            {"$setOnInsert": {"since": ObjectId()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if ensured.get("rebuilt"):
+            return
+        pipeline = [
+            {"$match": {"guild": guild, "_id": {"$lt": ensured["since"]}}},
+            {"$sort": {"timestamp": 1, "_id": 1}},
+            {
+                "$group": {
+                    "_id": {"charref": "$charref", "dm": "$dm"},
+                    "gained": {"$sum": {"$max": ["$xpadded", 0]}},
+                    "lost": {"$sum": {"$max": [{"$multiply": ["$xpadded", -1]}, 0]}},
+                    "entries": {"$sum": 1},
+                    "xp": {"$last": "$xpadded"},
+                    "timestamp": {"$last": "$timestamp"},
+                    "total": {"$last": {"$add": ["$prevxp", "$xpadded"]}},
+                }
+            },
+        ]
+        stats: Dict[Any, Dict[str, Any]] = {}
+        totals: Dict[Any, Tuple[int, float]] = {}
+        async for group in sdb["xplog"].aggregate(pipeline):
+            charref, dm = group["_id"]["charref"], group["_id"]["dm"]
+            award = {
+                "xp": group["xp"],
+                "timestamp": group["timestamp"],
+                "charref": charref,
+            }
+            for ref in (charref, None):
+                data = stats.setdefault(
+                    ref, {"gained": 0, "lost": 0, "entries": 0, "dms": {}}
+                )
+                data["gained"] += group["gained"]
+                data["lost"] += group["lost"]
+                data["entries"] += group["entries"]
+                if award["timestamp"] >= data["dms"].get(dm, award)["timestamp"]:
+                    data["dms"][dm] = award
+            if group["timestamp"] >= totals.get(charref, (group["timestamp"],))[0]:
+                totals[charref] = (group["timestamp"], group["total"])
+        if xptemplate is not None:
+            for charref, (_, total) in totals.items():
+                stats[charref]["level"] = xptemplate.level_for(total)
+        # the guild document goes first, whoever gets to mark it rebuilt writes the rest
+        guildstats = stats.pop(None, {"gained": 0, "lost": 0, "entries": 0, "dms": {}})
+        claimed = await sdb["xpstats"].update_one(
+            {"guild": guild, "charref": None, "rebuilt": {"$ne": True}},
+            [{"$set": {**cls._merge(guildstats), "rebuilt": True}}],
+        )
+        if not claimed.matched_count:
+            return
+        await asyncio.gather(
+            *(
+                sdb["xpstats"].update_one(
+                    {"guild": guild, "charref": charref},
+                    [{"$set": cls._merge(data)}],
+                    upsert=True,
+                )
+                for charref, data in stats.items()
+            )
+        )
+
+    @staticmethod
+    def _merge(data: Dict[str, Any]) -> Dict[str, Any]:
+        """Pipeline stage adding rebuilt counts to a stats document. Awards and levels from
+        entries logged since are newer, so those win."""
+        merged = {
+            x: {"$add": [{"$ifNull": [f"${x}", 0]}, data[x]]}
+            for x in ("gained", "lost", "entries")
+        }
+        merged["dms"] = {
+            "$mergeObjects": [{"$literal": data["dms"]}, {"$ifNull": ["$dms", {}]}]
+        }
+        if data.get("level") is not None:
+            merged["level"] = {"$ifNull": ["$level", {"$literal": data["level"]}]}
+        return merged
 
-class XPLogBook(LabyrinthianBaseModel):
-    log: List[XPLogEntry]
+
+class XPLogBook:
+    """A character's xp log, newest first, fetched a page at a time with range queries on
+    the (charref, timestamp, _id) index so opening it costs the same however long the log is.
+    The page after the one shown (in the direction the menu is going) gets prefetched."""
+
+    def __init__(self, db, charref: ObjectId, total: int, per_page: int = 4) -> None:
+        self.collection = db["xplog"]
+        self.charref = charref
+        # counted once on open, entries logged while the menu is up show up on the next one
+        self.total = total
+        self.per_page = per_page
+        # page number -> (entries, (timestamp, _id) of its newest and oldest entry)
+        self._pages: Dict[int, Tuple[List[XPLogEntry], LogKey, LogKey]] = {}
+        self._loading: Dict[int, "asyncio.Task[List[XPLogEntry]]"] = {}
+        self._shown = 0
 
     # ==== construction ====
     @classmethod
-    async def new(cls, db, char_ref_id: ObjectId) -> "XPLogBook":
-        data = db["xplog"].find({"charref": char_ref_id})
-        data = data.sort("timestamp", -1)
-        data = await data.to_list(None)
-        if data:
-            return cls.construct(log=[XPLogEntry.construct(**x) for x in data])
-        else:
+    async def new(
+        cls, db, char_ref_id: ObjectId, per_page: int = 4
+    ) -> Optional["XPLogBook"]:
+        total = await db["xplog"].count_documents({"charref": char_ref_id})
+        if not total:
             return None
+        book = cls(db, char_ref_id, total, per_page)
+        await book.page(0)
+        return book
+
+    # ==== pages ====
+    @property
+    def pages(self) -> int:
+        return math.ceil(self.total / self.per_page)
+
+    async def page(self, number: int) -> List[XPLogEntry]:
+        if not 0 <= number < self.pages:
+            raise IndexError(f"page {number} out of range")
+        entries = await self._load(number)
+        ahead = (
+            number - 1
+            if number < self._shown or number == self.pages - 1
+            else number + 1
+        )
+        self._shown = number
+        if 0 <= ahead < self.pages and ahead not in self._pages:
+            self._load_task(ahead)
+        return entries
+
+    def _load_task(self, number: int) -> "asyncio.Task[List[XPLogEntry]]":
+        task = self._loading.get(number)
+        if task is None:
+            task = self._loading[number] = asyncio.create_task(self._fetch(number))
+            task.add_done_callback(lambda _: self._loading.pop(number, None))
+        return task
+
+    async def _load(self, number: int) -> List[XPLogEntry]:
+        if number in self._pages:
+            return self._pages[number][0]
+        return await self._load_task(number)
+
+    async def _fetch(self, number: int) -> List[XPLogEntry]:
+        """Pages are cut from the newest entry, so a page next to one already loaded is a
+        range query from that page's edge, and the oldest one is a query from the other end."""
+        query: Dict[str, Any] = {"charref": self.charref}
+        limit = self.per_page
+        newest_first = True
+        if number - 1 in self._pages:
+            query.update(_older_than(self._pages[number - 1][2]))
+        elif number + 1 in self._pages:
+            query.update(_newer_than(self._pages[number + 1][1]))
+            newest_first = False
+        elif number == self.pages - 1 and number:
+            limit = self.total - number * self.per_page
+            newest_first = False
+        direction = -1 if newest_first else 1
+        cursor = self.collection.find(query).sort(
+            [("timestamp", direction), ("_id", direction)]
+        )
+        if newest_first and number and query.keys() == {"charref"}:
+            # nothing loaded around it, only reachable by jumping into the middle
+            cursor = cursor.skip(number * self.per_page)
+        data = await cursor.limit(limit).to_list(None)
+        if not newest_first:
+            data.reverse()
+        entries = [XPLogEntry.construct(**x) for x in data]
+        if data:
+            self._pages[number] = (entries, _key(data[0]), _key(data[-1]))
+        return entries
+
+
+def _key(document: Mapping[str, Any]) -> LogKey:
+    return document["timestamp"], document["_id"]
+
+
+def _older_than(key: LogKey) -> Dict[str, Any]:
+    timestamp, oid = key
+    return {
+        "$or": [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": oid}},
+        ]
+    }
+
 
-    def paginate(self, items_per_page: int) -> Generator[Tuple[XPLogEntry], None, None]:
-        data = [*self.log]
-        for x in range(math.ceil(len(self.log) / items_per_page)):
-            result = []
-            for y in range(items_per_page):
-                if not data:
-                    break
-                else:
-                    result.append(data[0])
-                    data = data[1:]
-            if result:
-                yield result
-            if not data:
-                break
+def _newer_than(key: LogKey) -> Dict[str, Any]:
+    timestamp, oid = key
+    return {
+        "$or": [
+            {"timestamp": {"$gt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$gt": oid}},
+        ]
+    }
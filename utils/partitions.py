@@ -0,0 +1,150 @@
+import logging
+from dataclasses import dataclass, replace
+from typing import TYPE_CHECKING, Any, Dict, Mapping, Optional
+
+import cachetools
+
+if TYPE_CHECKING:
+    from utils.MongoCache import MongoCache
+
+logger = logging.getLogger("partitions")
+
+
+@dataclass
+class PartitionSpec:
+    """How one collection's slice of the cache is sized and evicted.
+
+    policy is one of "lru", "lfu" or "ttl", ttl only applies to the "ttl" policy.
+    With autotune on, maxsize moves between min_size and max_size based on the hit ratio
+    seen since the last tuning pass."""
+
+    policy: str = "ttl"
+    maxsize: int = 50
+    ttl: Optional[float] = 30
+    autotune: bool = False
+    min_size: int = 25
+    max_size: int = 1000
+    target_hit_ratio: float = 0.9
+
+
+# collections not listed here share the "default" partition
+DEFAULT_PARTITIONS: Dict[str, PartitionSpec] = {
+    # few, hot and read mostly, every command reads them. LFU with room to spare
+    # means an active guild's settings basically never leave the cache
+    "srvconf": PartitionSpec(policy="lfu", maxsize=1000, ttl=None),
+    "userprefs": PartitionSpec(
+        policy="ttl", maxsize=200, ttl=300, autotune=True, max_size=2000
+    ),
+    # many and write heavy, so they're kept around for less time
+    "charactercollection": PartitionSpec(
+        policy="ttl", maxsize=200, ttl=120, autotune=True, max_size=2000
+    ),
+}
+
+# with CacheWatcher evicting anything changed behind our back, entries only need to expire
+# to give memory back, not to pick up outside writes
+WATCHED_TTL = 3600
+
+
+def with_ttl(
+    specs: Mapping[str, PartitionSpec], ttl: float
+) -> Dict[str, PartitionSpec]:
+    """Copy of specs with every expiring partition's ttl set to ttl."""
+    return {x: y if y.ttl is None else replace(y, ttl=ttl) for x, y in specs.items()}
+
+
+class _Partition:
+    """Hooks a cachetools cache up to the MongoCache that owns it, so evictions get written
+    back and the owner's indexes stay in sync, and keeps the hit ratio telemetry."""
+
+    def __init__(self, owner: "MongoCache", name: str, spec: PartitionSpec, *args):
+        super().__init__(*args)
+        self.owner = owner
+        self.name = name
+        self.spec = spec
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        # counters as of the last tuning pass
+        self._window = (0, 0, 0)
+
+    def __delitem__(self, key: str):
+        super().__delitem__(key)
+        self.owner._forget(key)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.evicted += 1
+        self.owner._evict(key, value)
+        return key, value
+
+    def resize(self, maxsize: int):
+        # cachetools doesn't expose a setter, shrinking evicts down to the new size
+        self._Cache__maxsize = maxsize
+        while self.currsize > maxsize:
+            self.popitem()
+
+    def tune(self):
+        hits, misses, evicted = self._window
+        self._window = (self.hits, self.misses, self.evicted)
+        hits, misses, evicted = (
+            self.hits - hits,
+            self.misses - misses,
+            self.evicted - evicted,
+        )
+        lookups = hits + misses
+        if not self.spec.autotune or lookups < 20:
+            return
+        ratio = hits / lookups
+        if ratio < self.spec.target_hit_ratio and evicted:
+            # missing because things got pushed out, not because they were never asked for before
+            maxsize = min(self.spec.max_size, int(self.maxsize * 1.5) + 1)
+        elif ratio >= self.spec.target_hit_ratio and self.currsize < self.maxsize // 2:
+            maxsize = max(self.spec.min_size, self.currsize * 2)
+        else:
+            return
+        if maxsize != self.maxsize:
+            logger.info(
+                f"Resizing {self.name} cache partition {self.maxsize} -> {maxsize} "
+                f"(hit ratio {ratio:.2f}, {evicted} evicted)"
+            )
+            self.resize(maxsize)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "policy": self.spec.policy,
+            "size": self.currsize,
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted": self.evicted,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class LRUPartition(_Partition, cachetools.LRUCache):
+    pass
+
+
+class LFUPartition(_Partition, cachetools.LFUCache):
+    pass
+
+
+class TTLPartition(_Partition, cachetools.TTLCache):
+    def expire(self, time=None):
+        # TTLCache drops expired items without going through __delitem__
+        expired = super().expire(time)
+        for key, value in expired:
+            self.owner._expired(key, value)
+        return expired
+
+
+def make_partition(owner: "MongoCache", name: str, spec: PartitionSpec) -> _Partition:
+    if spec.policy == "lru":
+        return LRUPartition(owner, name, spec, spec.maxsize)
+    if spec.policy == "lfu":
+        return LFUPartition(owner, name, spec, spec.maxsize)
+    if spec.policy == "ttl":
+        return TTLPartition(owner, name, spec, spec.maxsize, spec.ttl)
+    raise ValueError(f"Unknown cache policy {spec.policy!r}")
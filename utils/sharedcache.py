@@ -0,0 +1,139 @@
+import abc
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # only needed when REDIS_URL is configured
+    aioredis = None
+
+logger = logging.getLogger("sharedcache")
+
+DBCACHE_CHANNEL = "labyrinthian:invalidate:dbcache"
+CHARLIST_CHANNEL = "labyrinthian:invalidate:charlist"
+
+
+class SharedCacheBackend(abc.ABC):
+    """A cache tier shared by every process/shard running the bot.
+
+    Sits behind each process's own in-memory cache, and carries the invalidation
+    broadcasts that keep those in-memory caches consistent with each other."""
+
+    @abc.abstractmethod
+    async def get(self, key: str) -> Optional[bytes]:
+        ...
+
+    @abc.abstractmethod
+    async def set(self, key: str, value: bytes, ttl: float):
+        ...
+
+    @abc.abstractmethod
+    async def delete(self, *keys: str):
+        ...
+
+    @abc.abstractmethod
+    async def publish(self, channel: str, message: bytes):
+        ...
+
+    @abc.abstractmethod
+    def listen(self, channel: str) -> AsyncIterator[bytes]:
+        ...
+
+    async def close(self):
+        pass
+
+
+class RedisBackend(SharedCacheBackend):
+    """Shared tier on anything that speaks the redis protocol."""
+
+    def __init__(self, url: str) -> None:
+        if aioredis is None:
+            raise RuntimeError(
+                "REDIS_URL is set, but the redis package isn't installed."
+            )
+        self.redis = aioredis.from_url(url)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.redis.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self.redis.set(key, value, px=int(ttl * 1000))
+
+    async def delete(self, *keys: str):
+        if keys:
+            await self.redis.delete(*keys)
+
+    async def publish(self, channel: str, message: bytes):
+        await self.redis.publish(channel, message)
+
+    async def listen(self, channel: str) -> AsyncIterator[bytes]:
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(channel)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    yield message["data"]
+        finally:
+            await pubsub.unsubscribe(channel)
+            await pubsub.close()
+
+    async def close(self):
+        await self.redis.close()
+
+
+class LocalBackend(SharedCacheBackend):
+    """In-process stand-in for a shared server, for running several caches in one process
+    (or trying the shared tier out without a redis server)."""
+
+    def __init__(self) -> None:
+        self.data: Dict[str, Tuple[bytes, float]] = {}
+        self.subscribers: Dict[str, List["asyncio.Queue[bytes]"]] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        value, expires = self.data.get(key, (None, 0.0))
+        if value is not None and time.monotonic() >= expires:
+            self.data.pop(key, None)
+            return None
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        self.data[key] = (value, time.monotonic() + ttl)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self.data.pop(key, None)
+
+    async def publish(self, channel: str, message: bytes):
+        for queue in self.subscribers.get(channel, ()):
+            queue.put_nowait(message)
+
+    async def listen(self, channel: str) -> AsyncIterator[bytes]:
+        queue: "asyncio.Queue[bytes]" = asyncio.Queue()
+        self.subscribers.setdefault(channel, []).append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.subscribers[channel].remove(queue)
+
+
+async def listen_for_invalidations(
+    backend: SharedCacheBackend,
+    channel: str,
+    callback: Callable[[bytes], Awaitable[None]],
+):
+    """Feeds every broadcast on channel to callback, resubscribing if the connection drops."""
+    delay = 1.0
+    while True:
+        try:
+            async for message in backend.listen(channel):
+                delay = 1.0
+                await callback(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(f"Lost the invalidation subscription to {channel}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60.0)
@@ -0,0 +1,47 @@
+import logging
+import os
+from typing import Any, Dict, Iterable, List, Mapping
+
+import bson
+from bson.errors import InvalidBSON
+
+logger = logging.getLogger("snapshot")
+
+
+class CacheSnapshot:
+    """The hot set of a cache, written on shutdown and read back on startup so a restart
+    doesn't start out cold.
+
+    Same layout as the LIT journal, one BSON document per entry appended back to back.
+    What goes in an entry is up to the cache, the snapshot just stores and returns them."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def save(self, entries: Iterable[Mapping[str, Any]]):
+        temppath = f"{self.path}.tmp"
+        count = 0
+        with open(temppath, "wb") as snapshot:
+            for entry in entries:
+                snapshot.write(bson.encode(entry))
+                count += 1
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temppath, self.path)
+        logger.info(f"Snapshotted {count} cache entries to {self.path}")
+
+    def load(self) -> List[Dict[str, Any]]:
+        """Returns every entry in the snapshot, a damaged tail is dropped."""
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path, "rb") as snapshot:
+            try:
+                for entry in bson.decode_file_iter(snapshot):
+                    entries.append(entry)
+            except InvalidBSON:
+                logger.warning(
+                    f"Cache snapshot {self.path} is damaged, "
+                    f"keeping the {len(entries)} entries before the damage"
+                )
+        return entries
@@ -1,6 +1,6 @@
 import abc
 import asyncio
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Dict, List
 
 import disnake
 import inflect
@@ -13,7 +13,7 @@ if TYPE_CHECKING:
     from utils.models.character import Character
     from utils.models.settings.guild import ServerSettings
     from utils.models.settings.user import UserPreferences
-    from utils.models.xplog import XPLogBook
+    from utils.models.xplog import XPLogBook, XPLogEntry, XPStats
 
 
 class LogMenuBase(MenuBase, abc.ABC):
@@ -29,9 +29,13 @@ class LogMenu(LogMenuBase):
         self.priv = privileged
         self.selval = None
         self.char: "Character" = None
+        # the user's characters in this guild by name, loaded together when the menu opens
+        self.chars: Dict[str, "Character"] = {}
         self.log: "XPLogBook" = None
-        self.pagelist = []
+        self.stats: "XPStats" = None
         self.page = 0
+        # page number -> formatted page, only ever filled for pages that were shown
+        self.rendered: Dict[int, str] = {}
         super().__init__(*args, **kwargs)
 
     @classmethod
@@ -80,7 +84,7 @@ class LogMenu(LogMenuBase):
     @disnake.ui.button(emoji="▶", style=disnake.ButtonStyle.secondary, disabled=True)
     async def next_page(self, _: disnake.ui.Button, inter: disnake.MessageInteraction):
         self.page += 1
-        if self.page >= (len(self.pagelist) - 1):
+        if self.page >= (self.log.pages - 1):
             _.disabled = True
             self.last_page.disabled = True
         self.first_page.disabled = False
@@ -89,7 +93,7 @@ class LogMenu(LogMenuBase):
 
     @disnake.ui.button(emoji="⏩", style=disnake.ButtonStyle.blurple, disabled=True)
     async def last_page(self, _: disnake.ui.Button, inter: disnake.MessageInteraction):
-        self.page = len(self.pagelist) - 1
+        self.page = self.log.pages - 1
         self.first_page.disabled = False
         self.previous_page.disabled = False
         self.next_page.disabled = True
@@ -103,8 +107,8 @@ class LogMenu(LogMenuBase):
         self, select: disnake.ui.Select, inter: disnake.MessageInteraction
     ):
         if select.values[0] is None:
-            self.page = 0
-            self.pagelist = None
+            self.log = None
+            self.reset_pages()
             await self.refresh_content(inter)
             return
         await self.refresh_chardat(select.values[0])
@@ -114,70 +118,98 @@ class LogMenu(LogMenuBase):
             for x in self.children:
                 if isinstance(x, StaffArchiveCharButton):
                     x.disabled = False
-        self.struct_log_embs()
-        if len(self.pagelist) in (1, 0):
-            self.first_page.disabled = True
-            self.previous_page.disabled = True
+        self.reset_pages()
+        self._refresh_char_select()
+        await self.refresh_content(inter)
+
+    # ==== helpers ====
+    def reset_pages(self):
+        self.page = 0
+        self.rendered.clear()
+        self.first_page.disabled = True
+        self.previous_page.disabled = True
+        if not self.log or self.log.pages == 1:
             self.next_page.disabled = True
             self.last_page.disabled = True
         else:
             self.next_page.disabled = False
             self.last_page.disabled = False
-        self._refresh_char_select()
-        await self.refresh_content(inter)
 
-    # ==== helpers ====
-    def struct_log_embs(self):
-        if not self.log:
-            self.pagelist = []
-            self.page = 0
-            return
-        p = inflect.engine()
-        pagelist = []
-        for x in self.log.paginate(4):
-            toybox = []
-            for y in x:
-                notneg = False if y.xpadded < 0 else True
-                toybox.append(
-                    f"{('<@'+y.user+'> at')*(self.char.user != y.user)} <t:{y.timestamp}:f>\n"
-                    f"`{y.name} {'gained' if notneg else 'lost'} "
-                    f"{y.prevxp}({'+'*notneg}{y.xpadded}) {p.plural(self.settings.xplabel)}` "
-                    f"Approved by: <@{y.dm}>"
-                )
-            pagelist.append("\n\n".join(toybox))
-        self.pagelist = pagelist
-        self.page = 0
+    async def render_page(self, number: int) -> str:
+        if number not in self.rendered:
+            self.rendered[number] = self.format_page(await self.log.page(number))
+        return self.rendered[number]
+
+    def format_page(self, entries: List["XPLogEntry"]) -> str:
+        label = inflect.engine().plural(self.settings.xplabel)
+        toybox = []
+        for y in entries:
+            notneg = False if y.xpadded < 0 else True
+            toybox.append(
+                f"{('<@'+y.user+'> at')*(self.char.user != y.user)} <t:{y.timestamp}:f>\n"
+                f"`{y.name} {'gained' if notneg else 'lost'} "
+                f"{y.prevxp}({'+'*notneg}{y.xpadded}) {label}` "
+                f"Approved by: <@{y.dm}>"
+            )
+        return "\n\n".join(toybox)
+
+    def format_stats(self) -> str:
+        label = inflect.engine().plural(self.settings.xplabel)
+        lines = [f"Current {label}: {self.char.xp}"]
+        # the level as of the newest log entry, computed only for characters logged before stats
+        if self.stats and self.stats.level is not None:
+            lines.append(f"Expected Level: {self.stats.level}")
+        else:
+            lines.append(f"Expected Level: {self.char.expected_level}")
+        if self.stats:
+            lines.append(
+                f"Logged: +{self.stats.gained}/-{self.stats.lost} "
+                f"over {self.stats.entries} entries"
+            )
+        return "\n".join(lines)
 
     # ==== content ====
     def _refresh_char_select(self):
+        label = inflect.engine().plural(self.settings.xplabel)
         self.select_char.options.clear()
         for char in reversed(
             self.uprefs.characters[str(self.guild.id)]
         ):  # display highest-first
             selected = self.selval is not None and self.selval == char
-            self.select_char.add_option(label=char, default=selected)
+            loaded = self.chars.get(char)
+            self.select_char.add_option(
+                label=char,
+                description=(
+                    f"Level {loaded.level} | {loaded.xp} {label}" if loaded else None
+                ),
+                default=selected,
+            )
+
+    async def load_chars(self):
+        self.chars = {
+            x.name: x
+            async for x in self.bot.get_characters_bulk(
+                {"user": self.uprefs.user, "guild": str(self.guild.id)}
+            )
+        }
 
     async def refresh_chardat(self, name):
         self.selval = name
-        self.char = await self.bot.get_character(
+        self.char = self.chars.get(name) or await self.bot.get_character(
             str(self.guild.id), self.uprefs.user, self.selval, validate=False
         )
         if self.char:
-            self.log = await self.bot.get_character_xplog(self.char.id)
+            self.log, self.stats = await asyncio.gather(
+                self.bot.get_character_xplog(self.char.id),
+                self.bot.get_character_xpstats(str(self.guild.id), self.char.id),
+            )
 
     async def _before_send(self):
         disabled = True
+        await self.load_chars()
         if str(self.guild.id) in self.uprefs.activechar:
             await self.refresh_chardat(self.uprefs.activechar[str(self.guild.id)].name)
-            self.struct_log_embs()
-            if len(self.pagelist) in (1, 0):
-                self.first_page.disabled = True
-                self.previous_page.disabled = True
-                self.next_page.disabled = True
-                self.last_page.disabled = True
-            else:
-                self.next_page.disabled = False
-                self.last_page.disabled = False
+            self.reset_pages()
             disabled = False
         if self.priv:
             self.add_item(StaffArchiveCharButton(disabled))
@@ -222,10 +254,7 @@ class LogMenu(LogMenuBase):
                 )
                 .add_field(
                     name=f"{self.settings.xplabel} Information:",
-                    value=(
-                        f"Current {p.plural(self.settings.xplabel)}: {self.char.xp}\n"
-                        f"Expected Level: {self.char.expected_level}"
-                    ),
+                    value=self.format_stats(),
                     inline=True,
                 )
                 .add_field(
@@ -241,16 +270,14 @@ class LogMenu(LogMenuBase):
                 .add_field(
                     name=f"{self.settings.xplabel} log",
                     value=(
-                        self.pagelist[self.page]
-                        if self.pagelist
+                        await self.render_page(self.page)
+                        if self.log
                         else "This character doesn't have any entries yet..."
                     ),
                 )
             )
-            if self.pagelist:
-                embeds[0].set_footer(
-                    text=f"Page {self.page + 1} of {len(self.pagelist)}"
-                )
+            if self.log:
+                embeds[0].set_footer(text=f"Page {self.page + 1} of {self.log.pages}")
         return {"embeds": embeds}
 
 
@@ -289,11 +316,11 @@ class StaffArchiveCharButton(disnake.ui.Button[LogMenu]):
             raise FormTimeoutError
         if modalinter.text_values["confirm_archive"] == "Confirm":
             await self.view.char.archive(self.view.bot, self.view.uprefs)
+            self.view.chars.pop(self.view.char.name, None)
             self.view.selval = None
             self.view.char = None
             self.view.log = None
-            self.view.pagelist = []
-            self.view.page = 0
+            self.view.reset_pages()
             self.disabled = True
         else:
             await inter.send("Removal canceled", ephemeral=True)
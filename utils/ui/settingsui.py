@@ -468,8 +468,9 @@ class CoinPurseSettingsView(SettingsMenuBase, SelectandModify):
             "emoji": modalinter.text_values["modal_currency_emoji"],
         }
         data = self.validate_modal_input(data)
-        self.settings.coinconf.types.append(CoinType.from_dict(data))
-        self.settings.coinconf.sort_items()
+        self.settings.coinconf = self.settings.coinconf.replace(
+            [*self.settings.coinconf.types, CoinType.from_dict(data)]
+        )
         self.matchindex = (
             x for x, y in enumerate(self.settings.coinconf.types) if self.matched is y
         )
@@ -502,9 +503,11 @@ class CoinPurseSettingsView(SettingsMenuBase, SelectandModify):
         if "id" in self.matched:
             data["uid"] = self.matched.id
         data = self.validate_modal_input(data)
-        self.settings.coinconf.types[self.matchindex] = CoinType.from_dict(data)
-        self.matched = self.settings.coinconf.types[self.matchindex]
-        self.settings.coinconf.sort_items()
+        edited = CoinType.from_dict(data)
+        types = list(self.settings.coinconf.types)
+        types[self.matchindex] = edited
+        self.settings.coinconf = self.settings.coinconf.replace(types)
+        self.matched = self.settings.coinconf.by_uid[edited.uid]
         self.matchindex = (
             x for x, y in enumerate(self.settings.coinconf.types) if self.matched is y
         )
@@ -540,9 +543,10 @@ class CoinPurseSettingsView(SettingsMenuBase, SelectandModify):
             raise FormTimeoutError
         if modalinter.text_values["removal_confirm"] == "Confirm":
             await inter.send("Removal confirmed", ephemeral=True)
-            self.settings.coinconf.types.remove(self.matched)
+            self.settings.coinconf = self.settings.coinconf.replace(
+                x for x in self.settings.coinconf.types if x != self.matched
+            )
             self.selected = self.matched = self.matchindex = None
-            self.settings.coinconf.sort_items()
             await self.commit_settings()
             self.refresh_select()
             self.process_selection()
@@ -1125,6 +1129,7 @@ class AuctionDurationsView(SettingsMenuBase, SelectandModify):
             )
         self.settings.listingdurs.durlist.append(Duration.from_dict(data))
         self.settings.listingdurs.sort_items()
+        self.settings.mark_dirty("listingdurs")
         self.matchindex = (
             x
             for x, y in enumerate(self.settings.listingdurs.durlist)
@@ -1190,6 +1195,7 @@ class AuctionDurationsView(SettingsMenuBase, SelectandModify):
         self.settings.listingdurs.durlist[self.matchindex] = Duration.from_dict(data)
         self.matched = self.settings.listingdurs.durlist[self.matchindex]
         self.settings.listingdurs.sort_items()
+        self.settings.mark_dirty("listingdurs")
         self.matchindex = (
             x
             for x, y in enumerate(self.settings.listingdurs.durlist)
@@ -1228,6 +1234,7 @@ class AuctionDurationsView(SettingsMenuBase, SelectandModify):
             self.settings.listingdurs.durlist.remove(self.matched)
             self.selected = self.matched = self.matchindex = None
             self.settings.listingdurs.sort_items()
+            self.settings.mark_dirty("listingdurs")
             await self.commit_settings()
             self.refresh_select()
             self.process_selection()
@@ -1465,6 +1472,7 @@ class AuctionRaritiesView(SettingsMenuBase, SelectandModify):
             )
         self.settings.rarities.rarlist.append(Rarity.from_dict(data))
         self.settings.rarities.sort_items()
+        self.settings.mark_dirty("rarities")
         self.matchindex = (
             x for x, y in enumerate(self.settings.rarities) if self.matched is y
         )
@@ -1520,6 +1528,7 @@ class AuctionRaritiesView(SettingsMenuBase, SelectandModify):
         self.settings.rarities.rarlist[self.matchindex] = Rarity.from_dict(data)
         self.matched = self.settings.rarities.rarlist[self.matchindex]
         self.settings.rarities.sort_items()
+        self.settings.mark_dirty("rarities")
         self.matchindex = (
             x for x, y in enumerate(self.settings.rarities.rarlist) if self.matched is y
         )
@@ -1556,6 +1565,7 @@ class AuctionRaritiesView(SettingsMenuBase, SelectandModify):
             self.settings.rarities.rarlist.remove(self.matched)
             self.selected = self.matched = self.matchindex = None
             self.settings.rarities.sort_items()
+            self.settings.mark_dirty("rarities")
             await self.commit_settings()
             self.refresh_select()
             self.process_selection()